@@ -0,0 +1,215 @@
+"""Local stand-in for the part of the Supervisely API used by the engine. Images are synthetic
+JPEGs generated in memory, so the benchmarks run without the server and network access.
+Optional latency emulates the round trip of each request.
+"""
+
+import io
+import itertools
+import time
+
+from types import SimpleNamespace
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+import supervisely as sly
+from PIL import Image
+
+# Number of distinct synthetic images of each size, the images of the dataset cycle through them.
+VARIANTS_PER_SIZE = 8
+
+
+def generate_image(width: int, height: int, seed: int) -> bytes:
+    """Generates a JPEG with a random gradient and noise, so decoding costs the same as for
+    a real photo of the same size."""
+    rng = np.random.default_rng(seed)
+    x = np.linspace(0, 1, width, dtype=np.float32)[None, :, None]
+    y = np.linspace(0, 1, height, dtype=np.float32)[:, None, None]
+    colors = rng.uniform(0, 255, size=(3, 3)).astype(np.float32)
+    image = colors[0] * x + colors[1] * y + colors[2] * (1 - x) * (1 - y)
+    image += rng.normal(0, 16, size=(height, width, 3)).astype(np.float32)
+    buffer = io.BytesIO()
+    Image.fromarray(np.clip(image, 0, 255).astype(np.uint8)).save(buffer, "JPEG", quality=90)
+    return buffer.getvalue()
+
+
+class FakeApi:
+    """Fake API with the datasets of synthetic images in a single project.
+
+    Args:
+        datasets (int): number of the source datasets.
+        images_per_dataset (int): number of images in each source dataset.
+        sizes (List[Tuple[int, int]]): sizes (width, height) of the images, the images of the
+            dataset cycle through them.
+        latency (float, optional): delay of each request in seconds. Defaults to 0.0.
+        seed (int, optional): seed for the synthetic images. Defaults to 0.
+    """
+
+    def __init__(
+        self,
+        datasets: int,
+        images_per_dataset: int,
+        sizes: List[Tuple[int, int]],
+        latency: float = 0.0,
+        seed: int = 0,
+    ):
+        self.server_address = "http://localhost"
+        self.headers = {}
+        self.latency = latency
+
+        self._ids = itertools.count(1)
+        self.project_id = next(self._ids)
+        self.projects = {self.project_id: SimpleNamespace(id=self.project_id, name="source")}
+        self.datasets: Dict[int, SimpleNamespace] = {}
+        self.images: Dict[int, sly.ImageInfo] = {}
+        self.image_bytes: Dict[Tuple[int, int, int], bytes] = {}
+
+        for size in sizes:
+            for variant in range(VARIANTS_PER_SIZE):
+                self.image_bytes[(*size, variant)] = generate_image(*size, seed + variant)
+
+        for dataset_index in range(datasets):
+            dataset_id = self.add_dataset(self.project_id, f"dataset_{dataset_index}")
+            for image_index in range(images_per_dataset):
+                width, height = sizes[image_index % len(sizes)]
+                variant = image_index // len(sizes) % VARIANTS_PER_SIZE
+                self.add_image(
+                    dataset_id,
+                    f"image_{image_index}.jpg",
+                    width,
+                    height,
+                    f"{width}x{height}_{variant}",
+                )
+
+        self.image = FakeImageApi(self)
+        self.annotation = FakeAnnotationApi(self)
+        self.project = FakeProjectApi(self)
+        self.dataset = FakeDatasetApi(self)
+
+    @property
+    def source_dataset_ids(self) -> List[int]:
+        return [
+            dataset.id
+            for dataset in self.datasets.values()
+            if dataset.project_id == self.project_id
+        ]
+
+    def add_dataset(self, project_id: int, name: str) -> int:
+        dataset_id = next(self._ids)
+        self.datasets[dataset_id] = SimpleNamespace(id=dataset_id, project_id=project_id, name=name)
+        return dataset_id
+
+    def add_image(
+        self, dataset_id: int, name: str, width: int, height: int, image_hash: str, meta=None
+    ) -> sly.ImageInfo:
+        image_id = next(self._ids)
+        image_info = sly.ImageInfo._make([None] * len(sly.ImageInfo._fields))._replace(
+            id=image_id,
+            name=name,
+            dataset_id=dataset_id,
+            width=width,
+            height=height,
+            hash=image_hash,
+            updated_at="2024-01-01T00:00:00.000Z",
+            meta=meta or {},
+            full_storage_url=f"/fake/{image_hash}",
+            preview_url=f"/fake/{image_hash}",
+        )
+        self.images[image_id] = image_info
+        return image_info
+
+    def wait(self):
+        if self.latency:
+            time.sleep(self.latency)
+
+
+class FakeImageApi:
+    def __init__(self, api: FakeApi):
+        self._api = api
+
+    def get_list(self, dataset_id: int) -> List[sly.ImageInfo]:
+        self._api.wait()
+        return [info for info in self._api.images.values() if info.dataset_id == dataset_id]
+
+    def get_info_by_id(self, image_id: int) -> Optional[sly.ImageInfo]:
+        self._api.wait()
+        return self._api.images.get(image_id)
+
+    def download_bytes(self, dataset_id: int, ids: List[int]) -> List[bytes]:
+        self._api.wait()
+        result = []
+        for image_id in ids:
+            image_info = self._api.images[image_id]
+            width_height, variant = image_info.hash.rsplit("_", 1)
+            width, height = map(int, width_height.split("x"))
+            result.append(self._api.image_bytes[(width, height, int(variant))])
+        return result
+
+    def upload_ids(
+        self, dataset_id: int, names: List[str], ids: List[int], metas: Optional[List] = None
+    ) -> List[sly.ImageInfo]:
+        self._api.wait()
+        metas = metas or [None] * len(ids)
+        return [
+            self._api.add_image(
+                dataset_id,
+                name,
+                self._api.images[image_id].width,
+                self._api.images[image_id].height,
+                self._api.images[image_id].hash,
+                meta,
+            )
+            for name, image_id, meta in zip(names, ids, metas)
+        ]
+
+
+class FakeAnnotationApi:
+    def __init__(self, api: FakeApi):
+        self._api = api
+
+    def copy_batch_by_ids(self, src_image_ids: List[int], dst_image_ids: List[int], **kwargs):
+        self._api.wait()
+
+    def download_json_batch(self, dataset_id: int, image_ids: List[int]) -> List[Dict]:
+        self._api.wait()
+        return [
+            sly.Annotation((info.height, info.width)).to_json()
+            for info in (self._api.images[image_id] for image_id in image_ids)
+        ]
+
+    def upload_anns(self, img_ids: List[int], anns: List[sly.Annotation], **kwargs):
+        self._api.wait()
+
+
+class FakeProjectApi:
+    def __init__(self, api: FakeApi):
+        self._api = api
+        self._metas = {}
+
+    def get_meta(self, project_id: int) -> Dict:
+        self._api.wait()
+        return self._metas.get(project_id, sly.ProjectMeta().to_json())
+
+    def update_meta(self, project_id: int, meta: sly.ProjectMeta):
+        self._api.wait()
+        self._metas[project_id] = meta.to_json() if isinstance(meta, sly.ProjectMeta) else meta
+
+    def create(self, workspace_id: int, name: str, **kwargs) -> SimpleNamespace:
+        self._api.wait()
+        project_id = next(self._api._ids)
+        self._api.projects[project_id] = SimpleNamespace(id=project_id, name=name)
+        return self._api.projects[project_id]
+
+    def get_info_by_id(self, project_id: int) -> Optional[SimpleNamespace]:
+        return self._api.projects.get(project_id)
+
+
+class FakeDatasetApi:
+    def __init__(self, api: FakeApi):
+        self._api = api
+
+    def create(self, project_id: int, name: str, **kwargs) -> SimpleNamespace:
+        self._api.wait()
+        return self._api.datasets[self._api.add_dataset(project_id, name)]
+
+    def get_info_by_id(self, dataset_id: int) -> Optional[SimpleNamespace]:
+        return self._api.datasets.get(dataset_id)
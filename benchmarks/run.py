@@ -0,0 +1,298 @@
+"""Offline benchmark of the filtering pipeline. Runs the same engine as the app and the headless
+mode end to end (inference with the selected model, backend and batch size, then sorting and
+saving the results) against the fake API with synthetic images, and reports images/sec, peak
+RSS and per-stage latency for each configuration. All caches (embeddings, indexes, checkpoints,
+results) are isolated in a temporary directory, so each run encodes all images.
+
+The model weights must be in the cache (~/.cache) already, use --random-weights to benchmark
+randomly initialized models without downloading them, e.g. in CI without network access.
+
+Example:
+    python -m benchmarks.run --images 512 --sizes 640x480 1920x1080 \
+        --models ViT-B-32 --backends pytorch onnx --batch-sizes 16 32 --random-weights
+
+Use --output to save the report as JSON and --baseline to compare the throughput with
+the saved report, the exit code is 1 if any configuration is slower than the baseline by more
+than --tolerance.
+"""
+
+import argparse
+import itertools
+import json
+import os
+import resource
+import sys
+import tempfile
+import threading
+import time
+
+from typing import Dict, List, Optional, Tuple
+
+# The engine reads the app environment on import, the fake values keep it offline.
+TEMP_DIR = tempfile.mkdtemp(prefix="clip_benchmark_")
+for name, value in {
+    "SERVER_ADDRESS": "http://localhost",
+    "API_TOKEN": "benchmark",
+    "TEAM_ID": "1",
+    "WORKSPACE_ID": "1",
+    "SLY_APP_DATA_DIR": os.path.join(TEMP_DIR, "app_data"),
+}.items():
+    os.environ.setdefault(name, value)
+
+import supervisely as sly  # noqa: E402
+
+import src.globals as g  # noqa: E402
+import src.engine as engine  # noqa: E402
+import src.clip_api as clip_api  # noqa: E402
+from src.embedding_store import EmbeddingStore  # noqa: E402
+from src.models import get_model_data  # noqa: E402
+from src.prompts import Prompt, PromptQuery  # noqa: E402
+
+from benchmarks.fake_api import FakeApi  # noqa: E402
+
+# Interval of the RSS sampling in seconds.
+RSS_SAMPLING_INTERVAL = 0.05
+# Default model is the first one of the available models.
+DEFAULT_MODEL_NAME, DEFAULT_PRETRAINED = next(iter(g.MODELS))[:2]
+
+
+class PeakRss:
+    """Samples the resident set size of the process in a background thread and keeps the peak,
+    so each configuration gets its own peak instead of the peak of the whole process."""
+
+    def __init__(self):
+        self.peak = current_rss()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._sample, daemon=True)
+
+    def __enter__(self) -> "PeakRss":
+        self._thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self._stop.set()
+        self._thread.join()
+        self.peak = max(self.peak, current_rss())
+
+    def _sample(self):
+        while not self._stop.wait(RSS_SAMPLING_INTERVAL):
+            self.peak = max(self.peak, current_rss())
+
+
+def current_rss() -> int:
+    """Returns the resident set size of the process in bytes. Falls back to the peak RSS of the
+    process on systems without /proc."""
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def parse_size(size: str) -> Tuple[int, int]:
+    width, height = size.lower().split("x")
+    return int(width), int(height)
+
+
+def parse_args(args: Optional[List[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Offline benchmark of the filtering pipeline.")
+    parser.add_argument("--datasets", type=int, default=1, help="Number of source datasets.")
+    parser.add_argument("--images", type=int, default=256, help="Images in each dataset.")
+    parser.add_argument(
+        "--sizes", type=parse_size, nargs="+", default=[(1280, 720)], help="e.g. 640x480."
+    )
+    parser.add_argument("--latency", type=float, default=0.0, help="API request delay, s.")
+    parser.add_argument("--models", nargs="+", default=[DEFAULT_MODEL_NAME], help="Model names.")
+    parser.add_argument(
+        "--pretrained", default=DEFAULT_PRETRAINED, help="Pretrained tag of the models."
+    )
+    parser.add_argument(
+        "--random-weights",
+        action="store_true",
+        help="Use randomly initialized models, so the weights aren't downloaded.",
+    )
+    parser.add_argument("--backends", nargs="+", choices=list(g.BACKENDS), default=["pytorch"])
+    parser.add_argument("--batch-sizes", type=int, nargs="+", default=[g.MODEL_BATCH_SIZE])
+    parser.add_argument("--execution-mode", choices=list(g.EXECUTION_MODES), default="eager")
+    parser.add_argument("--decode-mode", choices=list(g.DECODE_POOL_MODES), default="threads")
+    parser.add_argument("--decode-workers", type=int, default=g.DECODE_WORKERS)
+    parser.add_argument("--image-source", choices=["original", "reduced"], default="original")
+    parser.add_argument("--device", help="Defaults to GPU if available (CPU for remote backend).")
+    parser.add_argument("--no-save", action="store_true", help="Benchmark only the inference.")
+    parser.add_argument("--output", help="Path to save the report as JSON.")
+    parser.add_argument("--baseline", help="Path to the report to compare the throughput with.")
+    parser.add_argument(
+        "--tolerance", type=float, default=0.2, help="Allowed relative throughput drop."
+    )
+    args = parser.parse_args(args)
+
+    # Randomly initialized models don't need to be in the list of available models.
+    if not args.random_weights:
+        for model_name in args.models:
+            try:
+                get_model_data(model_name, args.pretrained)
+            except ValueError as e:
+                parser.error(f"{e} Use --random-weights to benchmark it without the weights.")
+    return args
+
+
+def isolate_caches():
+    """Moves all the persistent caches of the engine to a new temporary directory. The exported
+    ONNX models are isolated too, so the exports of randomly initialized models don't get into
+    the cache of the app and aren't reused by the next runs with other random weights."""
+    cache_dir = tempfile.mkdtemp(dir=TEMP_DIR)
+    g.EMBEDDINGS_STORE = EmbeddingStore(
+        os.path.join(cache_dir, "embeddings.db"), g.EMBEDDINGS_STORE_MAX_SIZE
+    )
+    g.INDEX_DIR = os.path.join(cache_dir, "indexes")
+    g.CHECKPOINTS_DIR = os.path.join(cache_dir, "checkpoints")
+    g.RESULTS_DIR = os.path.join(cache_dir, "results")
+    clip_api.ONNX_CACHE_DIR = os.path.join(cache_dir, "onnx")
+
+
+def register_random_model(model_name: str) -> str:
+    """Adds the randomly initialized model to the available models and returns its pretrained
+    tag. The empty tag makes open_clip skip loading the weights."""
+    placeholder = os.path.join(TEMP_DIR, f"{model_name}_random.pt")
+    open(placeholder, "a").close()
+    g.MODELS[(model_name, "", "-", "-")] = {"url": None, "path": placeholder}
+    return ""
+
+
+def run_config(
+    api: FakeApi,
+    model_name: str,
+    pretrained: str,
+    backend: str,
+    batch_size: int,
+    args: argparse.Namespace,
+) -> Dict:
+    """Runs inference and saving for the configuration and returns its report."""
+    # Each configuration encodes all the images, the embeddings of the previous one aren't used.
+    isolate_caches()
+
+    params = engine.InferenceParams(
+        model_name=model_name,
+        pretrained=pretrained,
+        batch_size=batch_size,
+        decode_workers=args.decode_workers,
+        decode_mode=args.decode_mode,
+        image_source=args.image_source,
+        execution_mode=args.execution_mode,
+        backend=backend,
+        device=args.device or engine.get_device(backend),
+    )
+    query = PromptQuery([Prompt("a photo of a dog")])
+
+    # Building the model before the measurement, so the load time isn't counted.
+    engine.load_model(params)
+
+    with PeakRss() as peak_rss:
+        result = engine.run_inference(api, api.source_dataset_ids, query, params)
+
+        saved = 0
+        save_seconds = 0.0
+        if not args.no_save:
+            image_infos, scores = engine.select_images(
+                result.image_infos, result.scores, result.i_sort, engine.SaveParams("desc")
+            )
+            project_id = engine.create_project(api, g.WORKSPACE_ID, "benchmark")
+            dataset_id = engine.create_dataset(api, project_id, "benchmark")
+
+            save_start = time.perf_counter()
+            saved = len(
+                engine.save_results(
+                    api,
+                    image_infos,
+                    scores,
+                    query.label(),
+                    api.project_id,
+                    project_id,
+                    dataset_id,
+                )
+            )
+            save_seconds = time.perf_counter() - save_start
+
+    metrics = result.metrics or {"stages": {}, "queues": {}}
+    return {
+        "model": model_name,
+        "pretrained": pretrained or "random",
+        "backend": backend,
+        "batch_size": batch_size,
+        "images": result.encoded_count,
+        "images_per_second": round(result.images_per_second, 2),
+        "peak_rss_mb": round(peak_rss.peak / 1024**2, 1),
+        "stages_batch_ms": {
+            stage: timing["batch_ms"] for stage, timing in metrics["stages"].items()
+        },
+        "queues": metrics["queues"],
+        "saved": saved,
+        "save_images_per_second": round(saved / save_seconds, 2) if save_seconds else 0.0,
+    }
+
+
+def config_key(report: Dict) -> Tuple:
+    return report["model"], report["pretrained"], report["backend"], report["batch_size"]
+
+
+def compare(reports: List[Dict], baseline: List[Dict], tolerance: float) -> List[str]:
+    """Returns the descriptions of the configurations, which are slower than the baseline."""
+    baseline_by_key = {config_key(report): report for report in baseline}
+    regressions = []
+    for report in reports:
+        reference = baseline_by_key.get(config_key(report))
+        if reference is None or not reference["images_per_second"]:
+            continue
+        change = report["images_per_second"] / reference["images_per_second"] - 1
+        if change < -tolerance:
+            regressions.append(
+                f"{config_key(report)}: {report['images_per_second']} images/sec, "
+                f"baseline {reference['images_per_second']} ({change:+.1%})"
+            )
+    return regressions
+
+
+def format_report(report: Dict) -> str:
+    stages = ", ".join(f"{stage} {ms} ms" for stage, ms in report["stages_batch_ms"].items())
+    return (
+        f"{report['model']} ({report['pretrained']}), {report['backend']}, "
+        f"batch {report['batch_size']}: {report['images_per_second']} images/sec, "
+        f"peak RSS {report['peak_rss_mb']} MB, save {report['save_images_per_second']} "
+        f"images/sec. Per batch: {stages}."
+    )
+
+
+def main(args: Optional[List[str]] = None) -> List[Dict]:
+    args = parse_args(args)
+
+    api = FakeApi(args.datasets, args.images, args.sizes, args.latency)
+    sly.logger.info(
+        f"Generated {args.datasets * args.images} synthetic images of sizes {args.sizes} "
+        f"in {TEMP_DIR}."
+    )
+
+    reports = []
+    for model_name, backend, batch_size in itertools.product(
+        args.models, args.backends, args.batch_sizes
+    ):
+        pretrained = register_random_model(model_name) if args.random_weights else args.pretrained
+        report = run_config(api, model_name, pretrained, backend, batch_size, args)
+        reports.append(report)
+        print(format_report(report), flush=True)
+
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(reports, file, indent=4)
+
+    if args.baseline:
+        with open(args.baseline) as file:
+            regressions = compare(reports, json.load(file), args.tolerance)
+        if regressions:
+            print("Throughput regressions:\n" + "\n".join(regressions), file=sys.stderr)
+            sys.exit(1)
+
+    return reports
+
+
+if __name__ == "__main__":
+    main()
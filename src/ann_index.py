@@ -0,0 +1,242 @@
+import os
+
+from collections import OrderedDict
+from typing import List, Optional, Tuple
+
+import numpy as np
+import supervisely as sly
+
+from src.embedding_store import image_fingerprint
+
+# Number of k-means iterations and max number of training vectors per list.
+KMEANS_ITERATIONS = 10
+TRAINING_VECTORS_PER_LIST = 256
+
+# Number of vectors, which are assigned to the lists at once, to limit memory usage.
+ASSIGN_CHUNK_SIZE = 65536
+
+# Number of loaded indexes kept in memory.
+LOADED_INDEXES_CACHE_SIZE = 4
+loaded_indexes = OrderedDict()
+
+
+class IVFIndex:
+    """Inverted file index over normalized embeddings for approximate top-k search by cosine
+    similarity. The embeddings are clustered with spherical k-means and stored grouped by their
+    nearest centroid (list). Search scans only the lists with the closest centroids to the query.
+    The index is built with NumPy only, so it doesn't require network access or extra packages.
+
+    Args:
+        centroids (np.ndarray): normalized centroids of the lists with shape (n_lists, dim).
+        offsets (np.ndarray): start of each list in vectors with shape (n_lists + 1,).
+        vectors (np.ndarray): embeddings grouped by lists with shape (n, dim).
+        ids (np.ndarray): image ids of the vectors with shape (n,).
+        fingerprints (np.ndarray): image fingerprints of the vectors to detect changed images.
+    """
+
+    def __init__(
+        self,
+        centroids: np.ndarray,
+        offsets: np.ndarray,
+        vectors: np.ndarray,
+        ids: np.ndarray,
+        fingerprints: np.ndarray,
+    ):
+        self.centroids = centroids
+        self.offsets = offsets
+        self.vectors = vectors
+        self.ids = ids
+        self.fingerprints = fingerprints
+
+    @classmethod
+    def build(
+        cls,
+        vectors: np.ndarray,
+        image_infos: List[sly.ImageInfo],
+        n_lists: Optional[int] = None,
+        seed: int = 0,
+    ) -> "IVFIndex":
+        """Builds the index over the embeddings of the images.
+
+        Args:
+            vectors (np.ndarray): normalized embeddings with shape (n, dim).
+            image_infos (List[sly.ImageInfo]): infos of the images (in the same order as vectors).
+            n_lists (Optional[int], optional): number of lists. Defaults to 4 * sqrt(n).
+            seed (int, optional): seed for k-means initialization. Defaults to 0.
+
+        Returns:
+            IVFIndex: the built index.
+        """
+        vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+        if n_lists is None:
+            n_lists = int(4 * np.sqrt(len(vectors)))
+        n_lists = int(np.clip(n_lists, 1, len(vectors)))
+
+        rng = np.random.default_rng(seed)
+        training_size = min(len(vectors), n_lists * TRAINING_VECTORS_PER_LIST)
+        training_vectors = vectors[rng.choice(len(vectors), training_size, replace=False)]
+
+        centroids = training_vectors[rng.choice(training_size, n_lists, replace=False)]
+        for _ in range(KMEANS_ITERATIONS):
+            assignments = assign(training_vectors, centroids)
+            order = np.argsort(assignments, kind="stable")
+            counts = np.bincount(assignments, minlength=n_lists)
+            starts = np.cumsum(counts) - counts
+
+            # Empty lists keep their previous centroids.
+            non_empty = counts > 0
+            sums = np.add.reduceat(training_vectors[order], starts[non_empty], axis=0)
+            centroids[non_empty] = sums / np.linalg.norm(sums, axis=1, keepdims=True)
+
+        assignments = assign(vectors, centroids)
+        order = np.argsort(assignments, kind="stable")
+        offsets = np.searchsorted(assignments[order], np.arange(n_lists + 1))
+
+        ids = np.array([image_info.id for image_info in image_infos], dtype=np.int64)
+        fingerprints = np.array([str(image_fingerprint(image_info)) for image_info in image_infos])
+
+        sly.logger.info(f"Built IVF index with {n_lists} lists over {len(vectors)} embeddings.")
+
+        return cls(centroids, offsets, vectors[order], ids[order], fingerprints[order])
+
+    def search(self, query: np.ndarray, k: int, n_probe: int) -> Tuple[np.ndarray, np.ndarray]:
+        """Searches for the k images with the highest similarity to the query in the n_probe
+        lists with the closest centroids.
+
+        Args:
+            query (np.ndarray): query vector with shape (dim,).
+            k (int): number of images to find.
+            n_probe (int): number of lists to scan.
+
+        Returns:
+            Tuple[np.ndarray, np.ndarray]: ids and scores of the found images in descending order.
+        """
+        n_probe = min(n_probe, len(self.centroids))
+        lists = np.argpartition(-(self.centroids @ query), n_probe - 1)[:n_probe]
+        candidates = np.concatenate(
+            [np.arange(self.offsets[i], self.offsets[i + 1]) for i in lists]
+        )
+        return top_k(self.vectors[candidates] @ query, self.ids[candidates], k)
+
+    def is_valid(self, image_infos: List[sly.ImageInfo]) -> bool:
+        """Checks if the index contains exactly the given images in their current state."""
+        if len(image_infos) != len(self.ids):
+            return False
+        current = {image_info.id: str(image_fingerprint(image_info)) for image_info in image_infos}
+        return all(
+            current.get(image_id) == fingerprint
+            for image_id, fingerprint in zip(self.ids.tolist(), self.fingerprints.tolist())
+        )
+
+    def save(self, path: str):
+        sly.fs.mkdir(os.path.dirname(path))
+        # Writing to a temporary file first, so the index isn't corrupted if the app is stopped.
+        temp_path = f"{path}.tmp.npz"
+        np.savez(
+            temp_path,
+            centroids=self.centroids,
+            offsets=self.offsets,
+            vectors=self.vectors,
+            ids=self.ids,
+            fingerprints=self.fingerprints,
+        )
+        os.replace(temp_path, path)
+        cache_index(path, self)
+        sly.logger.info(f"IVF index was saved to {path}.")
+
+    @classmethod
+    def load(cls, path: str) -> "IVFIndex":
+        with np.load(path) as data:
+            return cls(
+                data["centroids"],
+                data["offsets"],
+                data["vectors"],
+                data["ids"],
+                data["fingerprints"],
+            )
+
+
+def assign(vectors: np.ndarray, centroids: np.ndarray) -> np.ndarray:
+    """Returns the index of the closest centroid for each vector."""
+    assignments = np.empty(len(vectors), dtype=np.int64)
+    for start in range(0, len(vectors), ASSIGN_CHUNK_SIZE):
+        chunk = vectors[start : start + ASSIGN_CHUNK_SIZE]
+        assignments[start : start + len(chunk)] = np.argmax(chunk @ centroids.T, axis=1)
+    return assignments
+
+
+def top_k(scores: np.ndarray, ids: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+    """Returns the ids and scores of the k items with the highest scores in descending order."""
+    k = min(k, len(scores))
+    if k == 0:
+        return ids[:0], scores[:0]
+    top = np.argpartition(-scores, k - 1)[:k]
+    top = top[np.argsort(-scores[top], kind="stable")]
+    return ids[top], scores[top]
+
+
+def exact_search(
+    vectors: np.ndarray, ids: np.ndarray, query: np.ndarray, k: int
+) -> Tuple[np.ndarray, np.ndarray]:
+    """Searches for the k images with the highest similarity to the query by scanning all
+    the embeddings. Used as a fallback and to verify the approximate search.
+
+    Args:
+        vectors (np.ndarray): normalized embeddings with shape (n, dim).
+        ids (np.ndarray): image ids of the embeddings with shape (n,).
+        query (np.ndarray): query vector with shape (dim,).
+        k (int): number of images to find.
+
+    Returns:
+        Tuple[np.ndarray, np.ndarray]: ids and scores of the found images in descending order.
+    """
+    return top_k(vectors @ query, ids, k)
+
+
+def recall(approximate_ids: np.ndarray, exact_ids: np.ndarray) -> float:
+    """Returns the share of the exact top-k images found by the approximate search."""
+    if len(exact_ids) == 0:
+        return 1.0
+    return len(np.intersect1d(approximate_ids, exact_ids)) / len(exact_ids)
+
+
+def get_index_path(
+    index_dir: str, datasets_key: str, model_name: str, pretrained: str, variant: str
+) -> str:
+    return os.path.join(index_dir, f"{datasets_key}_{model_name}_{pretrained}_{variant}.npz")
+
+
+def cache_index(path: str, index: IVFIndex):
+    """Keeps the index in memory, the least recently used indexes are evicted."""
+    loaded_indexes[path] = index
+    loaded_indexes.move_to_end(path)
+    while len(loaded_indexes) > LOADED_INDEXES_CACHE_SIZE:
+        loaded_indexes.popitem(last=False)
+
+
+def load_index(path: str, image_infos: List[sly.ImageInfo]) -> Optional[IVFIndex]:
+    """Loads the index from the path (or from memory, if it was loaded recently) and checks
+    that it's built over the current state of the images.
+
+    Args:
+        path (str): path to the saved index.
+        image_infos (List[sly.ImageInfo]): current infos of the images in the dataset.
+
+    Returns:
+        Optional[IVFIndex]: the index or None if it doesn't exist or is outdated.
+    """
+    if path in loaded_indexes:
+        loaded_indexes.move_to_end(path)
+        index = loaded_indexes[path]
+    elif os.path.exists(path):
+        index = IVFIndex.load(path)
+        cache_index(path, index)
+    else:
+        sly.logger.debug(f"IVF index wasn't found in {path}.")
+        return None
+
+    if not index.is_valid(image_infos):
+        sly.logger.info(f"IVF index in {path} is outdated, it will be rebuilt.")
+        return None
+
+    return index
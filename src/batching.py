@@ -0,0 +1,169 @@
+import threading
+
+from typing import Iterator, List
+
+import torch
+import supervisely as sly
+
+# Number of batches of each size, which are measured during the probing. The first batch of a
+# new size is slower (memory allocation, kernel selection), so the fastest one is taken.
+PROBE_BATCHES_PER_SIZE = 2
+# Minimal throughput gain to keep doubling the batch size.
+MIN_THROUGHPUT_GAIN = 0.05
+# Share of the RAM or VRAM, which should stay free.
+MEMORY_HEADROOM = 0.15
+
+
+class AdaptiveBatchSize:
+    """Batch size, which is picked by the measured throughput of the model and the memory
+    headroom. During the probing the batch size is doubled while the throughput grows and the
+    next batch fits into the free memory, then the best size is used. If the free memory drops
+    below the headroom later or the model runs out of memory, the batch size is halved and the
+    larger sizes aren't tried again.
+
+    Args:
+        initial (int): batch size to start the probing with.
+        max_size (int): max batch size.
+        device (str): device of the model, "cuda" or "cpu".
+        adaptive (bool, optional): whether to adjust the batch size. If False, the batch size is
+            reduced only on out of memory errors. Defaults to True.
+    """
+
+    def __init__(self, initial: int, max_size: int, device: str, adaptive: bool = True):
+        self._lock = threading.Lock()
+        self.batch_size = max(1, min(initial, max_size))
+        self.max_size = max_size
+        self.device = device
+        self.probing = adaptive
+        self.adaptive = adaptive
+
+        self._best_size = None
+        self._best_throughput = 0.0
+        self._size_throughput = 0.0
+        self._size_batches = 0
+        self._memory_baseline = self._allocated_memory()
+
+    def update(self, batch_size: int, seconds: float):
+        """Takes the time of the forward pass of the batch and adjusts the batch size.
+
+        Args:
+            batch_size (int): number of images in the batch.
+            seconds (float): time of the forward pass.
+        """
+        if not self.adaptive or seconds <= 0:
+            return
+
+        fits_double = self._fits(batch_size * 2)
+        with self._lock:
+            if not self.probing:
+                if not self._fits(batch_size):
+                    self._reduce(batch_size // 2, "free memory is below the headroom")
+                return
+
+            # Batches of the previous size can still be in the pipeline.
+            if batch_size != self.batch_size:
+                return
+
+            self._size_throughput = max(self._size_throughput, batch_size / seconds)
+            self._size_batches += 1
+            if self._size_batches < PROBE_BATCHES_PER_SIZE:
+                return
+
+            sly.logger.debug(
+                f"Batch size {batch_size}: {self._size_throughput:.1f} images/sec in forward pass."
+            )
+            gain = self._size_throughput / self._best_throughput - 1 if self._best_size else 1.0
+            if gain >= MIN_THROUGHPUT_GAIN:
+                self._best_size, self._best_throughput = batch_size, self._size_throughput
+            if gain >= MIN_THROUGHPUT_GAIN and fits_double and batch_size * 2 <= self.max_size:
+                self._set_probe_size(batch_size * 2)
+            else:
+                self.probing = False
+                self.batch_size = self._best_size
+                sly.logger.info(
+                    f"Batch size {self.batch_size} was selected with "
+                    f"{self._best_throughput:.1f} images/sec in forward pass."
+                )
+
+    def on_out_of_memory(self, batch_size: int):
+        """Halves the batch size after the out of memory error on the batch of the given size."""
+        with self._lock:
+            self._reduce(batch_size // 2, "out of memory")
+
+    def _reduce(self, batch_size: int, reason: str):
+        batch_size = max(1, batch_size)
+        if batch_size >= self.batch_size and not self.probing:
+            return
+        self.batch_size = batch_size
+        self.max_size = batch_size
+        self.probing = False
+        self._best_size = min(self._best_size or batch_size, batch_size)
+        sly.logger.warning(f"Batch size was reduced to {batch_size}: {reason}.")
+
+    def _set_probe_size(self, batch_size: int):
+        self.batch_size = batch_size
+        self._size_throughput = 0.0
+        self._size_batches = 0
+        if self.device == "cuda":
+            torch.cuda.reset_peak_memory_stats()
+
+    def _fits(self, batch_size: int) -> bool:
+        """Checks if the batch of the given size keeps the free memory above the headroom. On GPU
+        the memory of a batch is estimated by the peak allocation of the previous batches, on CPU
+        only the current free memory is checked, the out of memory errors are handled anyway."""
+        if self.device == "cuda":
+            free, total = torch.cuda.mem_get_info()
+            # Memory cached by PyTorch, but not used by tensors, is available for the next batch.
+            free += torch.cuda.memory_reserved() - torch.cuda.memory_allocated()
+            batch_memory = torch.cuda.max_memory_allocated() - self._memory_baseline
+            current_size = max(self.batch_size, 1)
+            extra_memory = batch_memory * (batch_size - current_size) / current_size
+            return free - max(extra_memory, 0) > MEMORY_HEADROOM * total
+
+        available, total = get_ram_info()
+        if total is None:
+            return True
+        return available > MEMORY_HEADROOM * total
+
+    def _allocated_memory(self) -> int:
+        if self.device == "cuda":
+            torch.cuda.reset_peak_memory_stats()
+            return torch.cuda.memory_allocated()
+        return 0
+
+
+def adaptive_batches(
+    items: List, batch_size: AdaptiveBatchSize, is_cancelled=lambda: False
+) -> Iterator[List]:
+    """Splits the items into batches of the current batch size, which can change between the
+    batches. Stops if the inference is cancelled."""
+    start = 0
+    while start < len(items) and not is_cancelled():
+        size = batch_size.batch_size
+        yield items[start : start + size]
+        start += size
+
+
+def is_out_of_memory(error: Exception) -> bool:
+    """Checks if the error is caused by the lack of RAM or VRAM."""
+    if isinstance(error, MemoryError):
+        return True
+    return isinstance(error, RuntimeError) and "out of memory" in str(error).lower()
+
+
+def get_ram_info() -> tuple:
+    """Returns the available and total RAM in bytes or (None, None) if it's unknown."""
+    try:
+        with open("/proc/meminfo") as meminfo:
+            values = dict(line.split(":", 1) for line in meminfo)
+        return (
+            int(values["MemAvailable"].split()[0]) * 1024,
+            int(values["MemTotal"].split()[0]) * 1024,
+        )
+    except (OSError, KeyError, ValueError):
+        return None, None
+
+
+def free_memory(device: str):
+    if device == "cuda":
+        torch.cuda.empty_cache()
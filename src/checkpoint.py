@@ -0,0 +1,141 @@
+import os
+import shutil
+import time
+
+from typing import Collection, Dict, List
+
+import numpy as np
+import supervisely as sly
+
+from src.embedding_store import image_fingerprint
+
+
+class Checkpoint:
+    """Checkpoint of an inference run in the app data directory, so the run can be resumed after
+    the app restart or cancellation without re-encoding the processed images. The embeddings are
+    saved instead of the scores, so the checkpoint can be reused with any prompt. Each save writes
+    only the images processed since the previous save to a new part file.
+
+    Args:
+        directory (str): directory of the checkpoint.
+    """
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        self.saved_at = time.monotonic()
+
+        self._ids: List[int] = []
+        self._fingerprints: List[str] = []
+        self._features: List[np.ndarray] = []
+
+    def load(self, image_infos: List[sly.ImageInfo]) -> Dict[int, np.ndarray]:
+        """Returns checkpointed embeddings of the given images. Embeddings of images, which were
+        changed since the checkpoint was saved, are skipped.
+
+        Args:
+            image_infos (List[sly.ImageInfo]): infos of the images to get embeddings for.
+
+        Returns:
+            Dict[int, np.ndarray]: image id to embedding mapping for the found images.
+        """
+        fingerprints = {
+            image_info.id: str(image_fingerprint(image_info)) for image_info in image_infos
+        }
+
+        embeddings = {}
+        for path in self._get_parts():
+            with np.load(path) as data:
+                ids = data["ids"].tolist()
+                saved_fingerprints = data["fingerprints"].tolist()
+                features = data["features"]
+            for image_id, fingerprint, feature in zip(ids, saved_fingerprints, features):
+                if fingerprints.get(image_id) == fingerprint:
+                    embeddings[image_id] = feature
+
+        if embeddings:
+            sly.logger.info(f"Loaded {len(embeddings)} embeddings from {self.directory}.")
+
+        return embeddings
+
+    def add(self, image_infos: List[sly.ImageInfo], features: np.ndarray):
+        """Adds the embeddings of the processed images, they are written on the next save."""
+        self._ids.extend(image_info.id for image_info in image_infos)
+        self._fingerprints.extend(str(image_fingerprint(image_info)) for image_info in image_infos)
+        self._features.append(features)
+
+    def save(self):
+        """Writes the embeddings added since the previous save to a new part file."""
+        self.saved_at = time.monotonic()
+        if not self._ids:
+            return
+
+        sly.fs.mkdir(self.directory)
+        # Parts can be removed by the finished runs, so the next index is after the last part.
+        parts = self._get_parts()
+        index = int(os.path.basename(parts[-1]).split(".")[0]) + 1 if parts else 0
+        path = os.path.join(self.directory, f"{index:06d}.npz")
+
+        # Writing to a temporary file first, so the part isn't corrupted if the app is stopped.
+        temp_path = f"{path}.tmp.npz"
+        np.savez(
+            temp_path,
+            ids=np.array(self._ids, dtype=np.int64),
+            fingerprints=np.array(self._fingerprints),
+            features=np.concatenate(self._features).astype(np.float32, copy=False),
+        )
+        os.replace(temp_path, path)
+
+        sly.logger.debug(f"Checkpoint with {len(self._ids)} images was saved to {path}.")
+
+        self._ids, self._fingerprints, self._features = [], [], []
+
+    def remove(self, image_ids: Collection[int]):
+        """Removes the embeddings of the given images after the run over them was finished.
+        The checkpoint is shared by the runs over the same datasets, so the embeddings of other
+        images (e.g. of the interrupted run over all images, when a subset was encoded) are kept.
+        The checkpoint directory is removed when no embeddings are left.
+
+        Args:
+            image_ids (Collection[int]): IDs of the images covered by the finished run.
+        """
+        self._ids, self._fingerprints, self._features = [], [], []
+        image_ids = np.fromiter(image_ids, dtype=np.int64)
+
+        removed = 0
+        for path in self._get_parts():
+            with np.load(path) as data:
+                ids, fingerprints, features = data["ids"], data["fingerprints"], data["features"]
+            keep = ~np.isin(ids, image_ids)
+            if keep.all():
+                continue
+            removed += int((~keep).sum())
+            if not keep.any():
+                os.remove(path)
+                continue
+
+            temp_path = f"{path}.tmp.npz"
+            np.savez(
+                temp_path, ids=ids[keep], fingerprints=fingerprints[keep], features=features[keep]
+            )
+            os.replace(temp_path, path)
+
+        if os.path.isdir(self.directory) and not self._get_parts():
+            shutil.rmtree(self.directory)
+            sly.logger.debug(f"Checkpoint {self.directory} was removed.")
+        elif removed:
+            sly.logger.debug(f"Removed {removed} embeddings from checkpoint {self.directory}.")
+
+    def _get_parts(self) -> List[str]:
+        if not os.path.isdir(self.directory):
+            return []
+        return sorted(
+            os.path.join(self.directory, name)
+            for name in os.listdir(self.directory)
+            if name.endswith(".npz") and ".tmp" not in name
+        )
+
+
+def get_checkpoint_dir(
+    checkpoints_dir: str, datasets_key: str, model_name: str, pretrained: str, variant: str
+) -> str:
+    return os.path.join(checkpoints_dir, f"{datasets_key}_{model_name}_{pretrained}_{variant}")
@@ -0,0 +1,227 @@
+"""Headless entry point for scheduled filtering jobs, which runs the same engine as the app.
+Requires the same environment variables as the app (see local.env and ~/supervisely.env).
+
+Example:
+    python -m src.cli --datasets 63106 --model ViT-L-14 --pretrained openai \
+        --prompt "a photo of a dog" --sort desc --filter "above threshold" --threshold 0.25 \
+        --project-name "Dogs" --dataset-name "Filtered"
+"""
+
+import argparse
+import json
+
+from typing import List, Optional
+
+import supervisely as sly
+
+import src.globals as g
+import src.engine as engine
+from src.prompts import PromptQuery, parse_prompts, parse_templates
+
+
+def parse_args(args: Optional[List[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        description="Score the images of the datasets by the text prompt with CLIP model, "
+        "filter or sort them and save the results to the destination dataset."
+    )
+    parser.add_argument("--datasets", type=int, nargs="+", required=True, help="Dataset IDs.")
+    parser.add_argument("--model", required=True, help="Model name, e.g. ViT-L-14.")
+    parser.add_argument("--pretrained", required=True, help="Pretrained tag, e.g. openai.")
+    parser.add_argument(
+        "--prompt",
+        nargs="+",
+        default=[],
+        help="Text prompts with optional weights, e.g. 'a photo of a dog | 2'.",
+    )
+    parser.add_argument(
+        "--example", type=int, nargs="*", default=[], help="IDs of the example images."
+    )
+    parser.add_argument("--negative-prompt", nargs="*", default=[], help="Negative prompts.")
+    parser.add_argument(
+        "--template", nargs="*", default=[], help="Prompt templates, e.g. 'a photo of {}'."
+    )
+
+    inference = parser.add_argument_group("inference")
+    inference.add_argument("--batch-size", type=int, default=g.MODEL_BATCH_SIZE)
+    inference.add_argument(
+        "--auto-batch-size",
+        action="store_true",
+        help="Adjust the batch size by the measured throughput and the free memory.",
+    )
+    inference.add_argument("--prefetch", type=int, default=g.PREFETCH_BATCHES)
+    inference.add_argument("--decode-workers", type=int, default=g.DECODE_WORKERS)
+    inference.add_argument("--decode-mode", choices=list(g.DECODE_POOL_MODES), default="threads")
+    inference.add_argument("--image-source", choices=list(g.IMAGE_SOURCES), default="original")
+    inference.add_argument("--execution-mode", choices=list(g.EXECUTION_MODES), default="eager")
+    inference.add_argument("--backend", choices=list(g.BACKENDS), default="pytorch")
+    inference.add_argument(
+        "--device", help="Device for the model, defaults to GPU if available (CPU for remote)."
+    )
+    inference.add_argument("--search-mode", choices=list(g.SEARCH_MODES), default="all")
+    inference.add_argument("--top-k", type=int, default=g.TOP_K)
+    inference.add_argument("--exact-search", action="store_true")
+    inference.add_argument(
+        "--duplicate-threshold",
+        type=float,
+        default=g.DUPLICATE_THRESHOLD,
+        help="Minimal similarity of near-duplicates in duplicates search mode.",
+    )
+    inference.add_argument(
+        "--incremental",
+        action="store_true",
+        help="Reuse scores of unchanged images from the last run.",
+    )
+
+    output = parser.add_argument_group("output")
+    output.add_argument("--sort", choices=list(g.SORT_METHODS), help="Sort the images.")
+    output.add_argument("--filter", choices=g.FILTER_METHODS, help="Filter the images.")
+    output.add_argument("--threshold", type=float, default=0.25, help="Threshold for filtering.")
+    output.add_argument("--add-tag", action="store_true", help="Add the confidence tag.")
+    output.add_argument("--project-id", type=int, help="Destination project ID.")
+    output.add_argument("--project-name", help="Name of the new destination project.")
+    output.add_argument("--dataset-id", type=int, help="Destination dataset ID.")
+    output.add_argument("--dataset-name", help="Name of the new destination dataset.")
+    output.add_argument(
+        "--split-classes",
+        nargs="*",
+        default=[],
+        help="Class prompts to split the images into a dataset per class in the destination project.",
+    )
+    output.add_argument("--split-method", choices=list(g.SPLIT_METHODS), default="best")
+    output.add_argument(
+        "--split-threshold", type=float, default=0.5, help="Class probability threshold."
+    )
+    output.add_argument(
+        "--no-save", action="store_true", help="Only score the images, don't save them."
+    )
+
+    return parser.parse_args(args)
+
+
+def main(args: Optional[List[str]] = None) -> dict:
+    """Runs the inference and saves the results according to the command-line arguments.
+
+    Returns:
+        dict: summary of the run, which is also printed as JSON.
+    """
+    args = parse_args(args)
+    api = g.api
+
+    if not args.prompt and not args.example and args.search_mode != "duplicates":
+        raise SystemExit("At least one --prompt or --example is required.")
+    if args.search_mode == "threshold" and args.filter is None:
+        raise SystemExit("--filter is required to select the images in threshold search mode.")
+    if len(args.split_classes) == 1:
+        raise SystemExit("At least two --split-classes are required to split the images.")
+    if args.dataset_id in args.datasets:
+        raise SystemExit("It's not allowed to save results to one of the input datasets.")
+
+    params = engine.InferenceParams(
+        model_name=args.model,
+        pretrained=args.pretrained,
+        batch_size=args.batch_size,
+        auto_batch_size=args.auto_batch_size,
+        prefetch=args.prefetch,
+        decode_workers=args.decode_workers,
+        decode_mode=args.decode_mode,
+        image_source=args.image_source,
+        execution_mode=args.execution_mode,
+        backend=args.backend,
+        device=args.device or engine.get_device(args.backend),
+        search_mode=args.search_mode,
+        top_k=args.top_k,
+        exact_search=args.exact_search,
+        threshold=args.threshold,
+        threshold_method=args.filter or g.FILTER_METHODS[0],
+        incremental=args.incremental,
+        duplicate_threshold=args.duplicate_threshold,
+    )
+
+    query = PromptQuery(
+        positive=parse_prompts("\n".join(args.prompt)),
+        negative=parse_prompts("\n".join(args.negative_prompt)),
+        templates=parse_templates("\n".join(args.template)),
+        examples=args.example,
+    )
+    text_prompt = query.label() or g.DEDUP_LABEL
+
+    result = engine.run_inference(api, args.datasets, query, params)
+
+    summary = {
+        "selected": len(result.image_infos),
+        "encoded": result.encoded_count,
+        "reused": result.reused_count,
+        "duplicates": result.duplicates_count,
+        "images_per_second": round(result.images_per_second, 2),
+        "metrics": result.metrics,
+    }
+
+    if not args.no_save and result.image_infos:
+        save_params = engine.SaveParams(
+            sort_method=args.sort, filter_method=args.filter, threshold=args.threshold
+        )
+        image_infos, scores = engine.select_images(
+            result.image_infos, result.scores, result.i_sort, save_params
+        )
+
+        source_project_id = api.dataset.get_info_by_id(args.datasets[0]).project_id
+        project_id = args.project_id
+        if not project_id and args.dataset_id:
+            project_id = api.dataset.get_info_by_id(args.dataset_id).project_id
+        if not project_id:
+            project_name = args.project_name or engine.get_default_name(text_prompt)
+            project_id = engine.create_project(api, g.WORKSPACE_ID, project_name)
+
+        if args.split_classes:
+            probabilities = engine.classify_images(
+                api, image_infos, args.split_classes, params, templates=query.templates
+            )
+            dataset_ids = [
+                engine.create_dataset(api, project_id, prompt) for prompt in args.split_classes
+            ]
+            splits = engine.build_splits(
+                image_infos,
+                probabilities,
+                args.split_classes,
+                dataset_ids,
+                args.split_method,
+                args.split_threshold,
+            )
+            uploaded_image_ids = engine.save_splits(
+                api, splits, source_project_id, project_id, add_tag=args.add_tag
+            )
+            summary.update(
+                saved=sum(len(ids) for ids in uploaded_image_ids),
+                project_id=project_id,
+                splits={
+                    split.text_prompt: len(ids) for split, ids in zip(splits, uploaded_image_ids)
+                },
+            )
+        else:
+            dataset_id = args.dataset_id
+            if not dataset_id:
+                dataset_name = args.dataset_name or engine.get_default_name(text_prompt)
+                dataset_id = engine.create_dataset(api, project_id, dataset_name)
+
+            uploaded_image_ids = engine.save_results(
+                api,
+                image_infos,
+                scores,
+                text_prompt,
+                source_project_id,
+                project_id,
+                dataset_id,
+                add_tag=args.add_tag,
+            )
+            summary.update(
+                saved=len(uploaded_image_ids), project_id=project_id, dataset_id=dataset_id
+            )
+
+    sly.logger.info(f"Filtering job finished: {summary}.")
+    print(json.dumps(summary))
+
+    return summary
+
+
+if __name__ == "__main__":
+    main()
@@ -1,18 +1,60 @@
 import os
+import time
+from collections import OrderedDict
+
 import numpy as np
 import torch
 import urllib
 from PIL import Image, ImageOps
+from tqdm import tqdm
 import open_clip
 
 import supervisely as sly
 
+import src.onnx_backend as onnx_backend
+
 CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache")
 sly.fs.mkdir(CACHE_DIR)
 sly.logger.info(f"Models cache dir: {CACHE_DIR}")
+# Models exported to ONNX are cached next to the weights.
+ONNX_CACHE_DIR = os.path.join(CACHE_DIR, "onnx")
+
+# Built models are kept in memory between inference runs, the least recently used models are
+# evicted when the number of models or their total size exceeds the limits.
+MODELS_CACHE_SIZE = int(os.getenv("MODELS_CACHE_SIZE", 2))
+MODELS_CACHE_RAM_BUDGET = int(float(os.getenv("MODELS_CACHE_RAM_BUDGET_GB", 16)) * 1024**3)
+models_cache = OrderedDict()
+
+# Normalized text embeddings of the recent prompts, so the text tower runs once per prompt.
+TEXT_FEATURES_CACHE_SIZE = 256
+text_features_cache = OrderedDict()
 
 
-def build_model(model_name, pretrained, device, model_data, jit=False):
+def build_model(
+    model_name,
+    pretrained,
+    device,
+    model_data,
+    execution_mode="eager",
+    backend="pytorch",
+    progress=None,
+    cache=True,
+):
+    """Builds the model or takes it from the cache. With cache=False the built model isn't
+    added to the cache and doesn't evict the cached ones, e.g. for a short speed measurement."""
+    cache_key = (model_name, pretrained, device, execution_mode, backend)
+    if cache_key in models_cache:
+        models_cache.move_to_end(cache_key)
+        model, preprocess, tokenizer, _ = models_cache[cache_key]
+        sly.logger.info(f"Model cache hit: {cache_key}, the model won't be loaded again.")
+        return model, preprocess, tokenizer
+
+    sly.logger.info(f"Model cache miss: {cache_key}, the model will be loaded.")
+
+    # Freeing the cache slot before loading, so two large models aren't loaded at the same time.
+    if cache:
+        evict_models(MODELS_CACHE_SIZE - 1, MODELS_CACHE_RAM_BUDGET)
+
     model_url = model_data.get("url")
     model_filename = model_data.get("path")
     model_path = os.path.join(CACHE_DIR, model_filename)
@@ -21,7 +63,7 @@ def build_model(model_name, pretrained, device, model_data, jit=False):
         sly.logger.info(f"Model file wasn't found in cache in path {model_path}")
         sly.logger.info(f"Model {model_name} will be downloaded from {model_url}")
 
-        download_model(model_url, model_path)
+        download_model(model_url, model_path, progress)
     else:
         sly.logger.info(
             f"Model file was found in cache in path {model_path}"
@@ -30,19 +72,135 @@ def build_model(model_name, pretrained, device, model_data, jit=False):
 
     sly.logger.info("Preparing the model...")
 
+    start_time = time.perf_counter()
     model, _, preprocess = open_clip.create_model_and_transforms(
-        model_name, pretrained, device=device, jit=jit
+        model_name, pretrained, device=device, jit=execution_mode == "jit"
     )
     tokenizer = open_clip.get_tokenizer(model_name)
+    if backend == "pytorch":
+        model = apply_execution_mode(model, execution_mode)
+    else:
+        model_dir = os.path.join(ONNX_CACHE_DIR, f"{model_name}_{pretrained}")
+        model = onnx_backend.build_onnx_model(
+            model,
+            tokenizer,
+            get_input_size(preprocess),
+            model_dir,
+            device,
+            quantize=backend == "onnx_int8",
+        )
+    load_time = time.perf_counter() - start_time
+
+    size = get_model_size(model)
+    sly.logger.info(
+        f"Model {model_name} ({pretrained}) was loaded in {load_time:.2f} s, "
+        f"size in memory: {size / 1024 ** 3:.2f} GB."
+    )
+
+    if cache:
+        models_cache[cache_key] = (model, preprocess, tokenizer, size)
+        evict_models(MODELS_CACHE_SIZE, MODELS_CACHE_RAM_BUDGET)
+
     return model, preprocess, tokenizer
 
 
-def load_image(image_path):
+def apply_execution_mode(model, execution_mode):
+    """Prepares the model for the execution mode. TorchScript JIT is applied while the model is
+    created, torch.compile compiles the model lazily on the first batch, channels-last converts
+    the weights to NHWC memory format (input batches are converted in encode_images).
+
+    Args:
+        model: the built model.
+        execution_mode (str): one of "eager", "jit", "compile" or "channels_last".
+
+    Returns:
+        the model prepared for the execution mode.
+    """
+    if execution_mode == "compile":
+        if not hasattr(torch, "compile"):
+            sly.logger.warning(
+                f"torch.compile is not available in torch {torch.__version__}, "
+                "the model will be executed in eager mode."
+            )
+            return model
+        # Only the image tower is compiled, since the text tower runs once per prompt.
+        model.encode_image = torch.compile(model.encode_image)
+    elif execution_mode == "channels_last":
+        model = model.to(memory_format=torch.channels_last)
+
+    return model
+
+
+def get_model_size(model) -> int:
+    if isinstance(model, onnx_backend.OnnxModel):
+        return model.size
+
+    tensors = list(model.parameters()) + list(model.buffers())
+    return sum(tensor.numel() * tensor.element_size() for tensor in tensors)
+
+
+def evict_models(max_models: int, ram_budget: int):
+    """Evicts the least recently used models from the cache until the number of cached models
+    and their total size are within the limits. A single model, which exceeds the RAM budget
+    by itself, is kept in the cache, since it's used right now.
+
+    Args:
+        max_models (int): max number of models in the cache.
+        ram_budget (int): max total size of the cached models in bytes.
+    """
+    evicted = False
+
+    while models_cache:
+        total_size = sum(size for *_, size in models_cache.values())
+        within_budget = total_size <= ram_budget or len(models_cache) == 1
+        if len(models_cache) <= max_models and within_budget:
+            break
+
+        cache_key, (*_, size) = models_cache.popitem(last=False)
+        evicted = True
+        sly.logger.info(
+            f"Model {cache_key} was evicted from the cache, freed {size / 1024 ** 3:.2f} GB."
+        )
+
+    if evicted and torch.cuda.is_available():
+        torch.cuda.empty_cache()
+
+
+def load_image(image_path, target_size=None):
     image = Image.open(image_path)
+    if target_size is not None:
+        image = reduce_image(image, target_size)
+    # The orientation is applied after the reduction: draft mode works only before the image is
+    # loaded, and the rotation by 90 degrees doesn't change the shortest side used for the factor.
     image = ImageOps.exif_transpose(image)
     return image
 
 
+def reduce_image(image: Image.Image, target_size: int) -> Image.Image:
+    """Decodes the image at reduced resolution, keeping the shortest side not less than
+    the target size. JPEG images are decoded directly at the reduced scale (draft mode),
+    other formats are decoded fully and reduced by an integer factor.
+
+    Args:
+        image (Image.Image): opened, but not loaded image.
+        target_size (int): input size of the model.
+
+    Returns:
+        Image.Image: reduced image.
+    """
+    if image.format == "JPEG":
+        image.draft("RGB", (target_size, target_size))
+        return image
+
+    factor = min(image.size) // target_size
+    if factor >= 2:
+        # Palette and 1-bit images can't be reduced, the model converts them to RGB anyway.
+        if image.mode in ("P", "1"):
+            image = image.convert("RGB")
+        image = image.reduce(factor)
+    return image
+
+
 def preprocess_image(image_pil, preprocess) -> torch.Tensor:
     input_image = preprocess(image_pil)
     return input_image
@@ -58,16 +216,112 @@ def collate_batch(input_images: list, device) -> torch.Tensor:
     return input_images
 
 
-def infer_batch(model: open_clip.CLIP, input_images, input_prompts):
-    with torch.no_grad(), torch.cuda.amp.autocast():
+def encode_images(model: open_clip.CLIP, input_images, execution_mode="eager") -> torch.Tensor:
+    if execution_mode == "channels_last":
+        input_images = input_images.contiguous(memory_format=torch.channels_last)
+
+    # Mixed precision is used only on GPU, on CPU the model runs in float32.
+    with torch.no_grad(), torch.cuda.amp.autocast(enabled=input_images.is_cuda):
         image_features = model.encode_image(input_images)
-        text_features = model.encode_text(input_prompts)
         image_features /= image_features.norm(dim=-1, keepdim=True)
+    return image_features.float()
+
+
+def encode_prompts(model: open_clip.CLIP, input_prompts) -> torch.Tensor:
+    with torch.no_grad(), torch.cuda.amp.autocast(enabled=input_prompts.is_cuda):
+        text_features = model.encode_text(input_prompts)
         text_features /= text_features.norm(dim=-1, keepdim=True)
-        logits_per_image = image_features @ text_features.T
+    return text_features.float()
+
+
+def get_text_features(
+    model_name,
+    pretrained,
+    model: open_clip.CLIP,
+    tokenizer,
+    prompts,
+    device,
+    execution_mode="eager",
+    backend="pytorch",
+) -> torch.Tensor:
+    """Returns normalized text embeddings of the prompts, encoding them only if they aren't
+    in the cache for the given model yet. Embeddings of different backends and execution modes
+    differ slightly, so they are cached separately and match the image embeddings of the run.
+
+    Args:
+        model_name (str): name of the model.
+        pretrained (str): pretrained tag of the model.
+        model (open_clip.CLIP): the model to encode the prompts with.
+        tokenizer: tokenizer of the model.
+        prompts (List[str]): text prompts.
+        device (str): device to run the text encoder on.
+        execution_mode (str, optional): execution mode of the model. Defaults to "eager".
+        backend (str, optional): backend of the model. Defaults to "pytorch".
+
+    Returns:
+        torch.Tensor: normalized text embeddings with shape (len(prompts), embedding size).
+    """
+    cache_key = (model_name, pretrained, execution_mode, backend, tuple(prompts))
+    if cache_key in text_features_cache:
+        text_features_cache.move_to_end(cache_key)
+        sly.logger.debug(f"Text features cache hit for prompts: {prompts}.")
+        return text_features_cache[cache_key]
+
+    input_prompts = preprocess_prompts(prompts, tokenizer, device)
+    text_features = encode_prompts(model, input_prompts)
+
+    text_features_cache[cache_key] = text_features
+    if len(text_features_cache) > TEXT_FEATURES_CACHE_SIZE:
+        text_features_cache.popitem(last=False)
+
+    return text_features
+
+
+def infer_batch(
+    model: open_clip.CLIP, input_images, text_features: torch.Tensor, execution_mode="eager"
+):
+    image_features = encode_images(model, input_images, execution_mode)
+    logits_per_image = image_features @ text_features.T
     return logits_per_image
 
 
+def get_input_size(preprocess) -> int:
+    return preprocess(Image.new("RGB", (32, 32))).shape[-1]
+
+
+def measure_throughput(
+    model: open_clip.CLIP, input_size, batch_size, device, execution_mode="eager", batches=3
+) -> float:
+    """Measures the speed of the image encoder on random input batches. The first batch is
+    used for warm up (e.g. compilation) and isn't measured.
+
+    Args:
+        model (open_clip.CLIP): the model built for the execution mode.
+        input_size (int): input size of the model.
+        batch_size (int): number of images in the batch.
+        device (str): device of the model.
+        execution_mode (str, optional): execution mode of the model. Defaults to "eager".
+        batches (int, optional): number of measured batches. Defaults to 3.
+
+    Returns:
+        float: number of images per second.
+    """
+    input_images = torch.randn(batch_size, 3, input_size, input_size, device=device)
+    encode_images(model, input_images, execution_mode).cpu()
+
+    start_time = time.perf_counter()
+    for _ in range(batches):
+        # Copying the features to CPU waits for the asynchronous GPU execution to finish.
+        encode_images(model, input_images, execution_mode).cpu()
+    elapsed = time.perf_counter() - start_time
+
+    return batches * batch_size / elapsed
+
+
+def calculate_logits(image_features: np.ndarray, text_features: np.ndarray) -> np.ndarray:
+    return image_features @ text_features.T
+
+
 def collect_inference(logits):
     return torch.cat(logits, 0).cpu().numpy()
 
@@ -77,14 +331,18 @@ def calculate_scores(logits: np.ndarray, weights: list):
     return scores
 
 
-def download_model(source_url, dst_path):
-    from src.ui.inference import inference_progress
+def download_model(source_url, dst_path, progress=None):
+    """Downloads the model checkpoint. The progress is a function, which takes the message,
+    the total and the units and returns a progress bar context manager (e.g. Progress widget).
+    If it's None, the progress is shown in the console."""
+    if progress is None:
+        progress = lambda message, **kwargs: tqdm(desc=message, **kwargs)  # noqa: E731
 
     sly.logger.info(f"Download started from: {source_url}")
     sly.fs.mkdir(os.path.dirname(dst_path))
 
     with urllib.request.urlopen(source_url) as source, open(dst_path, "wb") as output:
-        with inference_progress(
+        with progress(
             message="Downloading model...",
             total=int(source.headers.get("Content-Length")),
             unit="B",
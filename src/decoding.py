@@ -0,0 +1,193 @@
+import io
+import multiprocessing
+import time
+
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from multiprocessing import shared_memory
+from typing import Callable, List, Optional, Tuple
+
+import numpy as np
+import torch
+from PIL import Image
+
+import supervisely as sly
+
+import src.clip_api as clip_api
+from src.metrics import RunMetrics
+from src.jobs import wait_results
+
+# Preprocessing transforms of the model in the process pool workers, set by the initializer.
+_worker_preprocess = None
+
+
+class DecodePool:
+    """Pool of workers, which decode and preprocess the images of a batch in parallel.
+    In threads mode the workers write tensors directly to the output batch. In processes mode
+    the workers write preprocessed images to a shared memory buffer, so large arrays aren't
+    pickled between processes. If pin_memory is True, the output batch is allocated in
+    page-locked memory for faster asynchronous copy to GPU. If reduced is True, the images
+    are decoded at the resolution close to the model input size instead of the full one.
+
+    Args:
+        preprocess: preprocessing transforms of the model.
+        workers (int): number of workers in the pool.
+        mode (str, optional): "threads" or "processes". Defaults to "threads".
+        pin_memory (bool, optional): whether to pin the output batch memory. Defaults to False.
+        reduced (bool, optional): whether to decode the images at reduced resolution.
+            Defaults to False.
+    """
+
+    def __init__(
+        self,
+        preprocess,
+        workers: int,
+        mode: str = "threads",
+        pin_memory: bool = False,
+        reduced: bool = False,
+    ):
+        self.preprocess = preprocess
+        self.workers = max(workers, 1)
+        self.mode = mode
+        self.pin_memory = pin_memory
+
+        # Shape of the preprocessed image, e.g. (3, 224, 224).
+        self.image_shape = tuple(preprocess(Image.new("RGB", (32, 32))).shape)
+        self.target_size = self.image_shape[-1] if reduced else None
+
+        self._shared_memory = None
+
+        if mode == "threads":
+            self._executor = ThreadPoolExecutor(max_workers=self.workers)
+        elif mode == "processes":
+            self._executor = ProcessPoolExecutor(
+                max_workers=self.workers,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=_init_worker,
+                initargs=(preprocess,),
+            )
+        else:
+            raise ValueError(f"Unknown decode pool mode: {mode}")
+
+        sly.logger.info(
+            f"Decode pool was started with {self.workers} {mode}, image shape: {self.image_shape}."
+        )
+
+    def decode(
+        self,
+        images_bytes: List[bytes],
+        metrics: Optional[RunMetrics] = None,
+        is_cancelled: Callable[[], bool] = lambda: False,
+    ) -> torch.Tensor:
+        """Decodes and preprocesses the images in the pool and stacks them into a batch.
+
+        Args:
+            images_bytes (List[bytes]): encoded images.
+            metrics (Optional[RunMetrics], optional): metrics to add the decode and preprocess
+                time summed over the workers to. Defaults to None.
+            is_cancelled (Callable[[], bool], optional): function, which returns True if the
+                inference was cancelled. Checked while waiting for the workers, the images,
+                which weren't started yet, are skipped. Defaults to lambda: False.
+
+        Raises:
+            Cancelled: if the inference was cancelled.
+
+        Returns:
+            torch.Tensor: batch of preprocessed images on CPU.
+        """
+        batch = torch.empty((len(images_bytes), *self.image_shape), pin_memory=self.pin_memory)
+
+        if self.mode == "threads":
+            timings = []
+            futures = [
+                self._executor.submit(self._decode_image, image_bytes)
+                for image_bytes in images_bytes
+            ]
+            results = wait_results(futures, is_cancelled)
+            for index, (image, decode_time, preprocess_time) in enumerate(results):
+                batch[index] = image
+                timings.append((decode_time, preprocess_time))
+            add_timings(metrics, timings)
+            return batch
+
+        shared_batch = self._get_shared_batch(len(images_bytes))
+        futures = [
+            self._executor.submit(
+                _decode_to_shared_memory,
+                self._shared_memory.name,
+                shared_batch.shape,
+                index,
+                image_bytes,
+                self.target_size,
+            )
+            for index, image_bytes in enumerate(images_bytes)
+        ]
+
+        # Waiting for all the workers to write their images to the shared memory.
+        timings = list(wait_results(futures, is_cancelled))
+        add_timings(metrics, timings)
+
+        batch.copy_(torch.from_numpy(shared_batch[: len(images_bytes)]))
+        return batch
+
+    def close(self):
+        """Stops the workers and releases the shared memory."""
+        self._executor.shutdown(wait=True)
+
+        if self._shared_memory is not None:
+            self._shared_memory.close()
+            self._shared_memory.unlink()
+            self._shared_memory = None
+
+        sly.logger.debug("Decode pool was closed.")
+
+    def _decode_image(self, image_bytes: bytes) -> Tuple[torch.Tensor, float, float]:
+        start = time.perf_counter()
+        image_pil = clip_api.load_image(io.BytesIO(image_bytes), self.target_size)
+        decoded = time.perf_counter()
+        image = clip_api.preprocess_image(image_pil, self.preprocess)
+        return image, decoded - start, time.perf_counter() - decoded
+
+    def _get_shared_batch(self, batch_size: int) -> np.ndarray:
+        shape = (batch_size, *self.image_shape)
+        size = int(np.prod(shape)) * np.dtype(np.float32).itemsize
+
+        if self._shared_memory is None or self._shared_memory.size < size:
+            # Reallocating the buffer only when a larger batch comes.
+            if self._shared_memory is not None:
+                self._shared_memory.close()
+                self._shared_memory.unlink()
+            self._shared_memory = shared_memory.SharedMemory(create=True, size=size)
+
+        return np.ndarray(shape, dtype=np.float32, buffer=self._shared_memory.buf)
+
+
+def add_timings(metrics: Optional[RunMetrics], timings: List[Tuple[float, float]]):
+    """Adds the decode and preprocess time of the images of a batch to the metrics."""
+    if metrics is None or not timings:
+        return
+    metrics.add("decode", sum(timing[0] for timing in timings))
+    metrics.add("preprocess", sum(timing[1] for timing in timings))
+
+
+def _init_worker(preprocess):
+    global _worker_preprocess
+    _worker_preprocess = preprocess
+    torch.set_num_threads(1)
+
+
+def _decode_to_shared_memory(
+    name: str, shape: tuple, index: int, image_bytes: bytes, target_size: Optional[int]
+) -> Tuple[float, float]:
+    start = time.perf_counter()
+    image_pil = clip_api.load_image(io.BytesIO(image_bytes), target_size)
+    decoded = time.perf_counter()
+    image = clip_api.preprocess_image(image_pil, _worker_preprocess)
+    preprocessed = time.perf_counter()
+
+    buffer = shared_memory.SharedMemory(name=name)
+    try:
+        np.ndarray(shape, dtype=np.float32, buffer=buffer.buf)[index] = image.numpy()
+    finally:
+        buffer.close()
+
+    return decoded - start, preprocessed - decoded
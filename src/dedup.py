@@ -0,0 +1,160 @@
+from typing import Iterator, Optional, Tuple
+
+import numpy as np
+import supervisely as sly
+
+from src.ann_index import IVFIndex
+
+# Size of the square blocks of the similarity matrix, which are computed at once.
+BLOCK_SIZE = 4096
+
+
+class UnionFind:
+    """Disjoint sets of elements 0..size-1 with the batched union of pairs. Each root points to
+    itself, other elements point to an element with a smaller index, so the sets can be merged
+    with vectorized operations without cycles.
+
+    Args:
+        size (int): number of elements.
+    """
+
+    def __init__(self, size: int):
+        self.parent = np.arange(size, dtype=np.int64)
+
+    def find(self, elements: np.ndarray) -> np.ndarray:
+        """Returns the roots of the sets of the elements and compresses their paths."""
+        roots = self.parent[elements]
+        while True:
+            parents = self.parent[roots]
+            if np.array_equal(parents, roots):
+                break
+            roots = parents
+        self.parent[elements] = roots
+        return roots
+
+    def union(self, first: np.ndarray, second: np.ndarray):
+        """Merges the sets of each pair of elements. The larger root is hooked to the smaller
+        one, conflicting hooks are resolved in the next rounds until all pairs are merged."""
+        while len(first):
+            first_roots, second_roots = self.find(first), self.find(second)
+            different = first_roots != second_roots
+            first, second = first[different], second[different]
+            first_roots, second_roots = first_roots[different], second_roots[different]
+            np.minimum.at(
+                self.parent,
+                np.maximum(first_roots, second_roots),
+                np.minimum(first_roots, second_roots),
+            )
+
+    def labels(self) -> np.ndarray:
+        """Returns the root of the set for each element."""
+        return self.find(np.arange(len(self.parent)))
+
+
+def blocked_pairs(
+    vectors: np.ndarray, threshold: float, block_size: int = BLOCK_SIZE
+) -> Iterator[Tuple[np.ndarray, np.ndarray]]:
+    """Finds all pairs of vectors with the similarity not less than the threshold. The upper
+    triangle of the similarity matrix is computed block by block, so the memory usage doesn't
+    depend on the number of vectors.
+
+    Args:
+        vectors (np.ndarray): normalized embeddings with shape (n, dim).
+        threshold (float): minimal cosine similarity of the duplicates.
+        block_size (int, optional): size of the blocks. Defaults to BLOCK_SIZE.
+
+    Yields:
+        Tuple[np.ndarray, np.ndarray]: positions of the first and the second vectors of the pairs.
+    """
+    for row_start in range(0, len(vectors), block_size):
+        rows_block = vectors[row_start : row_start + block_size]
+        for column_start in range(row_start, len(vectors), block_size):
+            columns_block = vectors[column_start : column_start + block_size]
+            rows, columns = np.nonzero(rows_block @ columns_block.T >= threshold)
+            rows, columns = rows + row_start, columns + column_start
+            mask = rows < columns
+            yield rows[mask], columns[mask]
+
+
+def index_pairs(
+    index: IVFIndex, threshold: float, n_probe: int
+) -> Iterator[Tuple[np.ndarray, np.ndarray]]:
+    """Finds the pairs of vectors with the similarity not less than the threshold, comparing
+    the vectors of each list of the index only with the lists with the closest centroids.
+    Near-duplicates are almost always in the same or neighbouring lists, so the search is
+    approximate, but its cost grows almost linearly with the number of vectors.
+
+    Args:
+        index (IVFIndex): index over the embeddings.
+        threshold (float): minimal cosine similarity of the duplicates.
+        n_probe (int): number of the closest lists to compare each list with, including itself.
+
+    Yields:
+        Tuple[np.ndarray, np.ndarray]: positions of the pairs in the vectors of the index.
+    """
+    n_probe = min(n_probe, len(index.centroids))
+    neighbours = np.argpartition(-(index.centroids @ index.centroids.T), n_probe - 1, axis=1)
+    for list_index, neighbour_lists in enumerate(neighbours[:, :n_probe]):
+        start, end = index.offsets[list_index], index.offsets[list_index + 1]
+        if start == end:
+            continue
+        candidates = np.concatenate(
+            [np.arange(index.offsets[i], index.offsets[i + 1]) for i in neighbour_lists]
+        )
+        rows, columns = np.nonzero(
+            index.vectors[start:end] @ index.vectors[candidates].T >= threshold
+        )
+        rows, columns = rows + start, candidates[columns]
+        # The neighbourhood of the lists isn't symmetric, so the pairs can be found twice.
+        mask = rows != columns
+        yield rows[mask], columns[mask]
+
+
+def group_duplicates(
+    vectors: np.ndarray,
+    threshold: float,
+    index: Optional[IVFIndex] = None,
+    n_probe: int = 8,
+    block_size: int = BLOCK_SIZE,
+) -> np.ndarray:
+    """Groups the near-duplicates: the vectors with the similarity not less than the threshold
+    are in the same group, including the transitive similarity.
+
+    Args:
+        vectors (np.ndarray): normalized embeddings with shape (n, dim). If the index is given,
+            these must be the vectors of the index.
+        threshold (float): minimal cosine similarity of the duplicates.
+        index (Optional[IVFIndex], optional): index to search the pairs approximately. If None,
+            all the pairs are compared with the blocked matrix multiplication. Defaults to None.
+        n_probe (int, optional): number of the closest lists to compare with. Defaults to 8.
+        block_size (int, optional): size of the blocks for exact search. Defaults to BLOCK_SIZE.
+
+    Returns:
+        np.ndarray: group label of each vector with shape (n,), the label is the smallest
+            position in the group.
+    """
+    vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+    if index is not None:
+        pairs = index_pairs(index, threshold, n_probe)
+    else:
+        pairs = blocked_pairs(vectors, threshold, block_size)
+
+    groups = UnionFind(len(vectors))
+    for first, second in pairs:
+        groups.union(first, second)
+
+    labels = groups.labels()
+    sizes = np.bincount(labels, minlength=len(labels))
+    sly.logger.info(
+        f"Found {np.count_nonzero(sizes > 1)} groups of near-duplicates with similarity >= "
+        f"{threshold} among {len(vectors)} images, {np.count_nonzero(sizes)} unique images remain."
+    )
+    return labels
+
+
+def select_representatives(labels: np.ndarray, priorities: np.ndarray) -> np.ndarray:
+    """Returns the position of the element with the highest priority in each group in the order
+    of the groups' labels."""
+    order = np.lexsort((-priorities, labels))
+    _, first = np.unique(labels[order], return_index=True)
+    return order[first]
@@ -0,0 +1,250 @@
+import os
+import sqlite3
+import threading
+import time
+
+from typing import Dict, List
+
+import numpy as np
+import supervisely as sly
+
+# SQLite limits the number of variables in a single query, so lookups are done in chunks.
+QUERY_CHUNK_SIZE = 500
+
+# Condition on the key of the embeddings except the image id.
+KEY_CONDITION = "model = ? AND pretrained = ? AND variant = ?"
+
+# After eviction the store is shrunk to this fraction of the max size, so the eviction
+# doesn't run on every write.
+EVICTION_TARGET_RATIO = 0.9
+
+
+class EmbeddingStore:
+    """On-disk store of normalized image embeddings, shared between inference runs.
+    Embeddings are keyed by (model name, pretrained tag, variant, image id) and are valid only
+    while the image hash matches the stored one. The variant separates the embeddings of the
+    same model, which differ slightly (e.g. of the quantized model or of the resized images).
+    When the total size of the stored embeddings exceeds the max size, the least recently used
+    embeddings are evicted. The total size is counted once on opening and then kept up to date
+    on each write, so writes don't scan the table.
+
+    Args:
+        path (str): path to the SQLite database file.
+        max_size (int): max total size of the stored embeddings in bytes.
+    """
+
+    def __init__(self, path: str, max_size: int):
+        self.path = path
+        self.max_size = max_size
+
+        sly.fs.mkdir(os.path.dirname(path))
+
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+
+        # Embeddings of the stores without the variant can be of any variant, so they are dropped.
+        columns = [row[1] for row in self._connection.execute("PRAGMA table_info(embeddings)")]
+        if columns and "variant" not in columns:
+            sly.logger.warning("Embeddings store has the old format and will be cleared.")
+            self._connection.execute("DROP TABLE embeddings")
+
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS embeddings ("
+            "model TEXT NOT NULL, "
+            "pretrained TEXT NOT NULL, "
+            "variant TEXT NOT NULL, "
+            "image_id INTEGER NOT NULL, "
+            "image_hash TEXT NOT NULL, "
+            "embedding BLOB NOT NULL, "
+            "size INTEGER NOT NULL, "
+            "accessed_at REAL NOT NULL, "
+            "PRIMARY KEY (model, pretrained, variant, image_id))"
+        )
+        self._connection.execute(
+            "CREATE INDEX IF NOT EXISTS embeddings_accessed_at ON embeddings (accessed_at)"
+        )
+        self._connection.commit()
+        self._total_size = self._connection.execute(
+            "SELECT COALESCE(SUM(size), 0) FROM embeddings"
+        ).fetchone()[0]
+
+        sly.logger.info(
+            f"Embeddings store: {path}, size: {self.size() / 1024 ** 2:.1f} MB "
+            f"of {max_size / 1024 ** 2:.1f} MB."
+        )
+
+    def get(
+        self, model_name: str, pretrained: str, variant: str, image_infos: List[sly.ImageInfo]
+    ) -> Dict[int, np.ndarray]:
+        """Returns stored embeddings for the given images. Embeddings of images, which hash was
+        changed since the embedding was stored, are removed from the store and not returned.
+
+        Args:
+            model_name (str): name of the model.
+            pretrained (str): pretrained tag of the model.
+            variant (str): variant of the embeddings, e.g. backend and source of the images.
+            image_infos (List[sly.ImageInfo]): infos of the images to get embeddings for.
+
+        Returns:
+            Dict[int, np.ndarray]: image id to embedding mapping for the found images.
+        """
+        hashes = {image_info.id: image_fingerprint(image_info) for image_info in image_infos}
+        image_ids = list(hashes.keys())
+
+        embeddings = {}
+        outdated_ids = []
+        outdated_size = 0
+
+        with self._lock:
+            for chunk in sly.batched(image_ids, QUERY_CHUNK_SIZE):
+                placeholders = ",".join("?" * len(chunk))
+                rows = self._connection.execute(
+                    "SELECT image_id, image_hash, embedding, size FROM embeddings "
+                    f"WHERE {KEY_CONDITION} AND image_id IN ({placeholders})",
+                    (model_name, pretrained, variant, *chunk),
+                )
+                for image_id, image_hash, embedding, size in rows:
+                    if image_hash != hashes[image_id]:
+                        outdated_ids.append(image_id)
+                        outdated_size += size
+                        continue
+                    embeddings[image_id] = np.frombuffer(embedding, dtype=np.float32)
+
+            now = time.time()
+            for chunk in sly.batched(list(embeddings.keys()), QUERY_CHUNK_SIZE):
+                placeholders = ",".join("?" * len(chunk))
+                self._connection.execute(
+                    "UPDATE embeddings SET accessed_at = ? "
+                    f"WHERE {KEY_CONDITION} AND image_id IN ({placeholders})",
+                    (now, model_name, pretrained, variant, *chunk),
+                )
+
+            for chunk in sly.batched(outdated_ids, QUERY_CHUNK_SIZE):
+                placeholders = ",".join("?" * len(chunk))
+                self._connection.execute(
+                    "DELETE FROM embeddings "
+                    f"WHERE {KEY_CONDITION} AND image_id IN ({placeholders})",
+                    (model_name, pretrained, variant, *chunk),
+                )
+            self._total_size -= outdated_size
+
+            self._connection.commit()
+
+        if outdated_ids:
+            sly.logger.debug(
+                f"Removed {len(outdated_ids)} outdated embeddings of changed images from the store."
+            )
+
+        return embeddings
+
+    def put(
+        self,
+        model_name: str,
+        pretrained: str,
+        variant: str,
+        image_infos: List[sly.ImageInfo],
+        embeddings: np.ndarray,
+    ):
+        """Saves the embeddings of the given images to the store and evicts the least recently
+        used embeddings if the store exceeds the max size.
+
+        Args:
+            model_name (str): name of the model.
+            pretrained (str): pretrained tag of the model.
+            variant (str): variant of the embeddings, e.g. backend and source of the images.
+            image_infos (List[sly.ImageInfo]): infos of the images.
+            embeddings (np.ndarray): embeddings of the images (in the same order as image_infos).
+        """
+        assert len(image_infos) == len(embeddings)
+
+        now = time.time()
+        rows = []
+        for image_info, embedding in zip(image_infos, embeddings):
+            blob = np.ascontiguousarray(embedding, dtype=np.float32).tobytes()
+            rows.append(
+                (
+                    model_name,
+                    pretrained,
+                    variant,
+                    image_info.id,
+                    image_fingerprint(image_info),
+                    blob,
+                    len(blob),
+                    now,
+                )
+            )
+
+        with self._lock:
+            # Replaced embeddings are subtracted from the total size, the lookup is by the key.
+            replaced_size = 0
+            image_ids = [image_info.id for image_info in image_infos]
+            for chunk in sly.batched(image_ids, QUERY_CHUNK_SIZE):
+                placeholders = ",".join("?" * len(chunk))
+                replaced_size += self._connection.execute(
+                    "SELECT COALESCE(SUM(size), 0) FROM embeddings "
+                    f"WHERE {KEY_CONDITION} AND image_id IN ({placeholders})",
+                    (model_name, pretrained, variant, *chunk),
+                ).fetchone()[0]
+
+            self._connection.executemany(
+                "INSERT OR REPLACE INTO embeddings VALUES (?, ?, ?, ?, ?, ?, ?, ?)", rows
+            )
+            self._connection.commit()
+            self._total_size += sum(row[6] for row in rows) - replaced_size
+
+            if self._total_size > self.max_size:
+                self._evict()
+
+    def evict(self):
+        """Removes the least recently used embeddings until the store size is below the
+        target size."""
+        with self._lock:
+            self._evict()
+
+    def _evict(self):
+        """Removes the least recently used embeddings, the lock must be held by the caller.
+        Only the rows up to the target size are read from the table."""
+        target_size = int(self.max_size * EVICTION_TARGET_RATIO)
+        size = self._total_size
+
+        evicted_rowids = []
+        cursor = self._connection.execute(
+            "SELECT rowid, size FROM embeddings ORDER BY accessed_at ASC"
+        )
+        for rowid, row_size in cursor:
+            if size <= target_size:
+                break
+            evicted_rowids.append(rowid)
+            size -= row_size
+        cursor.close()
+
+        for chunk in sly.batched(evicted_rowids, QUERY_CHUNK_SIZE):
+            placeholders = ",".join("?" * len(chunk))
+            self._connection.execute(
+                f"DELETE FROM embeddings WHERE rowid IN ({placeholders})", chunk
+            )
+        self._connection.commit()
+        self._total_size = size
+
+        sly.logger.info(
+            f"Evicted {len(evicted_rowids)} embeddings from the store, "
+            f"current size: {size / 1024 ** 2:.1f} MB."
+        )
+
+    def size(self) -> int:
+        """Returns the total size of the stored embeddings in bytes."""
+        with self._lock:
+            return self._total_size
+
+
+def image_fingerprint(image_info: sly.ImageInfo) -> str:
+    """Returns the value which changes when the image content changes. Images without hash
+    (e.g. uploaded by links) fall back to the last update time.
+
+    Args:
+        image_info (sly.ImageInfo): info of the image.
+
+    Returns:
+        str: hash of the image or its last update time.
+    """
+    return image_info.hash or image_info.updated_at
@@ -0,0 +1,1259 @@
+import hashlib
+import time
+
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from functools import partial
+from typing import Callable, Dict, List, NamedTuple, Optional, Tuple
+from urllib.parse import urljoin
+
+import numpy as np
+import requests
+import torch
+import supervisely as sly
+from tqdm import tqdm
+
+import src.globals as g
+import src.clip_api as clip_api
+import src.pipeline as pipeline
+import src.ann_index as ann_index
+import src.selection as selection
+import src.uploader as uploader
+import src.dedup as dedup
+import src.metrics as metrics
+import src.model_server as model_server
+from src.batching import AdaptiveBatchSize, adaptive_batches, free_memory, is_out_of_memory
+from src.prompts import PromptQuery, apply_templates
+from src.results import RunResults, get_results_path
+from src.checkpoint import Checkpoint, get_checkpoint_dir
+from src.decoding import DecodePool
+from src.jobs import Cancelled, wait_results
+from src.models import get_model_data
+
+
+class InferenceParams(NamedTuple):
+    """Parameters of the inference run, which don't depend on the UI."""
+
+    model_name: str
+    pretrained: str
+    batch_size: int = g.MODEL_BATCH_SIZE
+    auto_batch_size: bool = False
+    prefetch: int = g.PREFETCH_BATCHES
+    decode_workers: int = g.DECODE_WORKERS
+    decode_mode: str = "threads"
+    image_source: str = "original"
+    execution_mode: str = "eager"
+    backend: str = "pytorch"
+    device: str = g.DEVICE
+    search_mode: str = "all"
+    top_k: int = g.TOP_K
+    exact_search: bool = False
+    threshold: float = 0.25
+    threshold_method: str = g.FILTER_METHODS[0]
+    incremental: bool = False
+    duplicate_threshold: float = g.DUPLICATE_THRESHOLD
+
+
+class InferenceResult(NamedTuple):
+    """Selected images and their scores with the statistics of the inference run."""
+
+    image_infos: List[sly.ImageInfo]
+    scores: np.ndarray
+    i_sort: np.ndarray
+    encoded_count: int = 0
+    images_per_second: float = 0.0
+    reused_count: int = 0
+    duplicates_count: int = 0
+    cancelled: bool = False
+    metrics: Optional[Dict] = None
+
+
+class SaveParams(NamedTuple):
+    """Parameters of saving the results to the destination dataset. If sort_method or
+    filter_method is None, the images aren't sorted or filtered respectively."""
+
+    sort_method: Optional[str] = None
+    filter_method: Optional[str] = None
+    threshold: float = 0.25
+
+
+class Split(NamedTuple):
+    """Images with their scores to save to one destination dataset."""
+
+    text_prompt: str
+    dataset_id: int
+    image_infos: List[sly.ImageInfo]
+    scores: np.ndarray
+
+
+def console_progress(message: str, total: int, **kwargs) -> tqdm:
+    """Progress bar in the console with the same interface as the Progress widget."""
+    return tqdm(desc=message, total=total, **kwargs)
+
+
+def get_variant(params: InferenceParams) -> str:
+    """Returns the variant of the embeddings of the model: the backend (with quantization) and
+    the source of the images. Embeddings of different variants differ slightly, so they are
+    stored, checkpointed, indexed and scored separately and a run doesn't silently get the
+    embeddings of lower fidelity."""
+    return f"{params.backend}_{params.image_source}"
+
+
+def get_device(backend: str) -> str:
+    """Returns the device for the model inputs. Models of the shared model server run on its
+    device, so the inputs stay on CPU."""
+    return "cpu" if backend == "remote" else g.DEVICE
+
+
+def load_model(params: InferenceParams, progress: Callable = console_progress):
+    """Builds the model for the inference parameters or takes it from the cache. With the
+    remote backend the model is loaded on the shared model server.
+
+    Returns:
+        the model, its preprocessing transforms and tokenizer.
+    """
+    if params.backend == "remote":
+        return model_server.connect(
+            g.MODEL_SERVER_URL,
+            params.model_name,
+            params.pretrained,
+            params.execution_mode,
+        )
+
+    model, preprocess, tokenizer = clip_api.build_model(
+        params.model_name,
+        params.pretrained,
+        params.device,
+        get_model_data(params.model_name, params.pretrained),
+        params.execution_mode,
+        params.backend,
+        progress,
+    )
+    sly.logger.info(f"Model was built. Name: {params.model_name}, pretrained: {params.pretrained}.")
+    return model, preprocess, tokenizer
+
+
+def run_inference(
+    api: sly.Api,
+    dataset_ids: List[int],
+    query: PromptQuery,
+    params: InferenceParams,
+    progress: Callable = console_progress,
+    is_cancelled: Callable[[], bool] = lambda: False,
+    status_cb: Optional[Callable[[str], None]] = None,
+) -> InferenceResult:
+    """Loads images from the datasets, scores them by the prompts and selects the images
+    according to the search mode. Images from all the datasets are ranked together. All the
+    prompts are scored against the same image embeddings, so they cost a single pass.
+
+    Args:
+        api (sly.Api): API to access the images.
+        dataset_ids (List[int]): IDs of the datasets.
+        query (PromptQuery): prompts for scoring.
+        params (InferenceParams): parameters of the inference.
+        progress (Callable, optional): function, which takes the message and the total and
+            returns a progress bar context manager. Defaults to console_progress.
+        is_cancelled (Callable[[], bool], optional): function, which returns True if the
+            inference should be stopped. Defaults to lambda: False.
+        status_cb (Optional[Callable[[str], None]], optional): function, which takes the short
+            status of the run. Defaults to None.
+
+    Returns:
+        InferenceResult: selected images, their scores and the statistics of the run.
+    """
+    status_cb = status_cb or (lambda status: None)
+    model_name, pretrained = params.model_name, params.pretrained
+    text_prompt = query.label()
+    texts, weights = query.expand()
+
+    sly.logger.info(
+        f"Starting inference with model: {model_name}, batch size: {params.batch_size}, "
+        f"execution mode: {params.execution_mode}, backend: {params.backend}, "
+        f"device: {params.device}. Text prompt: {text_prompt}"
+    )
+
+    # Building model, preprocessing input data and running inference.
+    model, preprocess, tokenizer = load_model(params, progress)
+
+    # Getting images from all selected datasets, they are ranked together.
+    image_infos = []
+    for dataset_id in dataset_ids:
+        image_infos.extend(api.image.get_list(dataset_id))
+    datasets_key = get_datasets_key(dataset_ids)
+
+    sly.logger.info(
+        f"Loaded {len(image_infos)} images from {len(dataset_ids)} datasets with ids {dataset_ids}."
+    )
+
+    # Scores are weighted sums of similarities to the prompts and the example images,
+    # so the query is a single vector. The query can be empty only in duplicates mode.
+    query_parts = []
+    if texts:
+        text_features = clip_api.get_text_features(
+            model_name,
+            pretrained,
+            model,
+            tokenizer,
+            texts,
+            params.device,
+            params.execution_mode,
+            params.backend,
+        )
+        text_features = text_features.cpu().numpy()
+        query_parts.append(text_features.T @ np.array(weights, dtype=np.float32))
+        sly.logger.info(f"Input prompts were encoded: {dict(zip(texts, weights))}.")
+    if query.examples:
+        example_features = get_example_features(
+            api, query.examples, image_infos, model, preprocess, params, progress
+        )
+        example_weights = np.array(query.example_weights(), dtype=np.float32)
+        query_parts.append(example_features.T @ example_weights)
+        sly.logger.info(f"Example images were encoded: {query.examples}.")
+    query_vector = sum(query_parts) if query_parts else None
+    variant = get_variant(params)
+    index_path = ann_index.get_index_path(
+        g.INDEX_DIR, datasets_key, model_name, pretrained, variant
+    )
+
+    use_index = params.search_mode in ("top_k", "duplicates") and not params.exact_search
+    index = None
+    if use_index:
+        index = ann_index.load_index(index_path, image_infos)
+
+    # Images are selected on the fly as the batches are scored.
+    if params.search_mode == "top_k":
+        selector = selection.TopKSelector(params.top_k)
+    elif params.search_mode == "threshold":
+        selector = selection.ThresholdSelector(params.threshold, params.threshold_method)
+    elif params.search_mode == "all":
+        selector = selection.ScoreCollector()
+    else:
+        selector = None
+
+    # Scores of all the images are kept as the baseline for the next incremental run in every
+    # mode, which scores all the images. The collector of the "all" mode keeps them already.
+    baseline = None
+    if selector is not None and index is None:
+        baseline = selector if params.search_mode == "all" else selection.ScoreCollector()
+
+    def update_scores(ids: np.ndarray, scores: np.ndarray):
+        selector.update(ids, scores)
+        if baseline is not selector:
+            baseline.update(ids, scores)
+
+    # Embeddings are kept in memory only to build the index or to find the duplicates.
+    build_index = use_index and index is None
+    collect_features = build_index or params.search_mode == "duplicates"
+    indexed_infos, indexed_features = [], []
+
+    def score_batch(batched_image_infos: List[sly.ImageInfo], batched_features: np.ndarray):
+        if selector is not None:
+            batched_scores = batched_features @ query_vector
+            batched_ids = np.array([image_info.id for image_info in batched_image_infos])
+            update_scores(batched_ids, batched_scores)
+
+        if collect_features:
+            indexed_infos.extend(batched_image_infos)
+            indexed_features.append(batched_features)
+
+    # Scores of unchanged images are taken from the last run, only the delta is inferred.
+    results_path = get_results_path(
+        g.RESULTS_DIR, datasets_key, model_name, pretrained, variant, query.key()
+    )
+    changed_image_infos = image_infos
+    reused_count = 0
+    if params.incremental and selector is not None and index is None and not collect_features:
+        results = RunResults.load(results_path)
+        if results is not None:
+            reused_ids, reused_scores, changed_image_infos = results.split(image_infos)
+            update_scores(reused_ids, reused_scores)
+            reused_count = len(reused_ids)
+            sly.logger.info(
+                f"Reused scores of {reused_count} unchanged images from the last run, "
+                f"{len(changed_image_infos)} new or changed images will be inferred."
+            )
+
+    encoded_count, images_per_second = 0, 0.0
+    metrics_summary = None
+    if index is not None:
+        # All the images are in the index, so no inference is needed.
+        status_cb("Searching...")
+        if params.search_mode == "top_k":
+            selected_ids, scores = index.search(query_vector, params.top_k, g.INDEX_N_PROBE)
+            sly.logger.info(f"Found top {len(selected_ids)} images in the index.")
+    else:
+        run_metrics = metrics.registry.start()
+        try:
+            encoded_count, images_per_second = encode_dataset(
+                api,
+                changed_image_infos,
+                score_batch,
+                model,
+                preprocess,
+                params,
+                datasets_key,
+                progress,
+                is_cancelled,
+                status_cb,
+                run_metrics,
+            )
+        finally:
+            metrics.registry.finish(run_metrics)
+        metrics_summary = run_metrics.summary()
+        sly.logger.info(
+            f"Inference metrics: {metrics.format_summary(metrics_summary)}",
+            extra={"metrics": metrics_summary},
+        )
+
+    if is_cancelled():
+        sly.logger.info(f"Inference was canceled. Text prompt: {text_prompt}.")
+        return InferenceResult([], np.empty(0, dtype=np.float32), np.empty(0), cancelled=True)
+
+    status_cb("Finishing...")
+
+    if selector is not None and index is None:
+        selected_ids, scores = selector.result()
+
+    if baseline is not None:
+        # Saving scores of all images as a baseline for the next incremental run.
+        baseline_ids, baseline_scores = baseline.result()
+        RunResults.from_image_infos(image_infos, baseline_ids, baseline_scores).save(results_path)
+
+    if build_index and indexed_infos:
+        # Building the index for the next prompts and checking its quality.
+        index = ann_index.IVFIndex.build(np.concatenate(indexed_features), indexed_infos)
+        index.save(index_path)
+        indexed_infos, indexed_features = [], []
+
+        if params.search_mode == "top_k":
+            approximate_ids, _ = index.search(query_vector, params.top_k, g.INDEX_N_PROBE)
+            sly.logger.info(
+                f"Recall of the index search: "
+                f"{ann_index.recall(approximate_ids, selected_ids):.2%}."
+            )
+
+    duplicates_count = 0
+    if params.search_mode == "duplicates":
+        status_cb("Searching...")
+        if index is not None:
+            vectors, ids = index.vectors, index.ids
+        else:
+            vectors = np.concatenate(indexed_features)
+            ids = np.array([image_info.id for image_info in indexed_infos], dtype=np.int64)
+            indexed_infos, indexed_features = [], []
+        selected_ids, scores = remove_duplicates(
+            vectors, ids, image_infos, query_vector, params.duplicate_threshold, index
+        )
+        duplicates_count = len(ids) - len(selected_ids)
+
+    image_infos_by_id = {image_info.id: image_info for image_info in image_infos}
+    image_infos = [image_infos_by_id[image_id] for image_id in selected_ids.tolist()]
+    sly.logger.info(f"Selected {len(image_infos)} images in {params.search_mode} mode.")
+
+    i_sort = np.argsort(scores)[::-1]
+
+    sly.logger.info(f"Inference finished successfully. Text prompt: {text_prompt}.")
+
+    return InferenceResult(
+        image_infos,
+        scores,
+        i_sort,
+        encoded_count,
+        images_per_second,
+        reused_count,
+        duplicates_count,
+        metrics=metrics_summary,
+    )
+
+
+def remove_duplicates(
+    vectors: np.ndarray,
+    ids: np.ndarray,
+    image_infos: List[sly.ImageInfo],
+    query_vector: Optional[np.ndarray],
+    threshold: float,
+    index: Optional[ann_index.IVFIndex] = None,
+) -> Tuple[np.ndarray, np.ndarray]:
+    """Groups the near-duplicate images and keeps one representative of each group: the image
+    with the highest score if the query is given, otherwise the image with the largest area.
+
+    Args:
+        vectors (np.ndarray): embeddings of the images with shape (n, dim).
+        ids (np.ndarray): IDs of the images with shape (n,).
+        image_infos (List[sly.ImageInfo]): infos of the images.
+        query_vector (Optional[np.ndarray]): query to score the images or None.
+        threshold (float): minimal cosine similarity of the near-duplicates.
+        index (Optional[ann_index.IVFIndex], optional): index over the same vectors to search
+            the duplicates approximately. If None, all the pairs are compared. Defaults to None.
+
+    Returns:
+        Tuple[np.ndarray, np.ndarray]: IDs and scores of the representatives. Scores are zeros
+            if the query isn't given.
+    """
+    labels = dedup.group_duplicates(vectors, threshold, index, g.DEDUP_N_PROBE)
+
+    if query_vector is not None:
+        scores = (vectors @ query_vector).astype(np.float32)
+        priorities = scores
+    else:
+        scores = np.zeros(len(ids), dtype=np.float32)
+        image_infos_by_id = {image_info.id: image_info for image_info in image_infos}
+        priorities = np.array(
+            [
+                image_infos_by_id[image_id].width * image_infos_by_id[image_id].height
+                for image_id in ids.tolist()
+            ],
+            dtype=np.float64,
+        )
+
+    representatives = dedup.select_representatives(labels, priorities)
+    return ids[representatives], scores[representatives]
+
+
+def get_example_features(
+    api: sly.Api,
+    example_ids: List[int],
+    image_infos: List[sly.ImageInfo],
+    model,
+    preprocess,
+    params: InferenceParams,
+    progress: Callable = console_progress,
+) -> np.ndarray:
+    """Returns the embeddings of the example images in the order of their IDs. Embeddings are
+    taken from the store if the images were already encoded with the model, so the search by
+    examples from the scored dataset doesn't need the inference at all.
+
+    Args:
+        api (sly.Api): API to access the images.
+        example_ids (List[int]): IDs of the example images.
+        image_infos (List[sly.ImageInfo]): infos of the images in the datasets, the examples
+            from other datasets are requested by their IDs.
+        model: the model to encode the missing images with.
+        preprocess: preprocessing transforms of the model.
+        params (InferenceParams): parameters of the inference.
+        progress (Callable, optional): function, which takes the message and the total and
+            returns a progress bar context manager. Defaults to console_progress.
+
+    Raises:
+        ValueError: if some of the example images don't exist.
+
+    Returns:
+        np.ndarray: embeddings of the example images with shape (len(example_ids), dim).
+    """
+    image_infos_by_id = {image_info.id: image_info for image_info in image_infos}
+    example_infos = []
+    for image_id in example_ids:
+        image_info = image_infos_by_id.get(image_id) or api.image.get_info_by_id(image_id)
+        if image_info is None:
+            raise ValueError(f"Example image with id {image_id} doesn't exist.")
+        example_infos.append(image_info)
+
+    features = {}
+
+    def collect_batch(batched_image_infos: List[sly.ImageInfo], batched_features: np.ndarray):
+        for image_info, image_features in zip(batched_image_infos, batched_features):
+            features[image_info.id] = image_features
+
+    # The examples are encoded without the checkpoint, so the checkpoint of the interrupted
+    # run over their datasets isn't touched.
+    encode_dataset(api, example_infos, collect_batch, model, preprocess, params, None, progress)
+
+    return np.stack([features[image_id] for image_id in example_ids])
+
+
+def classify_images(
+    api: sly.Api,
+    image_infos: List[sly.ImageInfo],
+    class_prompts: List[str],
+    params: InferenceParams,
+    templates: List[str] = [],
+    progress: Callable = console_progress,
+    is_cancelled: Callable[[], bool] = lambda: False,
+) -> np.ndarray:
+    """Calculates the probabilities of the classes for the images with softmax over the
+    similarities to the class prompts. Embeddings of the images are taken from the store, so
+    the images scored by the previous run aren't encoded again. The prompts of each class are
+    expanded with the templates and their embeddings are averaged.
+
+    Args:
+        api (sly.Api): API to access the images.
+        image_infos (List[sly.ImageInfo]): infos of the images.
+        class_prompts (List[str]): prompts of the classes.
+        params (InferenceParams): parameters of the inference.
+        templates (List[str], optional): templates for the prompts. Defaults to [].
+        progress (Callable, optional): function, which takes the message and the total and
+            returns a progress bar context manager. Defaults to console_progress.
+        is_cancelled (Callable[[], bool], optional): function, which returns True if the
+            inference should be stopped. Defaults to lambda: False.
+
+    Returns:
+        np.ndarray: probabilities of the classes with shape (len(image_infos), len(class_prompts)).
+    """
+    model, preprocess, tokenizer = load_model(params, progress)
+
+    texts = [text for prompt in class_prompts for text in apply_templates(prompt, templates)]
+    text_features = clip_api.get_text_features(
+        params.model_name,
+        params.pretrained,
+        model,
+        tokenizer,
+        texts,
+        params.device,
+        params.execution_mode,
+        params.backend,
+    )
+    class_features = (
+        text_features.cpu().numpy().reshape(len(class_prompts), -1, text_features.shape[-1])
+    )
+    class_features = class_features.mean(axis=1)
+    class_features /= np.linalg.norm(class_features, axis=-1, keepdims=True)
+
+    positions = {image_info.id: position for position, image_info in enumerate(image_infos)}
+    probabilities = np.zeros((len(image_infos), len(class_prompts)), dtype=np.float32)
+
+    def classify_batch(batched_image_infos: List[sly.ImageInfo], batched_features: np.ndarray):
+        logits = g.CLASS_LOGIT_SCALE * clip_api.calculate_logits(batched_features, class_features)
+        logits -= logits.max(axis=-1, keepdims=True)
+        batched_probabilities = np.exp(logits)
+        batched_probabilities /= batched_probabilities.sum(axis=-1, keepdims=True)
+        batched_positions = [positions[image_info.id] for image_info in batched_image_infos]
+        probabilities[batched_positions] = batched_probabilities
+
+    # The images are usually in the store after the inference, so the classification pass runs
+    # without the checkpoint and doesn't touch the checkpoint of the runs over the datasets.
+    encode_dataset(
+        api, image_infos, classify_batch, model, preprocess, params, None, progress, is_cancelled
+    )
+
+    return probabilities
+
+
+def assign_classes(probabilities: np.ndarray, method: str, threshold: float) -> List[np.ndarray]:
+    """Assigns the images to the classes by their probabilities.
+
+    Args:
+        probabilities (np.ndarray): probabilities with shape (n_images, n_classes).
+        method (str): "best" to assign each image to the most probable class or "threshold" to
+            assign it to all classes with the probability not less than the threshold.
+        threshold (float): threshold for the probabilities in "threshold" method.
+
+    Returns:
+        List[np.ndarray]: indexes of the images of each class in descending order of probability.
+    """
+    if method == "best":
+        mask = np.zeros(probabilities.shape, dtype=bool)
+        mask[np.arange(len(probabilities)), probabilities.argmax(axis=-1)] = True
+    elif method == "threshold":
+        mask = probabilities >= threshold
+    else:
+        raise ValueError(f"Unknown split method: {method}")
+
+    classes = []
+    for class_index in range(probabilities.shape[1]):
+        indexes = np.flatnonzero(mask[:, class_index])
+        order = np.argsort(-probabilities[indexes, class_index], kind="stable")
+        classes.append(indexes[order])
+    return classes
+
+
+def build_splits(
+    image_infos: List[sly.ImageInfo],
+    probabilities: np.ndarray,
+    class_prompts: List[str],
+    dataset_ids: List[int],
+    method: str,
+    threshold: float,
+) -> List[Split]:
+    """Assigns the images to the classes and returns the split for each destination dataset.
+
+    Args:
+        image_infos (List[sly.ImageInfo]): infos of the images.
+        probabilities (np.ndarray): probabilities of the classes from classify_images.
+        class_prompts (List[str]): prompts of the classes.
+        dataset_ids (List[int]): IDs of the destination datasets, one for each class.
+        method (str): split method, one of g.SPLIT_METHODS.
+        threshold (float): threshold for the probabilities in "threshold" method.
+
+    Returns:
+        List[Split]: images of each class with their probabilities as scores.
+    """
+    splits = []
+    for class_index, indexes in enumerate(assign_classes(probabilities, method, threshold)):
+        splits.append(
+            Split(
+                class_prompts[class_index],
+                dataset_ids[class_index],
+                [image_infos[index] for index in indexes.tolist()],
+                probabilities[indexes, class_index],
+            )
+        )
+        sly.logger.info(f"{len(indexes)} images were assigned to '{class_prompts[class_index]}'.")
+    return splits
+
+
+def encode_dataset(
+    api: sly.Api,
+    image_infos: List[sly.ImageInfo],
+    on_batch: Callable[[List[sly.ImageInfo], np.ndarray], None],
+    model,
+    preprocess,
+    params: InferenceParams,
+    datasets_key: Optional[str],
+    progress: Callable = console_progress,
+    is_cancelled: Callable[[], bool] = lambda: False,
+    status_cb: Optional[Callable[[str], None]] = None,
+    run_metrics: Optional[metrics.RunMetrics] = None,
+) -> Tuple[int, float]:
+    """Passes the embeddings of the images to on_batch batch by batch, so they aren't kept in
+    memory all at once. Embeddings are read from the store first, missing images are downloaded,
+    encoded with the model and saved to the store. Encoded embeddings are also checkpointed to
+    the app data directory periodically, so the interrupted run is resumed from the checkpoint.
+    If datasets_key is None, the checkpoint isn't used (e.g. for a few example images, which
+    aren't worth resuming). If the inference is cancelled, the function saves the checkpoint and
+    returns after the current batch. If run_metrics is given, the time of each stage of the loop
+    is added to it.
+
+    Returns:
+        Tuple[int, float]: number of encoded images and encoding speed in images per second.
+    """
+    model_name, pretrained = params.model_name, params.pretrained
+    variant = get_variant(params)
+    missing_image_infos = []
+
+    with progress(message="Inference is running...", total=len(image_infos)) as pbar:
+        # Reading embeddings of the images, which were already encoded with the selected model.
+        for batched_image_infos in sly.batched(image_infos, g.STORE_READ_BATCH_SIZE):
+            stored_features = g.EMBEDDINGS_STORE.get(
+                model_name, pretrained, variant, batched_image_infos
+            )
+            stored_infos = []
+            for image_info in batched_image_infos:
+                if image_info.id in stored_features:
+                    stored_infos.append(image_info)
+                else:
+                    missing_image_infos.append(image_info)
+
+            if stored_infos:
+                on_batch(
+                    stored_infos,
+                    np.stack([stored_features[image_info.id] for image_info in stored_infos]),
+                )
+            pbar.update(len(stored_infos))
+
+        # Skipping the images, which were encoded by the interrupted run.
+        checkpoint = None
+        checkpoint_features = {}
+        if datasets_key is not None:
+            checkpoint = Checkpoint(
+                get_checkpoint_dir(g.CHECKPOINTS_DIR, datasets_key, model_name, pretrained, variant)
+            )
+            checkpoint_features = checkpoint.load(missing_image_infos)
+        if checkpoint_features:
+            checkpoint_infos = [
+                image_info
+                for image_info in missing_image_infos
+                if image_info.id in checkpoint_features
+            ]
+            missing_image_infos = [
+                image_info
+                for image_info in missing_image_infos
+                if image_info.id not in checkpoint_features
+            ]
+            for batched_image_infos in sly.batched(checkpoint_infos, g.STORE_READ_BATCH_SIZE):
+                on_batch(
+                    batched_image_infos,
+                    np.stack(
+                        [checkpoint_features[image_info.id] for image_info in batched_image_infos]
+                    ),
+                )
+                pbar.update(len(batched_image_infos))
+            del checkpoint_features
+
+        sly.logger.info(
+            f"Found {len(image_infos) - len(missing_image_infos)} image embeddings in the store "
+            f"and the checkpoint, {len(missing_image_infos)} images will be encoded."
+        )
+
+        sly.logger.info(f"Starting inference loop with batch size: {params.batch_size}.")
+        if status_cb is not None:
+            status_cb("Running...")
+
+        # Batches are downloaded and decoded in background threads while the model is busy.
+        # The batch size is read for each new batch, so it can be adjusted during the run.
+        batch_size = AdaptiveBatchSize(
+            params.batch_size, g.MAX_BATCH_SIZE, params.device, params.auto_batch_size
+        )
+        batches = adaptive_batches(missing_image_infos, batch_size, is_cancelled)
+        decode_pool = DecodePool(
+            preprocess,
+            params.decode_workers,
+            mode=params.decode_mode,
+            pin_memory=params.device == "cuda",
+            reduced=params.image_source == "reduced",
+        )
+
+        # Stages check the cancellation between the sub-batches and raise Cancelled.
+        if params.image_source == "preview":
+            download_stage = partial(
+                download_preview_batch,
+                api,
+                decode_pool.image_shape[-1],
+                is_cancelled=is_cancelled,
+            )
+        else:
+            download_stage = partial(download_batch, api, is_cancelled=is_cancelled)
+        stages = [
+            metrics.timed(run_metrics, "download", download_stage),
+            partial(
+                decode_batch,
+                decode_pool,
+                params.device,
+                run_metrics=run_metrics,
+                is_cancelled=is_cancelled,
+            ),
+        ]
+
+        def sample_queues(depths: List[int]):
+            if run_metrics is not None:
+                run_metrics.sample_queues(dict(zip(("downloaded", "decoded"), depths)))
+
+        start_time = time.perf_counter()
+        encoded_count = 0
+        try:
+            for batched_image_infos, input_images in pipeline.run_pipeline(
+                batches, stages, params.prefetch, sample_queues
+            ):
+                if is_cancelled():
+                    break
+
+                # Copying the features to CPU waits for the model, so it's a part of forward time.
+                forward_start = time.perf_counter()
+                batched_features = encode_batch(model, input_images, params, batch_size)
+                postprocess_start = time.perf_counter()
+                batch_size.update(len(batched_image_infos), postprocess_start - forward_start)
+
+                # Saving embeddings to the store, so the next prompt won't re-encode the images.
+                g.EMBEDDINGS_STORE.put(
+                    model_name, pretrained, variant, batched_image_infos, batched_features
+                )
+                on_batch(batched_image_infos, batched_features)
+                encoded_count += len(batched_image_infos)
+
+                if checkpoint is not None:
+                    checkpoint.add(batched_image_infos, batched_features)
+                    if time.monotonic() - checkpoint.saved_at > g.CHECKPOINT_INTERVAL:
+                        checkpoint.save()
+
+                if run_metrics is not None:
+                    run_metrics.add("forward", postprocess_start - forward_start)
+                    run_metrics.add("postprocess", time.perf_counter() - postprocess_start)
+                    run_metrics.add_images(len(batched_image_infos), batch_size.batch_size)
+
+                pbar.update(len(batched_image_infos))
+        except Cancelled:
+            sly.logger.info("Inference was cancelled in the download or decode stage.")
+        finally:
+            decode_pool.close()
+
+            if checkpoint is not None:
+                if not is_cancelled() and encoded_count == len(missing_image_infos):
+                    # All the images are in the store now, their checkpointed embeddings aren't
+                    # needed.
+                    checkpoint.remove([image_info.id for image_info in image_infos])
+                else:
+                    checkpoint.save()
+
+    elapsed = time.perf_counter() - start_time
+    images_per_second = encoded_count / elapsed if encoded_count else 0.0
+    sly.logger.info(
+        f"Encoded {encoded_count} images in {elapsed:.1f} s ({images_per_second:.1f} images/sec), "
+        f"execution mode: {params.execution_mode}, batch size: {batch_size.batch_size}."
+    )
+
+    return encoded_count, images_per_second
+
+
+def encode_batch(
+    model, input_images: torch.Tensor, params: InferenceParams, batch_size: AdaptiveBatchSize
+) -> np.ndarray:
+    """Encodes the batch of images with the model. If the model runs out of memory, the batch
+    is split in halves, which are encoded separately, and the next batches are made smaller.
+
+    Returns:
+        np.ndarray: normalized embeddings of the images on CPU.
+    """
+    try:
+        return clip_api.encode_images(model, input_images, params.execution_mode).cpu().numpy()
+    except (RuntimeError, MemoryError) as e:
+        if not is_out_of_memory(e) or len(input_images) == 1:
+            raise
+        batch_size.on_out_of_memory(len(input_images))
+        free_memory(params.device)
+
+    half = (len(input_images) + 1) // 2
+    return np.concatenate(
+        [
+            encode_batch(model, input_images[:half], params, batch_size),
+            encode_batch(model, input_images[half:], params, batch_size),
+        ]
+    )
+
+
+def download_batch(
+    api: sly.Api,
+    image_infos: List[sly.ImageInfo],
+    is_cancelled: Callable[[], bool] = lambda: False,
+) -> Tuple[List[sly.ImageInfo], List[bytes]]:
+    """Downloads the batch of images, which can be from different datasets, by sub-batches.
+    Runs in the download stage of the pipeline.
+
+    Args:
+        api (sly.Api): API to download the images.
+        image_infos (List[sly.ImageInfo]): infos of the images in the batch.
+        is_cancelled (Callable[[], bool], optional): function, which returns True if the
+            inference was cancelled. Checked before each sub-batch. Defaults to lambda: False.
+
+    Raises:
+        Cancelled: if the inference was cancelled.
+
+    Returns:
+        Tuple[List[sly.ImageInfo], List[bytes]]: infos of the images and their bytes.
+    """
+    # Images can be downloaded in batch only from a single dataset.
+    indexes_by_dataset = defaultdict(list)
+    for index, image_info in enumerate(image_infos):
+        indexes_by_dataset[image_info.dataset_id].append(index)
+
+    image_bytes = [None] * len(image_infos)
+    for dataset_id, indexes in indexes_by_dataset.items():
+        for batched_indexes in sly.batched(indexes, g.DOWNLOAD_SUB_BATCH_SIZE):
+            if is_cancelled():
+                raise Cancelled()
+            image_ids = [image_infos[index].id for index in batched_indexes]
+            for index, data in zip(
+                batched_indexes, api.image.download_bytes(dataset_id, image_ids)
+            ):
+                image_bytes[index] = data
+
+    sly.logger.debug(f"Downloaded {len(image_bytes)} images as bytes.")
+
+    return image_infos, image_bytes
+
+
+def download_preview_batch(
+    api: sly.Api,
+    image_size: int,
+    image_infos: List[sly.ImageInfo],
+    is_cancelled: Callable[[], bool] = lambda: False,
+) -> Tuple[List[sly.ImageInfo], List[bytes]]:
+    """Downloads the previews of the images, resized on the server side, so their shortest side
+    is equal to the model input size. Runs in the download stage of the pipeline.
+
+    Args:
+        api (sly.Api): API to download the previews.
+        image_size (int): input size of the model.
+        image_infos (List[sly.ImageInfo]): infos of the images in the batch.
+        is_cancelled (Callable[[], bool], optional): function, which returns True if the
+            inference was cancelled. Checked while waiting for the requests, the previews,
+            which weren't requested yet, are skipped. Defaults to lambda: False.
+
+    Raises:
+        Cancelled: if the inference was cancelled.
+
+    Returns:
+        Tuple[List[sly.ImageInfo], List[bytes]]: infos of the images and bytes of their previews.
+    """
+    urls = []
+    for image_info in image_infos:
+        if image_info.width < image_info.height:
+            width, height = image_size, None
+        else:
+            width, height = None, image_size
+
+        url = urljoin(api.server_address, image_info.full_storage_url)
+        urls.append(api.image.preview_url(url, width=width, height=height, quality=95))
+
+    with ThreadPoolExecutor(max_workers=g.PREVIEW_DOWNLOAD_WORKERS) as executor:
+        futures = [executor.submit(download_preview, api, url) for url in urls]
+        image_bytes = list(wait_results(futures, is_cancelled))
+
+    sly.logger.debug(f"Downloaded {len(image_bytes)} image previews as bytes.")
+
+    return image_infos, image_bytes
+
+
+def download_preview(api: sly.Api, url: str) -> bytes:
+    """Downloads the preview by the URL, the failed or stalled requests are retried."""
+
+    def get() -> bytes:
+        response = requests.get(url, headers=api.headers, timeout=g.PREVIEW_DOWNLOAD_TIMEOUT)
+        response.raise_for_status()
+        return response.content
+
+    return uploader.with_retries(get, retries=g.PREVIEW_DOWNLOAD_RETRIES)
+
+
+def decode_batch(
+    decode_pool: DecodePool,
+    device: str,
+    batch: Tuple[List[sly.ImageInfo], List[bytes]],
+    run_metrics: Optional[metrics.RunMetrics] = None,
+    is_cancelled: Callable[[], bool] = lambda: False,
+) -> Tuple[List[sly.ImageInfo], torch.Tensor]:
+    """Decodes and preprocesses the batch of downloaded images in the pool of workers.
+    Runs in the decode stage of the pipeline.
+
+    Args:
+        decode_pool (DecodePool): pool of workers for decoding the images.
+        device (str): device to put the batch on.
+        batch (Tuple[List[sly.ImageInfo], List[bytes]]): infos of the images and their bytes.
+        run_metrics (Optional[metrics.RunMetrics], optional): metrics to add the time of
+            decoding, preprocessing and copying to the device to. Defaults to None.
+        is_cancelled (Callable[[], bool], optional): function, which returns True if the
+            inference was cancelled. Defaults to lambda: False.
+
+    Raises:
+        Cancelled: if the inference was cancelled.
+
+    Returns:
+        Tuple[List[sly.ImageInfo], torch.Tensor]: infos of the images and the model input batch.
+    """
+    image_infos, image_bytes = batch
+
+    input_images = decode_pool.decode(image_bytes, run_metrics, is_cancelled)
+    sly.logger.debug(f"Decoded and preprocessed {len(input_images)} images.")
+
+    # The copy is asynchronous from pinned memory, so only its launch is measured on GPU.
+    copy_start = time.perf_counter()
+    input_images = input_images.to(device, non_blocking=True)
+    if run_metrics is not None:
+        run_metrics.add("h2d", time.perf_counter() - copy_start)
+
+    return image_infos, input_images
+
+
+def get_datasets_key(dataset_ids: List[int]) -> str:
+    """Returns the key of the datasets for the paths of the indexes, checkpoints and results.
+    Keys of several datasets are hashed to keep the paths short.
+
+    Args:
+        dataset_ids (List[int]): IDs of the datasets.
+
+    Returns:
+        str: key of the datasets.
+    """
+    if len(dataset_ids) == 1:
+        return str(dataset_ids[0])
+    joined_ids = ",".join(str(dataset_id) for dataset_id in sorted(dataset_ids))
+    return f"datasets_{hashlib.md5(joined_ids.encode('utf-8')).hexdigest()}"
+
+
+def select_images(
+    image_infos: List[sly.ImageInfo],
+    scores: np.ndarray,
+    i_sort: np.ndarray,
+    save_params: SaveParams,
+) -> Tuple[List[sly.ImageInfo], np.ndarray]:
+    """Sorts and filters the images by their scores.
+
+    Args:
+        image_infos (List[sly.ImageInfo]): infos of the images.
+        scores (np.ndarray): scores of the images (in the same order).
+        i_sort (np.ndarray): indexes of the images in descending order of scores.
+        save_params (SaveParams): sort and filter settings.
+
+    Returns:
+        Tuple[List[sly.ImageInfo], np.ndarray]: infos of the selected images and their scores.
+    """
+    scores = np.asarray(scores)
+
+    # Indexes of the images to save, sorting and filtering is done on them with NumPy.
+    indexes = np.arange(len(image_infos))
+
+    if save_params.sort_method == "desc":
+        indexes = np.asarray(i_sort)
+    elif save_params.sort_method == "asc":
+        indexes = np.asarray(i_sort)[::-1]
+
+    if save_params.filter_method is not None:
+        sly.logger.debug(
+            f"Filtering {len(indexes)} images with method {save_params.filter_method} "
+            f"and threshold {save_params.threshold}."
+        )
+        mask = selection.filter_mask(
+            scores[indexes], save_params.threshold, save_params.filter_method
+        )
+        indexes = indexes[mask]
+        sly.logger.debug(f"Finished filtering. {len(indexes)} images left.")
+
+    return [image_infos[i] for i in indexes.tolist()], scores[indexes]
+
+
+def save_results(
+    api: sly.Api,
+    image_infos: List[sly.ImageInfo],
+    scores: np.ndarray,
+    text_prompt: str,
+    source_project_id: int,
+    project_id: int,
+    dataset_id: int,
+    add_tag: bool = False,
+    progress: Callable = console_progress,
+    is_cancelled: Callable[[], bool] = lambda: False,
+) -> List[int]:
+    """Uploads the images with their annotations to the destination dataset in the given order.
+    The confidence is saved to the image meta and, optionally, as a tag.
+
+    Args:
+        api (sly.Api): API to upload the images.
+        image_infos (List[sly.ImageInfo]): infos of the images to save.
+        scores (np.ndarray): scores of the images (in the same order).
+        text_prompt (str): text prompt, used for inference.
+        source_project_id (int): ID of the project with the images.
+        project_id (int): ID of the destination project.
+        dataset_id (int): ID of the destination dataset.
+        add_tag (bool, optional): whether to add the confidence tag. Defaults to False.
+        progress (Callable, optional): function, which takes the message and the total and
+            returns a progress bar context manager. Defaults to console_progress.
+        is_cancelled (Callable[[], bool], optional): function, which returns True if the saving
+            was cancelled. Defaults to lambda: False.
+
+    Raises:
+        Cancelled: if the saving was cancelled.
+
+    Returns:
+        List[int]: IDs of the uploaded images.
+    """
+    split = Split(text_prompt, dataset_id, image_infos, scores)
+    return save_splits(
+        api, [split], source_project_id, project_id, add_tag, progress, is_cancelled
+    )[0]
+
+
+def save_splits(
+    api: sly.Api,
+    splits: List[Split],
+    source_project_id: int,
+    project_id: int,
+    add_tag: bool = False,
+    progress: Callable = console_progress,
+    is_cancelled: Callable[[], bool] = lambda: False,
+) -> List[List[int]]:
+    """Uploads the images of each split with their annotations to its destination dataset in
+    the given order. All the splits are uploaded in a single concurrent upload stage. The score
+    is saved to the image meta and, optionally, as a tag with the text prompt of the split.
+
+    Args:
+        api (sly.Api): API to upload the images.
+        splits (List[Split]): images with their scores for each destination dataset.
+        source_project_id (int): ID of the project with the images.
+        project_id (int): ID of the destination project.
+        add_tag (bool, optional): whether to add the confidence tag. Defaults to False.
+        progress (Callable, optional): function, which takes the message and the total and
+            returns a progress bar context manager. Defaults to console_progress.
+        is_cancelled (Callable[[], bool], optional): function, which returns True if the saving
+            was cancelled. Checked before each batch, the uploaded batches stay in the datasets.
+            Defaults to lambda: False.
+
+    Raises:
+        Cancelled: if the saving was cancelled.
+
+    Returns:
+        List[List[int]]: IDs of the uploaded images of each split.
+    """
+    # Updating the project meta to upload annotations.
+    project_meta = update_project_meta(api, source_project_id, project_id)
+    sly.logger.debug(f"Successfully updated project meta for project with ID {project_id}.")
+
+    if add_tag:
+        # Adding the tag metas before uploading, so the tags are uploaded with the annotations.
+        tag_names = [f"CLIP score ({split.text_prompt})" for split in splits]
+        sly.logger.debug(f"Add tag is enabled. Tag names: {tag_names}")
+
+        missing_tag_names = [name for name in tag_names if project_meta.get_tag_meta(name) is None]
+        if missing_tag_names:
+            project_meta = project_meta.add_tag_metas(
+                [sly.TagMeta(name, "any_number") for name in dict.fromkeys(missing_tag_names)]
+            )
+            api.project.update_meta(project_id, project_meta)
+            sly.logger.debug("Updated project meta with tag metas.")
+
+    jobs = []
+    for split_index, split in enumerate(splits):
+        names = []
+        metas = []
+        for prefix, (image_info, score) in enumerate(zip(split.image_infos, split.scores)):
+            names.append(f"{str(prefix).zfill(5)}_{image_info.name}")
+
+            meta = dict(image_info.meta)
+            meta["Prompt based confidence"] = f"{split.text_prompt} - {score:.4f}"
+            metas.append(meta)
+
+        tag_meta = project_meta.get_tag_meta(tag_names[split_index]) if add_tag else None
+        copy_annotations = partial(
+            copy_batch_annotations, api, split.scores, project_meta, tag_meta
+        )
+        jobs.append(
+            uploader.UploadJob(split.dataset_id, split.image_infos, names, metas, copy_annotations)
+        )
+
+    total = sum(len(split.image_infos) for split in splits)
+    sly.logger.info(f"Start saving {total} images to {len(splits)} datasets.")
+
+    with progress(message="Saving in process...", total=total) as pbar:
+        uploaded_image_ids = uploader.upload_jobs(
+            api,
+            jobs,
+            batch_size=g.BATCH_SIZE,
+            workers=g.UPLOAD_WORKERS,
+            progress_cb=pbar.update,
+            retries=g.UPLOAD_RETRIES,
+            is_cancelled=is_cancelled,
+        )
+
+    sly.logger.info(
+        f"Finished uploading {sum(map(len, uploaded_image_ids))} images "
+        "and copying their annotations."
+    )
+
+    return uploaded_image_ids
+
+
+def copy_batch_annotations(
+    api: sly.Api,
+    scores: np.ndarray,
+    project_meta: sly.ProjectMeta,
+    tag_meta: Optional[sly.TagMeta],
+    offset: int,
+    image_infos: List[sly.ImageInfo],
+    uploaded_image_ids: List[int],
+):
+    """Copies the annotations of the uploaded batch of images as soon as it's uploaded. If the
+    tag meta is given, the annotations are uploaded with the confidence tags instead.
+    Each request is retried separately, so only the failed one is repeated.
+
+    Args:
+        api (sly.Api): API to access the annotations.
+        scores (np.ndarray): scores of all the images of the split.
+        project_meta (sly.ProjectMeta): project meta of the new project.
+        tag_meta (Optional[sly.TagMeta]): tag meta of the confidence tag or None.
+        offset (int): offset of the batch in the split.
+        image_infos (List[sly.ImageInfo]): infos of the original images in the batch.
+        uploaded_image_ids (List[int]): IDs of the uploaded images (in the same order).
+    """
+    if tag_meta is not None:
+        batched_scores = scores[offset : offset + len(image_infos)]
+        upload_tagged_annotations(
+            api, image_infos, uploaded_image_ids, batched_scores, project_meta, tag_meta
+        )
+    else:
+        uploader.with_retries(
+            api.annotation.copy_batch_by_ids,
+            [image_info.id for image_info in image_infos],
+            uploaded_image_ids,
+            save_source_date=False,
+            retries=g.UPLOAD_RETRIES,
+        )
+
+
+def update_project_meta(api: sly.Api, source_project_id: int, project_id: int) -> sly.ProjectMeta:
+    """Retrieves the project meta from the original project and updates the project meta for
+    the new project.
+
+    Args:
+        api (sly.Api): API to access the projects.
+        source_project_id (int): ID of the original project.
+        project_id (int): ID of the new project.
+
+    Returns:
+        sly.ProjectMeta: Project meta of the original project.
+    """
+    # Retrieving the project meta from the original project.
+    meta_json = api.project.get_meta(source_project_id)
+    project_meta = sly.ProjectMeta.from_json(meta_json)
+
+    sly.logger.debug(
+        f"Successfully downloaded project meta for original project with ID {source_project_id}."
+    )
+
+    # Updating the new project meta to upload annotations.
+    api.project.update_meta(project_id, project_meta)
+
+    sly.logger.debug(f"Successfully updated project meta for new project with ID {project_id}.")
+
+    return project_meta
+
+
+def upload_tagged_annotations(
+    api: sly.Api,
+    image_infos: List[sly.ImageInfo],
+    uploaded_image_ids: List[int],
+    scores: np.ndarray,
+    project_meta: sly.ProjectMeta,
+    tag_meta: sly.TagMeta,
+) -> int:
+    """Downloads the annotations of the original images, adds the confidence tag with the score
+    to each of them and uploads them to the uploaded images in a single request per dataset.
+
+    Args:
+        api (sly.Api): API to access the annotations.
+        image_infos (List[sly.ImageInfo]): infos of the original images.
+        uploaded_image_ids (List[int]): IDs of the uploaded images (in the same order).
+        scores (np.ndarray): scores of the images (in the same order).
+        project_meta (sly.ProjectMeta): project meta of the new project with the tag meta.
+        tag_meta (sly.TagMeta): tag meta of the confidence tag.
+
+    Returns:
+        int: number of tagged images.
+    """
+    # Annotations can be downloaded in batch only from a single dataset.
+    batches = defaultdict(list)
+    for image_info, uploaded_image_id, score in zip(image_infos, uploaded_image_ids, scores):
+        batches[image_info.dataset_id].append((image_info.id, uploaded_image_id, score))
+
+    for source_dataset_id, batch in batches.items():
+        source_ids, destination_ids, batched_scores = zip(*batch)
+        ann_jsons = uploader.with_retries(
+            api.annotation.download_json_batch,
+            source_dataset_id,
+            list(source_ids),
+            retries=g.UPLOAD_RETRIES,
+        )
+
+        anns = []
+        for ann_json, score in zip(ann_jsons, batched_scores):
+            ann = sly.Annotation.from_json(ann_json, project_meta)
+            anns.append(ann.add_tag(sly.Tag(tag_meta, value=round(float(score), 4))))
+
+        uploader.with_retries(
+            api.annotation.upload_anns, list(destination_ids), anns, retries=g.UPLOAD_RETRIES
+        )
+
+    sly.logger.debug(f"Uploaded annotations with confidence tags for {len(image_infos)} images.")
+
+    return len(image_infos)
+
+
+def get_default_name(text_prompt: str) -> str:
+    """Returns the name for the new project or dataset with timestamp and text prompt."""
+    timestamp = datetime.now().strftime("%Y-%m-%d %H:%M")
+    return f"{timestamp}_({text_prompt})"
+
+
+def create_project(api: sly.Api, workspace_id: int, project_name: str) -> int:
+    """Creates a new project with the specified name and returns its id."""
+    project = api.project.create(workspace_id, project_name, change_name_if_conflict=True)
+
+    sly.logger.info(f"Project with name {project_name} and id {project.id} was created.")
+
+    return project.id
+
+
+def create_dataset(api: sly.Api, project_id: int, dataset_name: str) -> int:
+    """Creates a new dataset with the specified name and returns its id."""
+    dataset = api.dataset.create(project_id, dataset_name, change_name_if_conflict=True)
+
+    sly.logger.info(f"Dataset with name {dataset_name} and id {dataset.id} was created.")
+
+    return dataset.id
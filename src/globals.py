@@ -7,6 +7,9 @@ import supervisely as sly
 
 from dotenv import load_dotenv
 
+import src.models as models
+from src.embedding_store import EmbeddingStore
+
 if sly.is_development():
     load_dotenv("local.env")
     load_dotenv(os.path.expanduser("~/supervisely.env"))
@@ -15,8 +18,56 @@ api = sly.Api.from_env()
 
 DEVICE = "cuda" if torch.cuda.is_available() else "cpu"
 MODEL_BATCH_SIZE = 32 if DEVICE == "cuda" else 16
+# Max batch size, also the limit of the automatic batch size.
+MAX_BATCH_SIZE = 1024
 sly.logger.info(f"Chosen device: {DEVICE}, batch size: {MODEL_BATCH_SIZE}")
 
+# Number of batches, which are downloaded and decoded in advance during inference.
+PREFETCH_BATCHES = 2
+
+# Workers for parallel decoding and preprocessing of the images.
+DECODE_WORKERS = min(os.cpu_count() or 1, 8)
+DECODE_POOL_MODES = {"threads": "Threads", "processes": "Processes"}
+
+# Sources of the images for inference: original images decoded at full or reduced resolution
+# or previews resized on the server side to the model input size.
+IMAGE_SOURCES = {
+    "original": "Original images",
+    "reduced": "Original images, decoded at reduced resolution",
+    "preview": "Resized previews from the server",
+}
+# Number of parallel requests for downloading the previews.
+PREVIEW_DOWNLOAD_WORKERS = 16
+# Timeout in seconds of a single preview request and max number of attempts to download it,
+# so a stalled request doesn't block the run and its cancellation.
+PREVIEW_DOWNLOAD_TIMEOUT = 30
+PREVIEW_DOWNLOAD_RETRIES = 3
+# Number of images downloaded by a single request. Cancellation is checked between the requests,
+# so the cancelled inference stops after the current sub-batch instead of the whole batch.
+DOWNLOAD_SUB_BATCH_SIZE = 16
+
+# Execution modes of the models.
+EXECUTION_MODES = {
+    "eager": "Eager",
+    "jit": "TorchScript JIT",
+    "compile": "torch.compile",
+    "channels_last": "Channels-last memory format",
+}
+SPEED_TABLE_COLUMNS = ["EXECUTION MODE", "IMAGES/SEC"]
+
+# Inference backends. ONNX Runtime is faster on CPU, exported models are cached with the weights.
+BACKENDS = {
+    "pytorch": "PyTorch",
+    "onnx": "ONNX Runtime",
+    "onnx_int8": "ONNX Runtime with int8 quantization",
+}
+
+# URL of the shared model server (python -m src.model_server), which owns the loaded models,
+# so the app sessions on the same agent don't load their own copies.
+MODEL_SERVER_URL = os.getenv("MODEL_SERVER_URL")
+if MODEL_SERVER_URL:
+    BACKENDS["remote"] = "Shared model server"
+
 TEAM_ID = sly.env.team_id()
 WORKSPACE_ID = sly.env.workspace_id()
 
@@ -25,14 +76,20 @@ DATASET_ID = sly.env.dataset_id(raise_not_found=False)
 
 # Image table columns.
 SELECT_BUTTON = "SELECT"
+# Button to add the image to the examples for the search of similar images.
+EXAMPLE_BUTTON = "EXAMPLE"
 TABLE_COLUMNS = [
     "IMAGE ID",
     "FILE NAME",
+    "DATASET",
     "WIDTH (PIXELS)",
     "HEIGHT (PIXELS)",
     "CONFIDENCE",
     SELECT_BUTTON,
+    EXAMPLE_BUTTON,
 ]
+# Columns of the table with scores of the images in each dataset.
+DATASETS_TABLE_COLUMNS = ["DATASET", "IMAGES", "MEAN CONFIDENCE", "MAX CONFIDENCE"]
 
 SLY_APP_DATA_DIR = sly.app.get_data_dir()
 
@@ -43,6 +100,48 @@ os.makedirs(STATIC_DIR, exist_ok=True)
 
 # Batch size for uploading images to the dataset.
 BATCH_SIZE = 100
+# Number of batches, which are uploaded in parallel along with their annotations.
+UPLOAD_WORKERS = 4
+# Max number of attempts to upload a batch, the delay between attempts grows exponentially.
+UPLOAD_RETRIES = 3
+
+# Persistent store for image embeddings, so the next prompt doesn't re-encode the dataset.
+EMBEDDINGS_STORE_PATH = os.path.join(os.path.expanduser("~"), ".cache", "clip_embeddings.db")
+EMBEDDINGS_STORE_MAX_SIZE = int(float(os.getenv("EMBEDDINGS_STORE_MAX_SIZE_GB", 20)) * 1024**3)
+EMBEDDINGS_STORE = EmbeddingStore(EMBEDDINGS_STORE_PATH, EMBEDDINGS_STORE_MAX_SIZE)
+
+# Approximate nearest neighbour indexes over the stored embeddings for top-k search.
+INDEX_DIR = os.path.join(os.path.expanduser("~"), ".cache", "clip_indexes")
+# Number of index lists scanned for each query.
+INDEX_N_PROBE = 32
+SEARCH_MODES = {
+    "all": "Score all images",
+    "top_k": "Top-K search",
+    "threshold": "Threshold filter",
+    "duplicates": "Remove near-duplicates",
+}
+TOP_K = 100
+
+# Whether to expose the metrics of the inference runs in the Prometheus text format at /metrics.
+METRICS_ENDPOINT = os.getenv("METRICS_ENDPOINT", "false").lower() in ("1", "true", "yes")
+
+# Minimal cosine similarity of the embeddings of near-duplicate images.
+DUPLICATE_THRESHOLD = 0.95
+# Number of the closest index lists, which are compared with each list to find the duplicates.
+DEDUP_N_PROBE = 8
+# Name of the results of the duplicates search without the prompt, used for the tags and names.
+DEDUP_LABEL = "near-duplicates removed"
+
+# Number of stored embeddings read from the store at once during inference.
+STORE_READ_BATCH_SIZE = 10000
+
+# Checkpoints of the inference runs, so they can be resumed after restart or cancellation.
+CHECKPOINTS_DIR = os.path.join(SLY_APP_DATA_DIR, "checkpoints")
+# Interval between checkpoint saves in seconds.
+CHECKPOINT_INTERVAL = 60
+
+# Scores of the last runs, which are reused in incremental mode.
+RESULTS_DIR = os.path.join(SLY_APP_DATA_DIR, "results")
 
 # Define and copy placeholder image for Image preview widget to static directory.
 PLACEHOLDER = "placeholder.png"
@@ -52,51 +151,20 @@ shutil.copy(PLACEHOLDER, dst_file)
 # Columns for RadioTable widget with models.
 MODELS_COLUMNS = ["Name", "Pretrained on", "Top-1 accuracy on ImageNet", "Size"]
 # List of available models.
-MODELS = {
-    ("ViT-L-14", "openai", "75.5%", "0.933 GB"): {
-        "url": "https://openaipublic.azureedge.net/clip/models/b8cca3fd41ae0c99ba7e8951adf17d267cdb84cd88be6f7c2e0eca1737a03836/ViT-L-14.pt",
-        "path": "clip/ViT-L-14.pt",
-    },
-    ("coca_ViT-L-14", "mscoco_finetuned_laion2B-s13B-b90k", "-", "2.55 GB"): {
-        "url": "https://huggingface.co/laion/mscoco_finetuned_CoCa-ViT-L-14-laion2B-s13B-b90k/resolve/main/open_clip_pytorch_model.bin",
-        "path": "huggingface/hub/models--laion--mscoco_finetuned_CoCa-ViT-L-14-laion2B-s13B-b90k/blobs/f22c34acef2b7a5d1ed28982a21077de651363eaaebcf34a3f10676e17837cb8",
-    },
-    ("coca_ViT-L-14", "laion2B-s13B-b90k", "75.5%", "2.55 GB"): {
-        "url": "https://huggingface.co/laion/CoCa-ViT-L-14-laion2B-s13B-b90k/resolve/main/open_clip_pytorch_model.bin",
-        "path": "huggingface/hub/models--laion--CoCa-ViT-L-14-laion2B-s13B-b90k/blobs/73725652298ad76ed2162caffdae96d8653a05d7a29b6281103e4df81d0ff8ea",
-    },
-    ("ViT-L-14", "laion2b_s32b_b82k", "75.3%", "0.933 GB"): {
-        "url": "https://huggingface.co/laion/CLIP-ViT-L-14-laion2B-s32B-b82K/resolve/main/open_clip_pytorch_model.bin",
-        "path": "huggingface/hub/models--laion--CLIP-ViT-L-14-laion2B-s32B-b82K/blobs/5ddb47339f44e4fd9cace3d3960d38af1b51a25857440cfae90afc44706d7e2b",
-    },
-    ("ViT-L-14-336", "openai", "-", "0.933 GB"): {
-        "url": "https://openaipublic.azureedge.net/clip/models/3035c92b350959924f9f00213499208652fc7ea050643e8b385c2dac08641f02/ViT-L-14-336px.pt",
-        "path": "clip/ViT-L-14-336px.pt",
-    },
-    ("ViT-g-14", "laion2b_s34b_b88k", "78.5%", "5.47 GB"): {
-        "url": "https://huggingface.co/laion/CLIP-ViT-g-14-laion2B-s34B-b88K/resolve/main/open_clip_pytorch_model.bin",
-        "path": "huggingface/hub/models--laion--CLIP-ViT-g-14-laion2B-s34B-b88K/blobs/9ef136f407986fb607cd37a823eba38a3b6f95e8ec702b3d1687252985d84750",
-    },
-    ("ViT-bigG-14", "laion2b_s39b_b160k", "80.1%", "10.2 GB"): {
-        "url": "https://huggingface.co/laion/CLIP-ViT-bigG-14-laion2B-39B-b160k/resolve/main/open_clip_pytorch_model.bin",
-        "path": "huggingface/hub/models--laion--CLIP-ViT-bigG-14-laion2B-39B-b160k/blobs/0d5318839ad03607c48055c45897c655a14c0276a79f6b867934ddd073760e39",
-    },
-    ("convnext_base_w", "laion2b_s13b_b82k_augreg", "71.5%", "0.718 GB"): {
-        "url": "https://huggingface.co/laion/CLIP-convnext_base_w-laion2B-s13B-b82K-augreg/resolve/main/open_clip_pytorch_model.bin",
-        "path": "huggingface/hub/models--laion--CLIP-convnext_base_w-laion2B-s13B-b82K-augreg/blobs/249e2302c1670bb04476792196f788ff046fedef61191a24983e61b6eca56987",
-    },
-    ("convnext_large_d_320", "laion2b_s29b_b131k_ft_soup", "76.9%", "1.41 GB"): {
-        "url": "https://huggingface.co/laion/CLIP-convnext_large_d_320.laion2B-s29B-b131K-ft-soup/resolve/main/open_clip_pytorch_model.bin",
-        "path": "huggingface/hub/models--laion--CLIP-convnext_large_d_320.laion2B-s29B-b131K-ft-soup/blobs/4572137af44b2e26f01f638337a59688ec289e9363e15c08dde16640afb86988",
-    },
-}
-# Prompt weights.
-WEIGHTS = [1.0]
+MODELS = models.MODELS
 
 # Available methods for filtering and sorting images.
 FILTER_METHODS = ["above threshold", "below threshold"]
 SORT_METHODS = {"desc": "Descending 🔽", "asc": "Ascending 🔼"}
 
+# Methods of assigning images to classes in split mode.
+SPLIT_METHODS = {
+    "best": "Best matching class",
+    "threshold": "All classes with probability above threshold",
+}
+# Scale of the similarities before softmax over the classes, as in CLIP zero-shot classification.
+CLASS_LOGIT_SCALE = 100.0
+
 
 class State:
     def __init__(self):
@@ -104,7 +172,9 @@ class State:
         self.image_infos = None
         self.scores = None
         self.i_sort = None
-        self.continue_inference = True
+        # Datasets and parameters of the last inference, used to classify images in split mode.
+        self.dataset_ids = None
+        self.params = None
 
     def get_params(self):
         return self.image_infos, self.scores, self.i_sort
@@ -116,4 +186,4 @@ SELECTED_TEAM = None
 SELECTED_WORKSPACE = None
 PROJECT_META = None
 SELECTED_PROJECT = None
-SELECTED_DATASET = None
+SELECTED_DATASETS = []
@@ -0,0 +1,149 @@
+import threading
+
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+from contextlib import contextmanager
+from typing import Callable, Iterator, List
+
+import supervisely as sly
+
+# Interval in seconds between the updates of the progress widget from the job.
+PROGRESS_UPDATE_INTERVAL = 0.5
+# Interval in seconds between the checks of the cancellation while waiting for the workers.
+CANCEL_CHECK_INTERVAL = 0.1
+
+
+class Cancelled(Exception):
+    """Raised inside the stages of the running job, when the job was cancelled, so the stage
+    stops after the current sub-batch instead of the whole batch."""
+
+
+class BackgroundJob:
+    """Runs a function in the dedicated worker thread, so the handler, which starts the job,
+    returns immediately and the app keeps serving the UI requests while the job is running.
+    Cancellation is cooperative: the function checks is_cancelled() and stops by itself.
+
+    Args:
+        name (str): name of the job for the logs and the worker thread.
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix=name)
+        self._cancel_event = threading.Event()
+        self._future = None
+
+    @property
+    def running(self) -> bool:
+        return self._future is not None and not self._future.done()
+
+    def is_cancelled(self) -> bool:
+        return self._cancel_event.is_set()
+
+    def cancel(self):
+        """Asks the running job to stop, returns without waiting for it."""
+        if self.running:
+            sly.logger.info(f"Job {self.name} was asked to stop.")
+        self._cancel_event.set()
+
+    def start(self, func: Callable, *args, **kwargs) -> Future:
+        """Starts the function in the worker thread.
+
+        Raises:
+            RuntimeError: if the job is already running.
+
+        Returns:
+            Future: future with the result of the function.
+        """
+        if self.running:
+            raise RuntimeError(f"Job {self.name} is already running.")
+
+        self._cancel_event.clear()
+        self._future = self._executor.submit(func, *args, **kwargs)
+        self._future.add_done_callback(self._log_result)
+        return self._future
+
+    def _log_result(self, future: Future):
+        exception = future.exception()
+        if exception is not None:
+            sly.logger.error(
+                f"Job {self.name} failed: {exception}",
+                exc_info=(type(exception), exception, exception.__traceback__),
+            )
+        else:
+            sly.logger.debug(f"Job {self.name} finished.")
+
+
+class AsyncProgress:
+    """Progress in the format of the Progress widget, which doesn't block the job on the UI.
+    The job only counts the processed items, the counts are pushed to the widget from
+    a separate thread at most once per interval.
+
+    Args:
+        widget (Callable): progress bar factory, e.g. the Progress widget.
+        interval (float, optional): interval in seconds between the updates of the widget.
+            Defaults to PROGRESS_UPDATE_INTERVAL.
+    """
+
+    def __init__(self, widget: Callable, interval: float = PROGRESS_UPDATE_INTERVAL):
+        self.widget = widget
+        self.interval = interval
+
+    @contextmanager
+    def __call__(self, message: str, total: int, **kwargs) -> Iterator["_Counter"]:
+        with self.widget(message=message, total=total, **kwargs) as pbar:
+            counter = _Counter()
+            stop_event = threading.Event()
+
+            def push():
+                while not stop_event.wait(self.interval):
+                    counter.flush(pbar)
+
+            thread = threading.Thread(target=push, daemon=True)
+            thread.start()
+            try:
+                yield counter
+            finally:
+                stop_event.set()
+                thread.join()
+                counter.flush(pbar)
+
+
+class _Counter:
+    """Number of the processed items, which weren't pushed to the progress bar yet."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pending = 0
+
+    def update(self, count: int = 1):
+        with self._lock:
+            self._pending += count
+
+    def flush(self, pbar):
+        with self._lock:
+            count, self._pending = self._pending, 0
+        if count:
+            pbar.update(count)
+
+
+def wait_results(futures: List[Future], is_cancelled: Callable[[], bool]) -> Iterator:
+    """Yields the results of the futures in order. If the job is cancelled while waiting,
+    the pending futures are cancelled and Cancelled is raised.
+
+    Args:
+        futures (List[Future]): futures of the submitted tasks.
+        is_cancelled (Callable[[], bool]): function, which returns True if the job was cancelled.
+
+    Raises:
+        Cancelled: if the job was cancelled.
+    """
+    try:
+        for future in futures:
+            while not future.done():
+                if is_cancelled():
+                    raise Cancelled()
+                wait([future], timeout=CANCEL_CHECK_INTERVAL)
+            yield future.result()
+    finally:
+        for future in futures:
+            future.cancel()
@@ -1,8 +1,10 @@
 import supervisely as sly
 
+from fastapi.responses import PlainTextResponse
 from supervisely.app.widgets import Container
 
 import src.globals as g
+import src.metrics as metrics
 import src.ui.input as input
 import src.ui.settings as settings
 import src.ui.inference as inference
@@ -15,3 +17,13 @@ layout = Container(
 )
 
 app = sly.Application(layout=layout, static_dir=g.STATIC_DIR)
+
+if g.METRICS_ENDPOINT:
+    server = app.get_server()
+
+    @server.get("/metrics", response_class=PlainTextResponse)
+    def get_metrics():
+        """Returns the metrics of the inference runs in the Prometheus text format."""
+        return metrics.registry.to_prometheus()
+
+    sly.logger.info("Metrics of the inference runs are available at /metrics.")
@@ -0,0 +1,212 @@
+import threading
+import time
+
+from collections import defaultdict
+from contextlib import contextmanager
+from typing import Callable, Dict, Optional
+
+# Stages of the inference loop in the order of processing of a batch.
+STAGES = ["download", "decode", "preprocess", "h2d", "forward", "postprocess"]
+
+# Prefix of the metric names in the Prometheus text format.
+PROMETHEUS_PREFIX = "clip_inference"
+
+
+class RunMetrics:
+    """Timings of the stages of the inference loop, number of the encoded images and depths of
+    the queues between the pipeline stages for a single run. Decode and preprocess run in the
+    pool of workers, so their timings are summed over the workers. Stages run concurrently, so
+    the sum of the stage timings can exceed the wall time of the run.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.stage_seconds = defaultdict(float)
+        self.stage_batches = defaultdict(int)
+        self.queue_depths = defaultdict(list)
+        self.images = 0
+        self.batch_size = None
+        self.started_at = time.perf_counter()
+        self.finished_at = None
+
+    @contextmanager
+    def measure(self, stage: str):
+        """Measures the time of the code block and adds it to the stage."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(stage, time.perf_counter() - start)
+
+    def add(self, stage: str, seconds: float, batches: int = 1):
+        with self._lock:
+            self.stage_seconds[stage] += seconds
+            self.stage_batches[stage] += batches
+
+    def add_images(self, count: int, batch_size: Optional[int] = None):
+        """Adds the number of encoded images and saves the current batch size."""
+        with self._lock:
+            self.images += count
+            self.batch_size = batch_size or self.batch_size
+
+    def sample_queues(self, depths: Dict[str, int]):
+        """Saves the current number of items in each queue between the pipeline stages."""
+        with self._lock:
+            for name, depth in depths.items():
+                self.queue_depths[name].append(depth)
+
+    def finish(self):
+        self.finished_at = time.perf_counter()
+
+    @property
+    def elapsed(self) -> float:
+        return (self.finished_at or time.perf_counter()) - self.started_at
+
+    @property
+    def images_per_second(self) -> float:
+        return self.images / self.elapsed if self.images and self.elapsed > 0 else 0.0
+
+    def summary(self) -> Dict:
+        """Returns the summary of the run: total and mean per batch time of each stage in
+        milliseconds, the throughput and the mean and max depths of the queues."""
+        with self._lock:
+            stages = {
+                stage: {
+                    "total_ms": round(self.stage_seconds[stage] * 1000, 1),
+                    "batch_ms": round(
+                        self.stage_seconds[stage] * 1000 / self.stage_batches[stage], 2
+                    ),
+                }
+                for stage in STAGES
+                if self.stage_batches[stage]
+            }
+            queues = {
+                name: {"mean": round(sum(depths) / len(depths), 2), "max": max(depths)}
+                for name, depths in self.queue_depths.items()
+                if depths
+            }
+        return {
+            "images": self.images,
+            "elapsed_s": round(self.elapsed, 2),
+            "images_per_second": round(self.images_per_second, 2),
+            "batch_size": self.batch_size,
+            "stages": stages,
+            "queues": queues,
+        }
+
+
+def timed(run_metrics: Optional[RunMetrics], stage: str, func: Callable) -> Callable:
+    """Returns the function, which adds the time of each call of func to the stage."""
+    if run_metrics is None:
+        return func
+
+    def wrapper(*args, **kwargs):
+        with run_metrics.measure(stage):
+            return func(*args, **kwargs)
+
+    return wrapper
+
+
+def format_summary(summary: Dict) -> str:
+    """Formats the summary of the run as a short single-line text for logs and UI."""
+    text = f"{summary['images']} images in {summary['elapsed_s']} s "
+    text += f"({summary['images_per_second']} images/sec)"
+    if summary.get("batch_size"):
+        text += f", batch size {summary['batch_size']}"
+    if summary["stages"]:
+        text += ". Per batch: " + ", ".join(
+            f"{stage} {timing['batch_ms']} ms" for stage, timing in summary["stages"].items()
+        )
+    if summary["queues"]:
+        text += ". Queue depths (mean/max): " + ", ".join(
+            f"{name} {depth['mean']}/{depth['max']}" for name, depth in summary["queues"].items()
+        )
+    return text + "."
+
+
+class MetricsRegistry:
+    """Totals over all the runs in the app session and the current run, rendered in the
+    Prometheus text format for scraping."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.current: Optional[RunMetrics] = None
+        self.last: Optional[RunMetrics] = None
+        self.runs = 0
+        self.images = 0
+        self.stage_seconds = defaultdict(float)
+        self.stage_batches = defaultdict(int)
+
+    def start(self) -> RunMetrics:
+        run_metrics = RunMetrics()
+        with self._lock:
+            self.current = run_metrics
+        return run_metrics
+
+    def finish(self, run_metrics: RunMetrics):
+        run_metrics.finish()
+        with self._lock:
+            self.runs += 1
+            self.images += run_metrics.images
+            for stage in STAGES:
+                self.stage_seconds[stage] += run_metrics.stage_seconds[stage]
+                self.stage_batches[stage] += run_metrics.stage_batches[stage]
+            self.last = run_metrics
+            if self.current is run_metrics:
+                self.current = None
+
+    def to_prometheus(self) -> str:
+        prefix = PROMETHEUS_PREFIX
+        with self._lock:
+            current, last = self.current, self.last
+            lines = [
+                f"# HELP {prefix}_runs_total Finished inference runs.",
+                f"# TYPE {prefix}_runs_total counter",
+                f"{prefix}_runs_total {self.runs}",
+                f"# HELP {prefix}_images_total Images encoded by the finished runs.",
+                f"# TYPE {prefix}_images_total counter",
+                f"{prefix}_images_total {self.images}",
+                f"# HELP {prefix}_stage_seconds_total Time spent in each stage of the loop.",
+                f"# TYPE {prefix}_stage_seconds_total counter",
+            ]
+            lines += [
+                f'{prefix}_stage_seconds_total{{stage="{stage}"}} {self.stage_seconds[stage]:.6f}'
+                for stage in STAGES
+            ]
+            lines += [
+                f"# HELP {prefix}_stage_batches_total Batches processed by each stage.",
+                f"# TYPE {prefix}_stage_batches_total counter",
+            ]
+            lines += [
+                f'{prefix}_stage_batches_total{{stage="{stage}"}} {self.stage_batches[stage]}'
+                for stage in STAGES
+            ]
+
+        lines += [
+            f"# HELP {prefix}_running Whether the inference is running.",
+            f"# TYPE {prefix}_running gauge",
+            f"{prefix}_running {int(current is not None)}",
+            f"# HELP {prefix}_images_per_second Throughput of the current or the last run.",
+            f"# TYPE {prefix}_images_per_second gauge",
+        ]
+        run_metrics = current or last
+        lines.append(
+            f"{prefix}_images_per_second "
+            f"{run_metrics.images_per_second if run_metrics else 0.0:.3f}"
+        )
+        if current is not None:
+            lines += [
+                f"# HELP {prefix}_queue_depth Items waiting in the queues between the stages.",
+                f"# TYPE {prefix}_queue_depth gauge",
+            ]
+            with current._lock:
+                lines += [
+                    f'{prefix}_queue_depth{{queue="{name}"}} {depths[-1]}'
+                    for name, depths in current.queue_depths.items()
+                    if depths
+                ]
+        return "\n".join(lines) + "\n"
+
+
+# Metrics of all the runs in the app session.
+registry = MetricsRegistry()
@@ -0,0 +1,504 @@
+"""Shared model server, which owns the loaded models, so several app sessions on the same agent
+use a single copy of each model instead of loading their own. Concurrent encode_image and
+encode_text requests of all the sessions are merged into dynamic batches for each model.
+The sessions download, decode and preprocess the images and tokenize the prompts themselves,
+only the model input tensors are sent to the server.
+
+Start the server and set MODEL_SERVER_URL for the app sessions to add the "Shared model server"
+backend to the settings:
+    python -m src.model_server --host 127.0.0.1 --port 8100 --device cuda --max-batch-size 64
+    MODEL_SERVER_URL=http://127.0.0.1:8100
+"""
+
+import argparse
+import asyncio
+import hashlib
+import io
+import queue
+import threading
+import time
+
+from concurrent.futures import Future
+from typing import Callable, Dict, List, NamedTuple, Optional, Tuple
+
+import numpy as np
+import requests
+import torch
+import open_clip
+import supervisely as sly
+from torchvision.transforms import Normalize
+
+from fastapi import FastAPI, HTTPException, Request, Response
+from pydantic import BaseModel
+
+import src.clip_api as clip_api
+from src.models import get_model_data
+
+# Max number of images or prompts in a merged batch.
+MAX_BATCH_SIZE = 64
+# Max time in seconds the first request waits for other requests to merge with.
+MAX_BATCH_DELAY = 0.01
+# Timeout in seconds of the requests to the server. Loading a model can take minutes.
+LOAD_TIMEOUT = 1800
+ENCODE_TIMEOUT = 600
+
+ARRAY_CONTENT_TYPE = "application/octet-stream"
+
+
+class LoadRequest(BaseModel):
+    model_name: str
+    pretrained: str
+    execution_mode: str = "eager"
+
+
+class ModelUnloaded(RuntimeError):
+    """Raised for the requests to the model, which was unloaded from the server."""
+
+
+class _Request(NamedTuple):
+    inputs: np.ndarray
+    future: Future
+
+
+class DynamicBatcher:
+    """Merges the concurrent requests to the encoder into batches. The worker thread takes
+    the first waiting request and adds the next ones, until the batch is full or the first
+    request has waited for max_delay seconds, then encodes the batch and splits the outputs
+    back to the requests. A request larger than the max batch size is encoded as a whole.
+    Every submitted request gets the outputs or an exception, also when the batcher is stopped.
+
+    Args:
+        encode (Callable[[torch.Tensor], torch.Tensor]): function, which encodes the batch.
+        max_batch_size (int, optional): max number of items in a merged batch.
+            Defaults to MAX_BATCH_SIZE.
+        max_delay (float, optional): max waiting time of the first request in seconds.
+            Defaults to MAX_BATCH_DELAY.
+    """
+
+    def __init__(
+        self,
+        encode: Callable[[torch.Tensor], torch.Tensor],
+        max_batch_size: int = MAX_BATCH_SIZE,
+        max_delay: float = MAX_BATCH_DELAY,
+    ):
+        self.encode = encode
+        self.max_batch_size = max_batch_size
+        self.max_delay = max_delay
+        self.batches = 0
+        self.requests = 0
+
+        self._queue = queue.Queue()
+        self._stopped = threading.Event()
+        # Makes the check of the stop and the enqueueing of the request atomic, so no request
+        # is enqueued after the worker has drained the queue.
+        self._lock = threading.Lock()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def submit(self, inputs: np.ndarray) -> Future:
+        """Adds the inputs to the next batch.
+
+        Returns:
+            Future: future with the outputs for the inputs.
+        """
+        future = Future()
+        with self._lock:
+            if self._stopped.is_set():
+                future.set_exception(ModelUnloaded("The model was unloaded."))
+            else:
+                self._queue.put(_Request(inputs, future))
+        return future
+
+    def stop(self):
+        """Stops the worker after the current batch, the waiting requests and the requests
+        submitted after the stop fail."""
+        with self._lock:
+            self._stopped.set()
+            self._queue.put(None)
+
+    def _next_batch(self) -> List[_Request]:
+        """Returns the next batch or an empty list, if the batcher was stopped."""
+        batch = []
+        size = 0
+        deadline = None
+        while size < self.max_batch_size:
+            if deadline is None:
+                request = self._queue.get()
+            else:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    request = self._queue.get(timeout=timeout)
+                except queue.Empty:
+                    break
+            if request is None:
+                self._queue.put(None)
+                break
+            # The request is cancelled, when its client has disconnected.
+            if not request.future.set_running_or_notify_cancel():
+                continue
+            if deadline is None:
+                deadline = time.monotonic() + self.max_delay
+            batch.append(request)
+            size += len(request.inputs)
+        return batch
+
+    def _encode_batch(self, batch: List[_Request]):
+        try:
+            inputs = torch.from_numpy(np.concatenate([request.inputs for request in batch]))
+            outputs = self.encode(inputs).cpu().numpy()
+        except Exception as e:
+            sly.logger.warning(f"Encoding of the batch of {len(batch)} requests failed: {e}")
+            for request in batch:
+                request.future.set_exception(e)
+            return
+
+        self.batches += 1
+        self.requests += len(batch)
+        start = 0
+        for request in batch:
+            end = start + len(request.inputs)
+            request.future.set_result(outputs[start:end])
+            start = end
+
+    def _run(self):
+        batch = []
+        try:
+            while not self._stopped.is_set():
+                batch = self._next_batch()
+                if batch:
+                    self._encode_batch(batch)
+                batch = []
+        finally:
+            # Also when the worker has failed, so the next requests fail immediately.
+            with self._lock:
+                self._stopped.set()
+            error = ModelUnloaded("The model was unloaded.")
+            for request in batch:
+                if not request.future.done():
+                    request.future.set_exception(error)
+            # Nothing is added to the queue after the stop.
+            while True:
+                try:
+                    request = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if request is not None and request.future.set_running_or_notify_cancel():
+                    request.future.set_exception(error)
+
+
+class _ServedModel(NamedTuple):
+    cache_key: tuple
+    preprocess_params: Dict
+    image_batcher: DynamicBatcher
+    text_batcher: DynamicBatcher
+
+
+class ModelServer:
+    """Loaded models with the batchers of their image and text encoders. Models are loaded
+    and evicted by the models cache of clip_api, the batchers of the evicted models are
+    stopped, so their memory is freed.
+
+    Args:
+        device (str): device to run the models on.
+        backend (str, optional): backend of the models. Defaults to "pytorch".
+        max_batch_size (int, optional): max number of items in a merged batch.
+            Defaults to MAX_BATCH_SIZE.
+        max_delay (float, optional): max waiting time of the first request of the batch in
+            seconds. Defaults to MAX_BATCH_DELAY.
+    """
+
+    def __init__(
+        self,
+        device: str,
+        backend: str = "pytorch",
+        max_batch_size: int = MAX_BATCH_SIZE,
+        max_delay: float = MAX_BATCH_DELAY,
+    ):
+        self.device = device
+        self.backend = backend
+        self.max_batch_size = max_batch_size
+        self.max_delay = max_delay
+        self.models: Dict[str, _ServedModel] = {}
+        # Serializes the loading of the models, which can take minutes.
+        self._lock = threading.Lock()
+        # Guards the models, so the encode requests aren't blocked by the loading.
+        self._models_lock = threading.Lock()
+
+    def load(self, request: LoadRequest) -> Tuple[str, Dict]:
+        """Loads the model if it isn't loaded yet. The model files are resolved from the list of
+        available models of the server, not taken from the request, so the clients can't make
+        the server read or download other files.
+
+        Raises:
+            ValueError: if the model isn't in the list of available models.
+
+        Returns:
+            the key of the model for the encode requests and the parameters of its
+            preprocessing transforms.
+        """
+        model_data = get_model_data(request.model_name, request.pretrained)
+        key = get_model_key(request.model_name, request.pretrained, request.execution_mode)
+        with self._lock:
+            with self._models_lock:
+                served_model = self.models.get(key)
+            if served_model is not None:
+                return key, served_model.preprocess_params
+
+            model, preprocess, _ = clip_api.build_model(
+                request.model_name,
+                request.pretrained,
+                self.device,
+                model_data,
+                request.execution_mode,
+                self.backend,
+            )
+            served_model = _ServedModel(
+                (
+                    request.model_name,
+                    request.pretrained,
+                    self.device,
+                    request.execution_mode,
+                    self.backend,
+                ),
+                get_preprocess_params(preprocess),
+                DynamicBatcher(
+                    self._image_encoder(model, request.execution_mode),
+                    self.max_batch_size,
+                    self.max_delay,
+                ),
+                DynamicBatcher(self._text_encoder(model), self.max_batch_size, self.max_delay),
+            )
+            with self._models_lock:
+                self.models[key] = served_model
+                self._stop_evicted()
+        return key, served_model.preprocess_params
+
+    def submit(self, key: str, method: str, inputs: np.ndarray) -> Future:
+        """Submits the inputs to the batcher of the model.
+
+        Raises:
+            KeyError: if the model isn't loaded.
+        """
+        with self._models_lock:
+            served_model = self.models.get(key)
+            if served_model is None:
+                raise KeyError(key)
+            if method == "encode_image":
+                return served_model.image_batcher.submit(inputs)
+            return served_model.text_batcher.submit(inputs)
+
+    def stats(self) -> Dict:
+        with self._models_lock:
+            models = dict(self.models)
+        return {
+            key: {
+                "model": list(served_model.cache_key[:2]),
+                "image_batches": served_model.image_batcher.batches,
+                "image_requests": served_model.image_batcher.requests,
+                "text_batches": served_model.text_batcher.batches,
+                "text_requests": served_model.text_batcher.requests,
+            }
+            for key, served_model in models.items()
+        }
+
+    def _image_encoder(self, model, execution_mode: str) -> Callable:
+        def encode(images: torch.Tensor) -> torch.Tensor:
+            return clip_api.encode_images(model, images.to(self.device), execution_mode)
+
+        return encode
+
+    def _text_encoder(self, model) -> Callable:
+        def encode(text: torch.Tensor) -> torch.Tensor:
+            return clip_api.encode_prompts(model, text.to(self.device))
+
+        return encode
+
+    def _stop_evicted(self):
+        for key, served_model in list(self.models.items()):
+            if served_model.cache_key not in clip_api.models_cache:
+                served_model.image_batcher.stop()
+                served_model.text_batcher.stop()
+                del self.models[key]
+                sly.logger.info(f"Model {served_model.cache_key} was unloaded from the server.")
+
+
+def create_app(server: ModelServer) -> FastAPI:
+    app = FastAPI(title="CLIP model server")
+
+    @app.get("/health")
+    def health():
+        return {"device": server.device, "backend": server.backend, "models": server.stats()}
+
+    @app.post("/models")
+    def load_model(request: LoadRequest):
+        # Runs in the thread pool of the server, so the encode requests aren't blocked.
+        try:
+            key, preprocess_params = server.load(request)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+        return {"key": key, "preprocess": preprocess_params}
+
+    async def encode(key: str, method: str, request: Request) -> Response:
+        inputs = array_from_bytes(await request.body())
+        try:
+            future = server.submit(key, method, inputs)
+        except KeyError:
+            raise HTTPException(status_code=404, detail=f"Model {key} isn't loaded.")
+        try:
+            outputs = await asyncio.wrap_future(future)
+        except ModelUnloaded:
+            # The model was evicted after the request was submitted, the client loads it again.
+            raise HTTPException(status_code=404, detail=f"Model {key} was unloaded.")
+        return Response(content=array_to_bytes(outputs), media_type=ARRAY_CONTENT_TYPE)
+
+    @app.post("/models/{key}/encode_image")
+    async def encode_image(key: str, request: Request):
+        return await encode(key, "encode_image", request)
+
+    @app.post("/models/{key}/encode_text")
+    async def encode_text(key: str, request: Request):
+        return await encode(key, "encode_text", request)
+
+    return app
+
+
+class RemoteModel:
+    """Client of the model on the shared model server. Has the same encode_image and
+    encode_text methods as the CLIP model, so it can be used instead of it in clip_api.
+    If the server has unloaded the model, it's loaded again on the next request.
+
+    Args:
+        url (str): URL of the model server.
+        request (LoadRequest): model to load on the server.
+    """
+
+    def __init__(self, url: str, request: LoadRequest):
+        self.url = url.rstrip("/")
+        self.request = request
+        self.session = requests.Session()
+        self.key, self.preprocess_params = self._load()
+
+    def encode_image(self, images: torch.Tensor) -> torch.Tensor:
+        return self._encode("encode_image", images)
+
+    def encode_text(self, text: torch.Tensor) -> torch.Tensor:
+        return self._encode("encode_text", text)
+
+    def _load(self) -> Tuple[str, Dict]:
+        response = self.session.post(
+            f"{self.url}/models", json=self.request.dict(), timeout=LOAD_TIMEOUT
+        )
+        response.raise_for_status()
+        result = response.json()
+        return result["key"], result["preprocess"]
+
+    def _encode(self, method: str, inputs: torch.Tensor) -> torch.Tensor:
+        data = array_to_bytes(inputs.cpu().numpy())
+        for attempt in range(2):
+            response = self.session.post(
+                f"{self.url}/models/{self.key}/{method}",
+                data=data,
+                headers={"Content-Type": ARRAY_CONTENT_TYPE},
+                timeout=ENCODE_TIMEOUT,
+            )
+            if response.status_code == 404 and attempt == 0:
+                sly.logger.info(f"Model {self.key} was unloaded from the server, loading again.")
+                self.key, _ = self._load()
+                continue
+            response.raise_for_status()
+            break
+        # The loaded array is read-only, the features are normalized in place by clip_api.
+        return torch.tensor(array_from_bytes(response.content))
+
+
+def connect(
+    url: str, model_name: str, pretrained: str, execution_mode: str = "eager"
+) -> Tuple[RemoteModel, Callable, Callable]:
+    """Loads the model on the server and builds its preprocessing transforms with the parameters
+    of the served model and its tokenizer locally without loading the weights.
+
+    Returns:
+        the remote model, its preprocessing transforms and tokenizer.
+    """
+    start_time = time.perf_counter()
+    request = LoadRequest(
+        model_name=model_name,
+        pretrained=pretrained,
+        execution_mode=execution_mode,
+    )
+    model = RemoteModel(url, request)
+
+    preprocess = open_clip.image_transform(
+        model.preprocess_params["image_size"],
+        is_train=False,
+        mean=model.preprocess_params["mean"],
+        std=model.preprocess_params["std"],
+    )
+    tokenizer = open_clip.get_tokenizer(model_name)
+
+    sly.logger.info(
+        f"Model {model_name} ({pretrained}) is ready on the model server {url} "
+        f"in {time.perf_counter() - start_time:.2f} s."
+    )
+    return model, preprocess, tokenizer
+
+
+def get_preprocess_params(preprocess) -> Dict:
+    """Returns the parameters of the preprocessing transforms of open_clip, which are needed to
+    build the same transforms on the client: input size, mean and std of the normalization."""
+    normalize = next(
+        transform for transform in preprocess.transforms if isinstance(transform, Normalize)
+    )
+    return {
+        "image_size": clip_api.get_input_size(preprocess),
+        "mean": [float(value) for value in normalize.mean],
+        "std": [float(value) for value in normalize.std],
+    }
+
+
+def get_model_key(model_name: str, pretrained: str, execution_mode: str) -> str:
+    return hashlib.md5(f"{model_name}_{pretrained}_{execution_mode}".encode()).hexdigest()[:16]
+
+
+def array_to_bytes(array: np.ndarray) -> bytes:
+    buffer = io.BytesIO()
+    np.save(buffer, array, allow_pickle=False)
+    return buffer.getvalue()
+
+
+def array_from_bytes(data: bytes) -> np.ndarray:
+    return np.load(io.BytesIO(data), allow_pickle=False)
+
+
+def parse_args(args: Optional[List[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Shared CLIP model server.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8100)
+    parser.add_argument("--device", default="cuda" if torch.cuda.is_available() else "cpu")
+    parser.add_argument("--backend", choices=["pytorch", "onnx", "onnx_int8"], default="pytorch")
+    parser.add_argument("--max-batch-size", type=int, default=MAX_BATCH_SIZE)
+    parser.add_argument(
+        "--max-delay-ms",
+        type=float,
+        default=MAX_BATCH_DELAY * 1000,
+        help="Max time the first request waits for other requests to merge with.",
+    )
+    return parser.parse_args(args)
+
+
+def main(args: Optional[List[str]] = None):
+    import uvicorn
+
+    args = parse_args(args)
+    server = ModelServer(args.device, args.backend, args.max_batch_size, args.max_delay_ms / 1000)
+    sly.logger.info(
+        f"Model server is starting on {args.host}:{args.port}, device: {args.device}, "
+        f"backend: {args.backend}, max batch size: {args.max_batch_size}."
+    )
+    uvicorn.run(create_app(server), host=args.host, port=args.port)
+
+
+if __name__ == "__main__":
+    main()
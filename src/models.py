@@ -0,0 +1,62 @@
+"""List of available models. It doesn't depend on the app environment, so the model server
+resolves the model files by the model name and pretrained tag from it too."""
+
+from typing import Dict
+
+MODELS = {
+    ("ViT-L-14", "openai", "75.5%", "0.933 GB"): {
+        "url": "https://openaipublic.azureedge.net/clip/models/b8cca3fd41ae0c99ba7e8951adf17d267cdb84cd88be6f7c2e0eca1737a03836/ViT-L-14.pt",
+        "path": "clip/ViT-L-14.pt",
+    },
+    ("coca_ViT-L-14", "mscoco_finetuned_laion2B-s13B-b90k", "-", "2.55 GB"): {
+        "url": "https://huggingface.co/laion/mscoco_finetuned_CoCa-ViT-L-14-laion2B-s13B-b90k/resolve/main/open_clip_pytorch_model.bin",
+        "path": "huggingface/hub/models--laion--mscoco_finetuned_CoCa-ViT-L-14-laion2B-s13B-b90k/blobs/f22c34acef2b7a5d1ed28982a21077de651363eaaebcf34a3f10676e17837cb8",
+    },
+    ("coca_ViT-L-14", "laion2B-s13B-b90k", "75.5%", "2.55 GB"): {
+        "url": "https://huggingface.co/laion/CoCa-ViT-L-14-laion2B-s13B-b90k/resolve/main/open_clip_pytorch_model.bin",
+        "path": "huggingface/hub/models--laion--CoCa-ViT-L-14-laion2B-s13B-b90k/blobs/73725652298ad76ed2162caffdae96d8653a05d7a29b6281103e4df81d0ff8ea",
+    },
+    ("ViT-L-14", "laion2b_s32b_b82k", "75.3%", "0.933 GB"): {
+        "url": "https://huggingface.co/laion/CLIP-ViT-L-14-laion2B-s32B-b82K/resolve/main/open_clip_pytorch_model.bin",
+        "path": "huggingface/hub/models--laion--CLIP-ViT-L-14-laion2B-s32B-b82K/blobs/5ddb47339f44e4fd9cace3d3960d38af1b51a25857440cfae90afc44706d7e2b",
+    },
+    ("ViT-L-14-336", "openai", "-", "0.933 GB"): {
+        "url": "https://openaipublic.azureedge.net/clip/models/3035c92b350959924f9f00213499208652fc7ea050643e8b385c2dac08641f02/ViT-L-14-336px.pt",
+        "path": "clip/ViT-L-14-336px.pt",
+    },
+    ("ViT-g-14", "laion2b_s34b_b88k", "78.5%", "5.47 GB"): {
+        "url": "https://huggingface.co/laion/CLIP-ViT-g-14-laion2B-s34B-b88K/resolve/main/open_clip_pytorch_model.bin",
+        "path": "huggingface/hub/models--laion--CLIP-ViT-g-14-laion2B-s34B-b88K/blobs/9ef136f407986fb607cd37a823eba38a3b6f95e8ec702b3d1687252985d84750",
+    },
+    ("ViT-bigG-14", "laion2b_s39b_b160k", "80.1%", "10.2 GB"): {
+        "url": "https://huggingface.co/laion/CLIP-ViT-bigG-14-laion2B-39B-b160k/resolve/main/open_clip_pytorch_model.bin",
+        "path": "huggingface/hub/models--laion--CLIP-ViT-bigG-14-laion2B-39B-b160k/blobs/0d5318839ad03607c48055c45897c655a14c0276a79f6b867934ddd073760e39",
+    },
+    ("convnext_base_w", "laion2b_s13b_b82k_augreg", "71.5%", "0.718 GB"): {
+        "url": "https://huggingface.co/laion/CLIP-convnext_base_w-laion2B-s13B-b82K-augreg/resolve/main/open_clip_pytorch_model.bin",
+        "path": "huggingface/hub/models--laion--CLIP-convnext_base_w-laion2B-s13B-b82K-augreg/blobs/249e2302c1670bb04476792196f788ff046fedef61191a24983e61b6eca56987",
+    },
+    ("convnext_large_d_320", "laion2b_s29b_b131k_ft_soup", "76.9%", "1.41 GB"): {
+        "url": "https://huggingface.co/laion/CLIP-convnext_large_d_320.laion2B-s29B-b131K-ft-soup/resolve/main/open_clip_pytorch_model.bin",
+        "path": "huggingface/hub/models--laion--CLIP-convnext_large_d_320.laion2B-s29B-b131K-ft-soup/blobs/4572137af44b2e26f01f638337a59688ec289e9363e15c08dde16640afb86988",
+    },
+}
+
+
+def get_model_data(model_name: str, pretrained: str) -> Dict:
+    """Returns the data of the model from the list of available models.
+
+    Args:
+        model_name (str): name of the model.
+        pretrained (str): pretrained tag of the model.
+
+    Raises:
+        ValueError: if the model isn't in the list of available models.
+
+    Returns:
+        Dict: url and path of the model checkpoint.
+    """
+    for (name, tag, *_), model_data in MODELS.items():
+        if name == model_name and tag == pretrained:
+            return model_data
+    raise ValueError(f"Model {model_name} ({pretrained}) is not in the list of available models.")
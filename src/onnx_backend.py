@@ -0,0 +1,238 @@
+import os
+import shutil
+import tempfile
+
+from contextlib import contextmanager
+from typing import Iterator
+
+import numpy as np
+import torch
+
+import supervisely as sly
+
+# Opset with support of all the operations used in the image and text towers.
+ONNX_OPSET = 14
+
+# Number of random images and prompts used to check the exported model against the original one.
+VERIFICATION_IMAGES = 32
+VERIFICATION_TOP_K = 5
+
+
+class ImageEncoder(torch.nn.Module):
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    def forward(self, images):
+        return self.model.encode_image(images)
+
+
+class TextEncoder(torch.nn.Module):
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    def forward(self, text):
+        return self.model.encode_text(text)
+
+
+class OnnxModel:
+    """Runs the image and text towers of the model with ONNX Runtime. Has the same encode_image
+    and encode_text methods as the CLIP model, so it can be used instead of it in clip_api.
+
+    Args:
+        image_path (str): path to the exported image tower.
+        text_path (str): path to the exported text tower.
+        device (str): device to run the model on.
+    """
+
+    def __init__(self, image_path: str, text_path: str, device: str):
+        import onnxruntime as ort
+
+        providers = ["CPUExecutionProvider"]
+        if device == "cuda" and "CUDAExecutionProvider" in ort.get_available_providers():
+            providers.insert(0, "CUDAExecutionProvider")
+
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+
+        self.image_session = ort.InferenceSession(image_path, options, providers=providers)
+        self.text_session = ort.InferenceSession(text_path, options, providers=providers)
+        self.size = get_onnx_size(image_path) + get_onnx_size(text_path)
+
+        sly.logger.info(f"ONNX Runtime sessions were created with providers: {providers}.")
+
+    def encode_image(self, images: torch.Tensor) -> torch.Tensor:
+        features = self.image_session.run(None, {"images": images.cpu().numpy()})[0]
+        return torch.from_numpy(features)
+
+    def encode_text(self, text: torch.Tensor) -> torch.Tensor:
+        features = self.text_session.run(None, {"text": text.cpu().numpy()})[0]
+        return torch.from_numpy(features)
+
+
+def build_onnx_model(
+    model, tokenizer, input_size: int, model_dir: str, device: str, quantize: bool = False
+) -> OnnxModel:
+    """Exports the image and text towers of the model to ONNX (if they aren't exported yet),
+    quantizes the weights to int8 if needed and creates ONNX Runtime sessions for them.
+    Exported models are cached in the model directory.
+
+    Args:
+        model: the PyTorch model in eager mode.
+        tokenizer: tokenizer of the model.
+        input_size (int): input size of the model.
+        model_dir (str): directory to cache the exported models.
+        device (str): device to run the model on.
+        quantize (bool, optional): whether to quantize the weights to int8. Defaults to False.
+
+    Returns:
+        OnnxModel: the model running with ONNX Runtime.
+    """
+    try:
+        import onnxruntime  # noqa: F401
+    except ImportError:
+        raise RuntimeError(
+            "ONNX Runtime backend requires onnx and onnxruntime packages to be installed."
+        )
+
+    sly.fs.mkdir(model_dir)
+    image_path = os.path.join(model_dir, "image.onnx")
+    text_path = os.path.join(model_dir, "text.onnx")
+
+    model = model.float().cpu().eval()
+    dummy_images = torch.randn(1, 3, input_size, input_size)
+    dummy_text = tokenizer(["a photo"])
+
+    if not os.path.exists(image_path):
+        sly.logger.info(f"Exporting the image tower to ONNX: {image_path}.")
+        export(ImageEncoder(model), dummy_images, image_path, "images")
+    if not os.path.exists(text_path):
+        sly.logger.info(f"Exporting the text tower to ONNX: {text_path}.")
+        export(TextEncoder(model), dummy_text, text_path, "text")
+
+    if quantize:
+        image_path = quantize_model(image_path)
+        text_path = quantize_model(text_path)
+
+    return OnnxModel(image_path, text_path, device)
+
+
+def export(encoder: torch.nn.Module, dummy_input: torch.Tensor, path: str, input_name: str):
+    with torch.no_grad(), atomic_output(path) as temp_path:
+        torch.onnx.export(
+            encoder,
+            dummy_input,
+            temp_path,
+            input_names=[input_name],
+            output_names=["features"],
+            dynamic_axes={input_name: {0: "batch"}, "features": {0: "batch"}},
+            opset_version=ONNX_OPSET,
+        )
+
+
+def quantize_model(path: str) -> str:
+    """Quantizes the weights of the exported model to int8 (activations are quantized
+    dynamically during inference). The quantized model is cached next to the original one.
+
+    Args:
+        path (str): path to the exported model.
+
+    Returns:
+        str: path to the quantized model.
+    """
+    from onnxruntime.quantization import QuantType, quantize_dynamic
+
+    quantized_path = path.replace(".onnx", ".int8.onnx")
+    if not os.path.exists(quantized_path):
+        sly.logger.info(f"Quantizing {path} to int8.")
+        with atomic_output(quantized_path) as temp_path:
+            quantize_dynamic(
+                path,
+                temp_path,
+                weight_type=QuantType.QInt8,
+                use_external_data_format=get_onnx_size(path) > 2 * 1024**3,
+            )
+    return quantized_path
+
+
+@contextmanager
+def atomic_output(path: str) -> Iterator[str]:
+    """Yields the path with the same file name in a temporary directory next to the given path.
+    After the block the written files are moved to the directory of the path, the model file
+    last, so an interrupted or failed export never leaves a truncated model in the cache.
+    External data files keep their names, so the references in the model stay valid.
+
+    Args:
+        path (str): final path of the model.
+    """
+    directory, name = os.path.split(path)
+    temp_dir = tempfile.mkdtemp(dir=directory, prefix=".tmp_")
+    try:
+        temp_path = os.path.join(temp_dir, name)
+        yield temp_path
+        for file_name in os.listdir(temp_dir):
+            if file_name != name:
+                os.replace(os.path.join(temp_dir, file_name), os.path.join(directory, file_name))
+        os.replace(temp_path, path)
+    finally:
+        shutil.rmtree(temp_dir, ignore_errors=True)
+
+
+def verify(model, onnx_model: OnnxModel, tokenizer, input_size: int) -> float:
+    """Compares the rankings of random images produced by the PyTorch and ONNX models for a few
+    prompts and returns the mean overlap of their top-k images. Used by the tests, so the
+    export doesn't run extra inference on each build.
+
+    Args:
+        model: the PyTorch model.
+        onnx_model (OnnxModel): the ONNX model.
+        tokenizer: tokenizer of the model.
+        input_size (int): input size of the model.
+
+    Returns:
+        float: mean top-k overlap in range from 0 to 1.
+    """
+    images = torch.randn(VERIFICATION_IMAGES, 3, input_size, input_size)
+    text = tokenizer(["a photo of a cat", "a photo of a car", "a diagram"])
+
+    scores = []
+    for encoder in (model, onnx_model):
+        with torch.no_grad():
+            image_features = encoder.encode_image(images).float()
+            text_features = encoder.encode_text(text).float()
+        image_features /= image_features.norm(dim=-1, keepdim=True)
+        text_features /= text_features.norm(dim=-1, keepdim=True)
+        scores.append((image_features @ text_features.T).numpy())
+
+    overlaps = [
+        topk_overlap(scores[0][:, i], scores[1][:, i], VERIFICATION_TOP_K)
+        for i in range(scores[0].shape[1])
+    ]
+    sly.logger.info(
+        f"Top-{VERIFICATION_TOP_K} overlap of the ONNX model with the PyTorch model: "
+        f"{np.mean(overlaps):.2%}, max score difference: {np.abs(scores[0] - scores[1]).max():.4f}."
+    )
+    return float(np.mean(overlaps))
+
+
+def topk_overlap(scores: np.ndarray, reference_scores: np.ndarray, k: int) -> float:
+    """Returns the share of the top-k items by reference scores, which are also in the top-k
+    items by the scores.
+
+    Args:
+        scores (np.ndarray): scores to check.
+        reference_scores (np.ndarray): reference scores.
+        k (int): number of top items.
+
+    Returns:
+        float: overlap in range from 0 to 1.
+    """
+    k = min(k, len(scores))
+    top = np.argpartition(-scores, k - 1)[:k]
+    reference_top = np.argpartition(-reference_scores, k - 1)[:k]
+    return len(np.intersect1d(top, reference_top)) / k
+
+
+def get_onnx_size(path: str) -> int:
+    return os.path.getsize(path)
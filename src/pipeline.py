@@ -0,0 +1,108 @@
+import queue
+import threading
+
+from typing import Any, Callable, Iterable, Iterator, List, Optional
+
+import supervisely as sly
+
+# Timeout in seconds for the queue operations, so the stages can check if the pipeline was stopped.
+QUEUE_TIMEOUT = 0.1
+
+# Marks the end of the stream of items in the queue.
+_END = object()
+
+
+class _Failure:
+    """Wraps the exception raised in one of the stages to pass it to the consumer."""
+
+    def __init__(self, exception: Exception):
+        self.exception = exception
+
+
+def run_pipeline(
+    items: Iterable,
+    stages: List[Callable],
+    prefetch: int = 2,
+    queues_cb: Optional[Callable[[List[int]], None]] = None,
+) -> Iterator[Any]:
+    """Runs each stage in a separate thread, connecting the stages with bounded queues, so the
+    stages work on different items at the same time (e.g. the next batch is downloaded while
+    the current one is decoded and the previous one is in the model). Items from the iterable
+    are passed through all stages in order and the results of the last stage are yielded.
+    If one of the stages raises an exception, it's re-raised in the consumer. If the consumer
+    stops iterating, all stages are stopped after the current items.
+
+    Args:
+        items (Iterable): items for the first stage. The iterable is consumed in the stage thread.
+        stages (List[Callable]): functions, which take the result of the previous stage.
+        prefetch (int, optional): max number of ready items between two stages. Defaults to 2.
+        queues_cb (Optional[Callable[[List[int]], None]], optional): function, which takes the
+            number of ready items after each stage, called before each item is taken by the
+            consumer. Defaults to None.
+
+    Yields:
+        Iterator[Any]: results of the last stage in the same order as the items.
+    """
+    stop_event = threading.Event()
+    queues = [queue.Queue(maxsize=max(prefetch, 1)) for _ in stages]
+
+    def put(target: queue.Queue, item: Any) -> bool:
+        while not stop_event.is_set():
+            try:
+                target.put(item, timeout=QUEUE_TIMEOUT)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def read(index: int) -> Iterator[Any]:
+        if index == 0:
+            yield from items
+            return
+
+        source = queues[index - 1]
+        while not stop_event.is_set():
+            try:
+                item = source.get(timeout=QUEUE_TIMEOUT)
+            except queue.Empty:
+                continue
+            if item is _END:
+                return
+            yield item
+
+    def work(index: int, stage: Callable):
+        target = queues[index]
+        try:
+            for item in read(index):
+                if isinstance(item, _Failure):
+                    put(target, item)
+                    return
+                if stop_event.is_set() or not put(target, stage(item)):
+                    return
+        except Exception as e:
+            sly.logger.debug(f"Pipeline stage {index} failed: {e}")
+            put(target, _Failure(e))
+            return
+        put(target, _END)
+
+    threads = [
+        threading.Thread(target=work, args=(index, stage), daemon=True)
+        for index, stage in enumerate(stages)
+    ]
+    for thread in threads:
+        thread.start()
+
+    try:
+        while True:
+            if queues_cb is not None:
+                queues_cb([target.qsize() for target in queues])
+            item = queues[-1].get()
+            if item is _END:
+                break
+            if isinstance(item, _Failure):
+                raise item.exception
+            yield item
+    finally:
+        stop_event.set()
+        for thread in threads:
+            thread.join()
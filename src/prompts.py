@@ -0,0 +1,129 @@
+from typing import List, NamedTuple, Tuple
+
+# Separator of the prompt and its weight in the text input, e.g. "a photo of a dog | 2".
+WEIGHT_SEPARATOR = "|"
+# Placeholder for the prompt in the templates, e.g. "a photo of {}".
+TEMPLATE_PLACEHOLDER = "{}"
+
+
+class Prompt(NamedTuple):
+    text: str
+    weight: float = 1.0
+
+
+class PromptQuery(NamedTuple):
+    """Positive and negative prompts with weights and templates, which are scored against the
+    same image embeddings. Each prompt is expanded with all the templates and the similarities
+    to the expanded prompts are averaged. The score of the image is the weighted sum of the
+    similarities to the positive prompts minus the weighted sum of the similarities to the
+    negative prompts, the weights are normalized by the total weight of the positive prompts.
+    Example images are positive items with weight 1, scored by image-image similarity.
+
+    Args:
+        positive (List[Prompt]): prompts, which should be present in the images.
+        negative (List[Prompt], optional): prompts, which shouldn't be present in the images.
+        templates (List[str], optional): templates with {} placeholder for the prompts.
+        examples (List[int], optional): IDs of the example images to find similar images.
+    """
+
+    positive: List[Prompt]
+    negative: List[Prompt] = []
+    templates: List[str] = []
+    examples: List[int] = []
+
+    def total_weight(self) -> float:
+        """Returns the total weight of the positive prompts and example images."""
+        return sum(prompt.weight for prompt in self.positive) + len(self.examples) or 1.0
+
+    def example_weights(self) -> List[float]:
+        """Returns the weights of the example images for calculate_scores."""
+        return [1.0 / self.total_weight()] * len(self.examples)
+
+    def expand(self) -> Tuple[List[str], List[float]]:
+        """Returns the texts of the expanded prompts and their weights for calculate_scores."""
+        total_weight = self.total_weight()
+
+        texts, weights = [], []
+        for prompts, sign in ((self.positive, 1.0), (self.negative, -1.0)):
+            for prompt in prompts:
+                expanded_texts = apply_templates(prompt.text, self.templates)
+                texts.extend(expanded_texts)
+                weights.extend(
+                    [sign * prompt.weight / total_weight / len(expanded_texts)]
+                    * len(expanded_texts)
+                )
+        return texts, weights
+
+    def label(self) -> str:
+        """Returns the short description of the query for logs, names and tags."""
+        label = ", ".join(format_prompt(prompt) for prompt in self.positive)
+        if self.examples:
+            examples = f"like {len(self.examples)} example image" + "s" * (len(self.examples) > 1)
+            label = f"{label}, {examples}" if label else examples
+        if self.negative:
+            label += " without " + ", ".join(format_prompt(prompt) for prompt in self.negative)
+        return label
+
+    def key(self) -> str:
+        """Returns the key, which identifies the query with all its weights and templates."""
+        key = (list(self.positive), list(self.negative), list(self.templates))
+        if self.examples:
+            key += (sorted(self.examples),)
+        return repr(key)
+
+
+def parse_prompts(text: str) -> List[Prompt]:
+    """Parses prompts from the text with one prompt per line and optional weight after the
+    separator, e.g. "a photo of a dog | 2". Empty lines are skipped.
+
+    Args:
+        text (str): prompts, one per line.
+
+    Returns:
+        List[Prompt]: parsed prompts.
+    """
+    prompts = []
+    for line in (text or "").splitlines():
+        prompt, separator, weight = line.rpartition(WEIGHT_SEPARATOR)
+        if not separator:
+            prompt, weight = weight, ""
+        prompt = prompt.strip()
+        if not prompt:
+            continue
+        try:
+            prompts.append(Prompt(prompt, float(weight) if weight.strip() else 1.0))
+        except ValueError:
+            # The separator is a part of the prompt, not a weight.
+            prompts.append(Prompt(line.strip()))
+    return prompts
+
+
+def parse_templates(text: str) -> List[str]:
+    """Parses templates from the text with one template per line. Lines without the {} placeholder
+    are skipped."""
+    return [
+        line.strip() for line in (text or "").splitlines() if TEMPLATE_PLACEHOLDER in line.strip()
+    ]
+
+
+def apply_templates(text: str, templates: List[str]) -> List[str]:
+    """Returns the text inserted into each template or the text itself if there are no templates."""
+    if not templates:
+        return [text]
+    return [template.replace(TEMPLATE_PLACEHOLDER, text) for template in templates]
+
+
+def parse_image_ids(text: str) -> List[int]:
+    """Parses image IDs separated by commas, spaces or new lines. Other tokens are skipped."""
+    tokens = (text or "").replace(",", " ").split()
+    image_ids = []
+    for token in tokens:
+        if token.isdigit() and int(token) not in image_ids:
+            image_ids.append(int(token))
+    return image_ids
+
+
+def format_prompt(prompt: Prompt) -> str:
+    if prompt.weight == 1.0:
+        return prompt.text
+    return f"{prompt.text} ({prompt.weight:g})"
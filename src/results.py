@@ -0,0 +1,103 @@
+import hashlib
+import os
+
+from typing import List, Optional, Tuple
+
+import numpy as np
+import supervisely as sly
+
+
+class RunResults:
+    """Scores of all the images in the dataset from the last run with the same model and prompt.
+    Used in incremental mode: the scores of unchanged images are reused and only new or changed
+    images are inferred.
+
+    Args:
+        ids (np.ndarray): image ids with shape (n,).
+        fingerprints (np.ndarray): image fingerprints at the moment of the run with shape (n,).
+        scores (np.ndarray): scores of the images with shape (n,).
+    """
+
+    def __init__(self, ids: np.ndarray, fingerprints: np.ndarray, scores: np.ndarray):
+        self.ids = ids
+        self.fingerprints = fingerprints
+        self.scores = scores
+
+    @classmethod
+    def from_image_infos(
+        cls, image_infos: List[sly.ImageInfo], ids: np.ndarray, scores: np.ndarray
+    ) -> "RunResults":
+        """Creates the results from the scores of the images with the given ids."""
+        image_infos_by_id = {image_info.id: image_info for image_info in image_infos}
+        fingerprints = np.array(
+            [result_fingerprint(image_infos_by_id[image_id]) for image_id in ids.tolist()]
+        )
+        return cls(ids, fingerprints, scores)
+
+    def split(
+        self, image_infos: List[sly.ImageInfo]
+    ) -> Tuple[np.ndarray, np.ndarray, List[sly.ImageInfo]]:
+        """Splits the current images of the dataset into unchanged images with known scores and
+        new or changed images, which should be inferred. Removed images are dropped.
+
+        Args:
+            image_infos (List[sly.ImageInfo]): current infos of the images in the dataset.
+
+        Returns:
+            Tuple[np.ndarray, np.ndarray, List[sly.ImageInfo]]: ids and scores of the unchanged
+                images and infos of the new or changed images.
+        """
+        known = {
+            image_id: (fingerprint, index)
+            for index, (image_id, fingerprint) in enumerate(
+                zip(self.ids.tolist(), self.fingerprints.tolist())
+            )
+        }
+
+        indexes, changed_image_infos = [], []
+        for image_info in image_infos:
+            fingerprint, index = known.get(image_info.id, (None, None))
+            if fingerprint is not None and fingerprint == result_fingerprint(image_info):
+                indexes.append(index)
+            else:
+                changed_image_infos.append(image_info)
+
+        indexes = np.array(indexes, dtype=np.int64)
+        return self.ids[indexes], self.scores[indexes], changed_image_infos
+
+    def save(self, path: str):
+        sly.fs.mkdir(os.path.dirname(path))
+        # Writing to a temporary file first, so the baseline isn't corrupted if the app is stopped.
+        temp_path = f"{path}.tmp.npz"
+        np.savez(temp_path, ids=self.ids, fingerprints=self.fingerprints, scores=self.scores)
+        os.replace(temp_path, path)
+        sly.logger.info(f"Scores of {len(self.ids)} images were saved to {path}.")
+
+    @classmethod
+    def load(cls, path: str) -> Optional["RunResults"]:
+        if not os.path.exists(path):
+            sly.logger.debug(f"Results of the last run weren't found in {path}.")
+            return None
+        with np.load(path) as data:
+            return cls(data["ids"], data["fingerprints"], data["scores"])
+
+
+def result_fingerprint(image_info: sly.ImageInfo) -> str:
+    """Returns the fingerprint of the image, which changes when the image or its info is updated."""
+    return f"{image_info.hash}:{image_info.updated_at}"
+
+
+def get_results_path(
+    results_dir: str,
+    datasets_key: str,
+    model_name: str,
+    pretrained: str,
+    variant: str,
+    query_key: str,
+) -> str:
+    """Returns the path to the results of the datasets for the model and the query. The query key
+    (e.g. text prompt) is hashed, so it can contain any characters."""
+    query_hash = hashlib.md5(query_key.encode("utf-8")).hexdigest()
+    return os.path.join(
+        results_dir, f"{datasets_key}_{model_name}_{pretrained}_{variant}_{query_hash}.npz"
+    )
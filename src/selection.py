@@ -0,0 +1,108 @@
+from typing import List, Tuple
+
+import numpy as np
+
+# Top-k selector buffers up to k * factor candidates before pruning them back to k.
+TOP_K_BUFFER_FACTOR = 2
+
+
+class ScoreCollector:
+    """Collects the scores of all the images as the batches arrive."""
+
+    def __init__(self):
+        self._ids: List[np.ndarray] = []
+        self._scores: List[np.ndarray] = []
+
+    def update(self, ids: np.ndarray, scores: np.ndarray):
+        self._ids.append(ids)
+        self._scores.append(scores)
+
+    def result(self) -> Tuple[np.ndarray, np.ndarray]:
+        """Returns the ids and scores of all the images in the order of arrival."""
+        return concatenate(self._ids, np.int64), concatenate(self._scores, np.float32)
+
+
+class TopKSelector:
+    """Keeps only the k images with the highest scores as the batches arrive, so the memory
+    doesn't grow with the dataset. The candidates are pruned with vectorized partial sort
+    when the buffer exceeds the bounded size.
+
+    Args:
+        k (int): number of images to keep.
+    """
+
+    def __init__(self, k: int):
+        self.k = k
+        self._ids = np.empty(0, dtype=np.int64)
+        self._scores = np.empty(0, dtype=np.float32)
+
+    def update(self, ids: np.ndarray, scores: np.ndarray):
+        self._ids = np.concatenate([self._ids, ids])
+        self._scores = np.concatenate([self._scores, scores])
+
+        if len(self._scores) > self.k * TOP_K_BUFFER_FACTOR:
+            self._prune()
+
+    def result(self) -> Tuple[np.ndarray, np.ndarray]:
+        """Returns the ids and scores of the top-k images in descending order of scores."""
+        self._prune()
+        order = np.argsort(-self._scores, kind="stable")
+        return self._ids[order], self._scores[order]
+
+    def _prune(self):
+        if len(self._scores) <= self.k:
+            return
+        top = np.argpartition(-self._scores, self.k - 1)[: self.k]
+        self._ids = self._ids[top]
+        self._scores = self._scores[top]
+
+
+class ThresholdSelector:
+    """Keeps only the images with scores above or below the threshold as the batches arrive.
+
+    Args:
+        threshold (float): threshold for the scores.
+        method (str): "above threshold" or "below threshold".
+    """
+
+    def __init__(self, threshold: float, method: str):
+        self.threshold = threshold
+        self.method = method
+        self._ids: List[np.ndarray] = []
+        self._scores: List[np.ndarray] = []
+
+    def update(self, ids: np.ndarray, scores: np.ndarray):
+        mask = filter_mask(scores, self.threshold, self.method)
+        self._ids.append(ids[mask])
+        self._scores.append(scores[mask])
+
+    def result(self) -> Tuple[np.ndarray, np.ndarray]:
+        """Returns the ids and scores of the selected images in descending order of scores."""
+        ids = concatenate(self._ids, np.int64)
+        scores = concatenate(self._scores, np.float32)
+        order = np.argsort(-scores, kind="stable")
+        return ids[order], scores[order]
+
+
+def filter_mask(scores: np.ndarray, threshold: float, method: str) -> np.ndarray:
+    """Returns the boolean mask of the scores, which pass the threshold filter.
+
+    Args:
+        scores (np.ndarray): scores of the images.
+        threshold (float): threshold for the scores.
+        method (str): "above threshold" or "below threshold".
+
+    Returns:
+        np.ndarray: boolean mask with the same shape as scores.
+    """
+    if method == "above threshold":
+        return scores >= threshold
+    elif method == "below threshold":
+        return scores <= threshold
+    raise ValueError(f"Unknown filter method: {method}")
+
+
+def concatenate(arrays: List[np.ndarray], dtype) -> np.ndarray:
+    if not arrays:
+        return np.empty(0, dtype=dtype)
+    return np.concatenate(arrays).astype(dtype, copy=False)
@@ -1,30 +1,119 @@
-import io
-import os
-
-from typing import Dict
-
 import numpy as np
 import supervisely as sly
 
-from supervisely.app.widgets import Card, Input, Field, Container, Progress, Button, Text, Flexbox
+from supervisely.app.widgets import (
+    Card,
+    TextArea,
+    Field,
+    Container,
+    Progress,
+    Button,
+    Text,
+    Flexbox,
+    RadioGroup,
+    InputNumber,
+    Checkbox,
+    Input,
+)
 
 import src.globals as g
-import src.clip_api as clip_api
+import src.engine as engine
+import src.metrics as metrics
+from src.jobs import AsyncProgress, BackgroundJob
+from src.prompts import PromptQuery, parse_image_ids, parse_prompts, parse_templates
 import src.ui.input as input
 import src.ui.settings as settings
 import src.ui.preview as preview
 import src.ui.output as output
 
 # Field with text prompt input for filtering.
-text_prompt_input = Input(minlength=1, placeholder="Enter the text prompt here...")
+text_prompt_input = TextArea(placeholder="Enter the text prompt here...", rows=2)
 text_prompt_field = Field(
     title="Text prompt",
-    description="Enter the text prompt for inference.",
+    description=(
+        "Enter the text prompt for inference. To score images by several prompts at once, "
+        "enter one prompt per line with optional weight after the separator, "
+        "e.g. 'a photo of a dog | 2'."
+    ),
     content=text_prompt_input,
 )
 
+# Field with negative prompts and templates for the prompts.
+negative_prompts_input = TextArea(placeholder="Optional, one prompt per line...", rows=2)
+templates_input = TextArea(placeholder="Optional, e.g. a photo of {}", rows=2)
+prompt_options_field = Field(
+    title="Negative prompts and templates",
+    description=(
+        "Similarities to the negative prompts are subtracted from the scores. "
+        "Each prompt is inserted into each template instead of {} and the similarities "
+        "to the resulting prompts are averaged. All prompts are scored in a single pass."
+    ),
+    content=Container(widgets=[negative_prompts_input, templates_input]),
+)
+
+# Field with example images: the images are ranked by the similarity to the examples.
+examples_input = Input(placeholder="Optional, image IDs separated by commas...")
+examples_field = Field(
+    title="Example images",
+    description=(
+        "Find images similar to the examples alongside or instead of the text prompt. "
+        "Click the 'EXAMPLE' button in the preview table to add the image. Embeddings of the "
+        "images encoded by the previous runs are reused, so the search doesn't need new inference."
+    ),
+    content=examples_input,
+)
+
+# Field with search mode: scoring all images or retrieving top-k images by the index.
+search_mode_radio = RadioGroup(
+    items=[RadioGroup.Item(value=mode, label=label) for mode, label in g.SEARCH_MODES.items()]
+)
+top_k_input = InputNumber(value=g.TOP_K, min=1, max=100000)
+exact_search_checkbox = Checkbox("Exact search (scan all embeddings instead of the index)")
+top_k_container = Container(widgets=[top_k_input, exact_search_checkbox])
+top_k_container.hide()
+threshold_input = InputNumber(value=0.25, min=0.0, max=1.0, step=0.001)
+threshold_method_radio = RadioGroup(
+    items=[RadioGroup.Item(value=method, label=method.capitalize()) for method in g.FILTER_METHODS]
+)
+threshold_container = Container(widgets=[threshold_input, threshold_method_radio])
+threshold_container.hide()
+duplicate_threshold_input = InputNumber(value=g.DUPLICATE_THRESHOLD, min=0.0, max=1.0, step=0.005)
+exact_duplicates_checkbox = Checkbox("Exact search (compare all pairs instead of the index)")
+duplicates_container = Container(widgets=[duplicate_threshold_input, exact_duplicates_checkbox])
+duplicates_container.hide()
+search_mode_field = Field(
+    title="Search mode",
+    description=(
+        "Score all images in the dataset, retrieve only top-K images most relevant to the prompt "
+        "or keep only images with scores above or below the threshold. "
+        "Top-K search uses the approximate nearest neighbour index over stored embeddings, "
+        "which is built on the first run and answers the next prompts in milliseconds. "
+        "Top-K and threshold modes select images on the fly and don't keep all scores in memory. "
+        "Near-duplicates mode groups the images with the similarity of embeddings above "
+        "the threshold and keeps the image with the highest score (or the largest image "
+        "if no prompt is entered) from each group, the prompt is optional in this mode."
+    ),
+    content=Container(
+        widgets=[search_mode_radio, top_k_container, threshold_container, duplicates_container]
+    ),
+)
+
+# Field with incremental mode: reusing the scores of unchanged images from the last run.
+incremental_checkbox = Checkbox("Reuse scores of unchanged images from the last run")
+incremental_field = Field(
+    title="Incremental mode",
+    description=(
+        "Compare the images in the dataset with the last run of the selected model with the same "
+        "prompt and infer only new or changed images. Scores of all images are saved after each "
+        "run, except the search in the index and the duplicates search."
+    ),
+    content=incremental_checkbox,
+)
+
 # Message if no text prompt was entered.
-text_prompt_message = Text(text="Please, enter the text prompt for inference.", status="error")
+text_prompt_message = Text(
+    text="Please, enter the text prompt or example images for inference.", status="error"
+)
 text_prompt_message.hide()
 
 # Flexbox for start and cancel inference buttons.
@@ -43,6 +132,13 @@ inference_progress.hide()
 inference_message = Text()
 inference_message.hide()
 
+# Timings of the stages of the inference loop and depths of the queues between them.
+metrics_message = Text(status="info")
+metrics_message.hide()
+
+# Inference runs in the background, so the app keeps serving the UI while it's running.
+inference_job = BackgroundJob("inference")
+
 # Card with all module widgets.
 card = Card(
     title="3️⃣ Inference",
@@ -50,10 +146,15 @@ card = Card(
     content=Container(
         widgets=[
             text_prompt_field,
+            prompt_options_field,
+            examples_field,
+            search_mode_field,
+            incremental_field,
             text_prompt_message,
             buttons_flexbox,
             inference_progress,
             inference_message,
+            metrics_message,
         ]
     ),
     lock_message="Select the dataset on step 1️⃣.",
@@ -63,21 +164,33 @@ card.lock()
 
 @start_inference_button.click
 def start_inference():
-    """Reads all parameters from UI, loads images from selected dataset, runs inference,
-    updates UI with inference results and saves inference results to the state."""
+    """Reads all parameters from UI and starts inference on the selected datasets in the
+    background job. Returns immediately, the UI is updated by the job."""
+    if inference_job.running:
+        sly.logger.debug("Start inference button was clicked, but inference is already running.")
+        return
+
     inference_message.hide()
+    metrics_message.hide()
 
-    text_prompt = text_prompt_input.get_value()
-    if not text_prompt:
-        # Show message if no text prompt was entered.
+    query = PromptQuery(
+        positive=parse_prompts(text_prompt_input.get_value()),
+        negative=parse_prompts(negative_prompts_input.get_value()),
+        templates=parse_templates(templates_input.get_value()),
+        examples=parse_image_ids(examples_input.get_value()),
+    )
+    search_mode = search_mode_radio.get_value()
+    if not query.positive and not query.examples and search_mode != "duplicates":
+        # Show message if no text prompt or example images were entered.
 
         text_prompt_message.show()
 
-        sly.logger.debug("Start inference button was clicked, but no text prompt was entered.")
+        sly.logger.debug(
+            "Start inference button was clicked, but no text prompt or examples were entered."
+        )
 
         return
 
-    g.STATE.continue_inference = True
     inference_message.text = (
         "Preparing the model, it may take some time. Check the logs for more details."
     )
@@ -87,6 +200,7 @@ def start_inference():
     # Changing UI state.
     text_prompt_message.hide()
     preview.table.hide()
+    preview.datasets_table.hide()
     preview.image_preview.hide()
     preview.card.lock()
     preview.rows.clear()
@@ -94,20 +208,38 @@ def start_inference():
 
     inference_progress.show()
     start_inference_button.text = "Preparing..."
+    start_inference_button.disable()
 
     # Getting selected model parameters.
     selected_model = tuple(settings.model_radio_table.get_selected_row())
     model_name, pretrained = selected_model[:2]
     sly.logger.debug(f"Selected model: {selected_model}.")
-    model_data: Dict = g.MODELS[selected_model]
-    sly.logger.debug(f"Retrieved model data: {model_data}.")
 
-    batch_size = settings.batch_size_input.get_value()
-    jit = settings.jit_checkbox.is_checked()
-
-    sly.logger.info(
-        f"Starting inference with model: {model_name}, batch size: {batch_size}, JIT: {jit}. Text prompt: {text_prompt}"
+    params = engine.InferenceParams(
+        model_name=model_name,
+        pretrained=pretrained,
+        batch_size=settings.batch_size_input.get_value(),
+        auto_batch_size=settings.auto_batch_size_checkbox.is_checked(),
+        prefetch=settings.prefetch_input.get_value(),
+        decode_workers=settings.decode_workers_input.get_value(),
+        decode_mode=settings.decode_mode_radio.get_value(),
+        image_source=settings.image_source_radio.get_value(),
+        execution_mode=settings.execution_mode_radio.get_value(),
+        backend=settings.backend_radio.get_value(),
+        device=engine.get_device(settings.backend_radio.get_value()),
+        search_mode=search_mode,
+        top_k=top_k_input.get_value(),
+        exact_search=(
+            exact_duplicates_checkbox.is_checked()
+            if search_mode == "duplicates"
+            else exact_search_checkbox.is_checked()
+        ),
+        threshold=threshold_input.get_value(),
+        threshold_method=threshold_method_radio.get_value(),
+        incremental=incremental_checkbox.is_checked(),
+        duplicate_threshold=duplicate_threshold_input.get_value(),
     )
+    sly.logger.debug(f"Inference parameters: {params}.")
 
     # Locking all cards before inference is started.
     input.card.lock()
@@ -115,113 +247,142 @@ def start_inference():
     settings.card.lock()
     output.card.lock()
 
-    # Selecting device according to the availability of GPU.
-    device = g.DEVICE
-    sly.logger.info(f"Using device: {device}.")
-
-    # Building model, preprocessing input data and running inference.
-    model, preprocess, tokenizer = clip_api.build_model(model_name, pretrained, device, model_data)
-    sly.logger.info(
-        f"Model was built. Name: {model_name}, pretrained: {pretrained}, batch size: {batch_size}, JIT: {jit}."
-    )
     cancel_inference_button.show()
-
-    input_prompts = clip_api.preprocess_prompts([text_prompt], tokenizer, device)
-    sly.logger.info(f"Input prompts were preprocessed. Text prompt: {text_prompt}.")
-
-    # Getting images from selected dataset.
-    image_infos = g.api.image.get_list(g.SELECTED_DATASET)
+    text_prompt = query.label() or g.DEDUP_LABEL
     g.STATE.text_prompt = text_prompt
-    g.STATE.image_infos = image_infos
-
-    # Preparing list of image ids.
-    image_ids = [image_info.id for image_info in image_infos]
-    sly.logger.info(
-        f"Loaded {len(image_ids)} images from selected dataset with id {g.SELECTED_DATASET}."
-    )
 
-    inference_message.hide()
-
-    with inference_progress(message="Inference is running...", total=len(image_ids)) as pbar:
-        sly.logger.info(f"Starting inference loop with batch size: {batch_size}.")
-        start_inference_button.text = "Running..."
-
-        all_logits = []
-
-        for batched_image_ids in sly.batched(image_ids, batch_size):
-            if g.STATE.continue_inference:
-                # Starting inference loop in batches.
-                batched_image_bytes = g.api.image.download_bytes(
-                    g.SELECTED_DATASET, batched_image_ids
-                )
-
-                sly.logger.debug(f"Downloaded {len(batched_image_bytes)} images as bytes.")
-
-                # Converting images to PIL and preprocessing them.
-                images_pil = [
-                    clip_api.load_image(io.BytesIO(image_bytes))
-                    for image_bytes in batched_image_bytes
-                ]
-
-                sly.logger.debug(f"Loaded {len(images_pil)} images as PIL.")
-                images = [
-                    clip_api.preprocess_image(image_pil, preprocess) for image_pil in images_pil
-                ]
-                sly.logger.debug(f"Preprocessed {len(images)} images.")
-
-                input_images = clip_api.collate_batch(images, device)
-                logits = clip_api.infer_batch(model, input_images, input_prompts)
-                all_logits.append(logits)
-
-                pbar.update(len(batched_image_ids))
-
-    cancel_inference_button.hide()
-
-    if not g.STATE.continue_inference:
-        inference_message.text = "Inference was cancelled."
-        inference_message.status = "error"
-        inference_message.show()
-
-        sly.logger.info(f"Inference was canceled. Text prompt: {text_prompt}.")
-
-        start_inference_button.text = "Start inference"
-
-        input.card.unlock()
-        settings.card.unlock()
+    inference_job.start(run_inference, query, params, text_prompt)
+
+
+def run_inference(query: PromptQuery, params: engine.InferenceParams, text_prompt: str):
+    """Runs inference with the engine in the background job, updates UI with inference results
+    and saves inference results to the state. Errors are shown in the UI instead of the dialog
+    of the click handler.
+
+    Args:
+        query (PromptQuery): query with the prompts and example images.
+        params (engine.InferenceParams): inference parameters.
+        text_prompt (str): label of the query for the plot and the output.
+    """
+
+    def set_status(status: str):
+        inference_message.hide()
+        start_inference_button.text = status
+
+    try:
+        result = engine.run_inference(
+            g.api,
+            g.SELECTED_DATASETS,
+            query,
+            params,
+            progress=AsyncProgress(inference_progress),
+            is_cancelled=inference_job.is_cancelled,
+            status_cb=set_status,
+        )
+    except Exception as e:
+        sly.logger.error(f"Inference failed: {e}", exc_info=True)
+        finish_inference(f"Inference failed: {e}", "error")
+        return
 
+    if result.cancelled:
+        finish_inference("Inference was cancelled.", "error")
         return
 
-    start_inference_button.text = "Finishing..."
-    logits = clip_api.collect_inference(all_logits)
+    image_infos, scores, i_sort = result.image_infos, result.scores, result.i_sort
 
-    scores = clip_api.calculate_scores(logits, g.WEIGHTS).flatten()
+    g.STATE.image_infos = image_infos
+    g.STATE.dataset_ids = list(g.SELECTED_DATASETS)
+    g.STATE.params = params
     g.STATE.scores = scores
-
-    assert len(scores) == len(image_infos)
-
-    i_sort = np.argsort(scores)[::-1]
     g.STATE.i_sort = i_sort
 
-    inference_message.text = "Inference finished successfully."
-    inference_message.status = "success"
-
-    sly.logger.info(f"Inference finished successfully. Text prompt: {text_prompt}.")
+    message = "Inference finished successfully."
+    if result.encoded_count:
+        message += (
+            f" Encoded {result.encoded_count} images at "
+            f"{result.images_per_second:.1f} images/sec."
+        )
+    if result.reused_count:
+        message += f" Reused scores of {result.reused_count} unchanged images."
+    if result.duplicates_count:
+        message += f" Removed {result.duplicates_count} near-duplicates."
+
+    if result.metrics is not None:
+        metrics_message.text = metrics.format_summary(result.metrics)
+        metrics_message.show()
+
+    if len(image_infos) == 0:
+        finish_inference(message + " No images were selected.", "success")
+        return
 
     # Updating plot and table with inference results.
-    i_list, score_list = zip(*[(i, score) for i, score in enumerate(scores[i_sort])])
-    preview.update_plot(i_list, score_list, text_prompt)
+    preview.update_plot(np.arange(len(scores)).tolist(), scores[i_sort].tolist(), text_prompt)
 
     preview.build_table(image_infos, scores)
+    if len(g.SELECTED_DATASETS) > 1:
+        preview.build_datasets_breakdown(image_infos, scores, text_prompt)
 
     # Unlocking all cards after inference is finished.
     preview.card.unlock()
     output.card.unlock()
 
+    finish_inference(message, "success")
+
+
+def finish_inference(message: str, status: str):
+    """Shows the message and returns the UI to the state before inference.
+
+    Args:
+        message (str): message to show.
+        status (str): status of the message, e.g. "success" or "error".
+    """
+    cancel_inference_button.hide()
+    inference_message.text = message
+    inference_message.status = status
     inference_message.show()
+
     input.card.unlock()
     settings.card.unlock()
 
     start_inference_button.text = "Start inference"
+    start_inference_button.enable()
+
+
+def add_example(image_id: int):
+    """Adds the image to the examples for the search of similar images.
+
+    Args:
+        image_id (int): ID of the image.
+    """
+    image_id = int(image_id)
+    image_ids = parse_image_ids(examples_input.get_value())
+    if image_id not in image_ids:
+        image_ids.append(image_id)
+    examples_input.set_value(", ".join(str(image_id) for image_id in image_ids))
+    sly.logger.debug(f"Image with id {image_id} was added to the examples: {image_ids}.")
+
+
+@search_mode_radio.value_changed
+def search_mode_changed(search_mode: str):
+    """Shows the settings of the selected search mode.
+
+    Args:
+        search_mode (str): selected search mode.
+    """
+    if search_mode == "top_k":
+        top_k_container.show()
+    else:
+        top_k_container.hide()
+
+    if search_mode == "threshold":
+        threshold_container.show()
+    else:
+        threshold_container.hide()
+
+    if search_mode == "duplicates":
+        duplicates_container.show()
+    else:
+        duplicates_container.hide()
 
 
 @cancel_inference_button.click
@@ -229,4 +390,4 @@ def cancel_inference():
     sly.logger.debug("Cancel inference button was clicked.")
     cancel_inference_button.hide()
     start_inference_button.text = "Stopping..."
-    g.STATE.continue_inference = False
+    inference_job.cancel()
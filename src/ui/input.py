@@ -5,6 +5,7 @@ from supervisely.app.widgets import (
     Button,
     Container,
     DatasetThumbnail,
+    ProjectThumbnail,
     Text,
 )
 
@@ -17,12 +18,18 @@ import src.ui.output as output
 dataset_thumbnail = DatasetThumbnail()
 dataset_thumbnail.hide()
 
+# Thumbnail of the project and the number of selected datasets, if several datasets were selected.
+project_thumbnail = ProjectThumbnail()
+project_thumbnail.hide()
+selected_datasets_text = Text(status="info")
+selected_datasets_text.hide()
+
 load_button = Button("Load data")
 change_dataset_button = Button("Change dataset", icon="zmdi zmdi-lock-open")
 change_dataset_button.hide()
 
 no_dataset_message = Text(
-    "Please, select a dataset before clicking the button.",
+    "Please, select at least one dataset before clicking the button.",
     status="warning",
 )
 no_dataset_message.hide()
@@ -44,7 +51,7 @@ if g.DATASET_ID and g.PROJECT_ID:
     g.SELECTED_WORKSPACE = g.WORKSPACE_ID
     g.SELECTED_PROJECT = g.PROJECT_ID
     g.PROJECT_META = sly.ProjectMeta.from_json(g.api.project.get_meta(g.SELECTED_PROJECT))
-    g.SELECTED_DATASET = g.DATASET_ID
+    g.SELECTED_DATASETS = [g.DATASET_ID]
 
     # Hiding unnecessary widgets.
     select_dataset.hide()
@@ -67,20 +74,29 @@ elif g.PROJECT_ID:
     # g.SELECTED_WORKSPACE = g.WORKSPACE_ID
     # g.SELECTED_PROJECT = g.PROJECT_ID
 
-    select_dataset = SelectDataset(project_id=g.PROJECT_ID, compact=True, show_label=False)
+    select_dataset = SelectDataset(
+        project_id=g.PROJECT_ID,
+        multiselect=True,
+        select_all_datasets=True,
+        compact=True,
+        show_label=False,
+    )
 else:
     # If the app was loaded from ecosystem: showing the dataset selector in full mode.
     sly.logger.debug("App was loaded from ecosystem.")
 
-    select_dataset = SelectDataset()
+    select_dataset = SelectDataset(multiselect=True, select_all_datasets=True)
 
 # Inout card with all widgets.
 card = Card(
     "1️⃣ Input dataset",
-    "Images from the selected dataset will be loaded.",
+    "Images from the selected datasets will be loaded. Select several datasets or the whole "
+    "project to rank their images together with a single model.",
     content=Container(
         widgets=[
             dataset_thumbnail,
+            project_thumbnail,
+            selected_datasets_text,
             select_dataset,
             load_button,
             change_dataset_button,
@@ -97,19 +113,19 @@ def load_dataset():
     calling the API to get project, workspace and team ids (if they're not set),
     unlocking the settings card and showing the dataset thumbnail.
     """
-    # Reading the dataset id from SelectDataset widget.
-    dataset_id = select_dataset.get_selected_id()
+    # Reading the dataset ids from SelectDataset widget.
+    dataset_ids = select_dataset.get_selected_ids()
 
-    if not dataset_id:
-        # If the dataset id is empty, showing the warning message.
+    if not dataset_ids:
+        # If no datasets were selected, showing the warning message.
         no_dataset_message.show()
         return
 
-    # Hide the warning message if dataset was selected.
+    # Hide the warning message if datasets were selected.
     no_dataset_message.hide()
 
     # Changing the values of the global variables to access them from other modules.
-    g.SELECTED_DATASET = dataset_id
+    g.SELECTED_DATASETS = dataset_ids
 
     # Disabling the dataset selector and the load button.
     select_dataset.disable()
@@ -118,9 +134,9 @@ def load_dataset():
     # Showing the unlock button to change the dataset.
     change_dataset_button.show()
 
-    sly.logger.debug(f"Calling API with dataset ID {dataset_id} to get project ID.")
+    sly.logger.debug(f"Calling API with dataset ID {dataset_ids[0]} to get project ID.")
 
-    g.SELECTED_PROJECT = g.api.dataset.get_info_by_id(dataset_id).project_id
+    g.SELECTED_PROJECT = g.api.dataset.get_info_by_id(dataset_ids[0]).project_id
     g.PROJECT_META = sly.ProjectMeta.from_json(g.api.project.get_meta(g.SELECTED_PROJECT))
     g.SELECTED_WORKSPACE = g.api.project.get_info_by_id(g.SELECTED_PROJECT).workspace_id
     g.SELECTED_TEAM = g.api.workspace.get_info_by_id(g.SELECTED_WORKSPACE).team_id
@@ -130,12 +146,17 @@ def load_dataset():
         f"selected workspace: {g.SELECTED_WORKSPACE}, selected project: {g.SELECTED_PROJECT}"
     )
 
-    dataset_thumbnail.set(
-        g.api.project.get_info_by_id(g.SELECTED_PROJECT),
-        g.api.dataset.get_info_by_id(g.SELECTED_DATASET),
-    )
-
-    dataset_thumbnail.show()
+    if len(dataset_ids) == 1:
+        dataset_thumbnail.set(
+            g.api.project.get_info_by_id(g.SELECTED_PROJECT),
+            g.api.dataset.get_info_by_id(dataset_ids[0]),
+        )
+        dataset_thumbnail.show()
+    else:
+        project_thumbnail.set(g.api.project.get_info_by_id(g.SELECTED_PROJECT))
+        project_thumbnail.show()
+        selected_datasets_text.text = f"Selected {len(dataset_ids)} datasets."
+        selected_datasets_text.show()
 
     unlock_cards()
 
@@ -147,6 +168,9 @@ def unlock_input():
     select_dataset.enable()
     load_button.show()
     change_dataset_button.hide()
+    dataset_thumbnail.hide()
+    project_thumbnail.hide()
+    selected_datasets_text.hide()
 
     settings.card._lock_message = "Select the dataset on step 1️⃣."
     settings.card.lock()
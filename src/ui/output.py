@@ -1,7 +1,7 @@
 from collections import namedtuple
-from datetime import datetime
-from typing import Union
+from typing import Callable, List, Union
 
+import numpy as np
 import supervisely as sly
 from supervisely.app.widgets import (
     Checkbox,
@@ -14,10 +14,16 @@ from supervisely.app.widgets import (
     Button,
     Progress,
     Text,
+    TextArea,
     DatasetThumbnail,
+    ProjectThumbnail,
+    Flexbox,
 )
 
 import src.globals as g
+import src.engine as engine
+from src.jobs import AsyncProgress, BackgroundJob, Cancelled
+from src.prompts import parse_templates
 
 sort_checkbox = Checkbox("Sort images")
 filter_checkbox = Checkbox("Filter images")
@@ -55,6 +61,41 @@ sort_method_field = Field(
 )
 sort_method_field.hide()
 
+# Container with settings for splitting the images into several datasets by classes.
+split_checkbox = Checkbox("Split images by classes")
+class_prompts_input = TextArea(
+    placeholder="One class prompt per line, e.g. a photo of a dog", rows=3
+)
+class_templates_input = TextArea(placeholder="Optional templates, e.g. a photo of {}", rows=2)
+split_method_radio = RadioGroup(
+    items=[RadioGroup.Item(value=method, label=label) for method, label in g.SPLIT_METHODS.items()]
+)
+split_threshold_input = InputNumber(value=0.5, min=0.0, max=1.0, step=0.01)
+split_container = Container(
+    widgets=[
+        Field(
+            title="Classes",
+            description=(
+                "Each image is assigned to the classes by softmax over its similarities to the "
+                "class prompts. Images of each class are saved to a separate dataset named after "
+                "the class in the destination project. Embeddings from the inference are reused, "
+                "so the images aren't encoded again."
+            ),
+            content=Container(widgets=[class_prompts_input, class_templates_input]),
+        ),
+        Field(
+            title="Assign images to",
+            description="Probability threshold is used only for 'All classes' method.",
+            content=Container(widgets=[split_method_radio, split_threshold_input]),
+        ),
+    ]
+)
+split_container.hide()
+
+# Message if no class prompts were entered in split mode.
+no_classes_message = Text("Please, enter at least two class prompts.", status="error")
+no_classes_message.hide()
+
 # Message when no method was selected.
 no_method_message = Text("At least one method should be selected.", status="error")
 no_method_message.hide()
@@ -69,6 +110,8 @@ method_field = Field(
             filter_containter,
             sort_checkbox,
             sort_method_field,
+            split_checkbox,
+            split_container,
         ]
     ),
 )
@@ -83,6 +126,9 @@ add_confidence_field = Field(
 )
 
 save_button = Button("Save")
+cancel_save_button = Button(text="Cancel", button_type="danger", icon="zmdi zmdi-close-circle-o")
+cancel_save_button.hide()
+save_buttons_flexbox = Flexbox(widgets=[save_button, cancel_save_button])
 
 save_progress = Progress()
 save_progress.hide()
@@ -92,16 +138,21 @@ result_message = Text()
 result_dataset = DatasetThumbnail()
 result_dataset.hide()
 
+result_project = ProjectThumbnail()
+result_project.hide()
+
 # Container with all widgets for saving the results.
 save_container = Container(
     widgets=[
         no_method_message,
+        no_classes_message,
         destination,
         add_confidence_field,
-        save_button,
+        save_buttons_flexbox,
         save_progress,
         result_message,
         result_dataset,
+        result_project,
     ]
 )
 
@@ -114,6 +165,9 @@ card = Card(
 )
 card.lock()
 
+# Saving runs in the background, so the app keeps serving the UI while it's running.
+save_job = BackgroundJob("save")
+
 
 @sort_checkbox.value_changed
 def sort_method(is_checked: bool):
@@ -141,11 +195,32 @@ def filter_method(is_checked: bool):
         filter_containter.hide()
 
 
+@split_checkbox.value_changed
+def split_method(is_checked: bool):
+    """Updates the visibility of the split settings according to the split checkbox state.
+
+    Args:
+        is_checked (bool): True if the checkbox is checked, False otherwise.
+    """
+    if is_checked:
+        split_container.show()
+    else:
+        split_container.hide()
+
+
 @save_button.click
 def save():
-    """Handles the save button click event. Retrieves the settings from the UI and saves the results."""
+    """Handles the save button click event. Retrieves the settings from the UI and starts saving
+    the results in the background job."""
+    if save_job.running:
+        sly.logger.debug("Save button was clicked, but saving is already running.")
+        return
 
-    if not sort_checkbox.is_checked() and not filter_checkbox.is_checked():
+    if (
+        not sort_checkbox.is_checked()
+        and not filter_checkbox.is_checked()
+        and not split_checkbox.is_checked()
+    ):
         # If no method was selected, show the error message and stop the function.
         no_method_message.show()
 
@@ -154,9 +229,22 @@ def save():
         return
 
     no_method_message.hide()
+    no_classes_message.hide()
     result_dataset.hide()
+    result_project.hide()
     result_message.hide()
 
+    class_prompts = [line.strip() for line in class_prompts_input.get_value().splitlines()]
+    class_prompts = [prompt for prompt in class_prompts if prompt]
+    if split_checkbox.is_checked() and len(class_prompts) < 2:
+        no_classes_message.show()
+
+        sly.logger.debug(
+            "Save button clicked in split mode, but less than two classes were entered."
+        )
+
+        return
+
     # Preparing named tuples for the settings.
     Filter = namedtuple("Filter", ["active", "method", "threshold"])
     Sort = namedtuple("Sort", ["active", "method"])
@@ -180,49 +268,19 @@ def save():
     # Getting the images and their scores from the global state.
     image_infos, scores, i_sort = g.STATE.get_params()
 
-    if sort_settings.active:
-        # If sorting method is enabled, sort the images and their scores.
-        sly.logger.debug(f"Sorting is active, the sorting method is {sort_settings.method}.")
-
-        if sort_settings.method == "desc":
-            image_infos = [image_infos[i] for i in i_sort]
-            scores = [scores[i] for i in i_sort]
-        elif sort_settings.method == "asc":
-            image_infos = [image_infos[i] for i in i_sort[::-1]]
-            scores = [scores[i] for i in i_sort[::-1]]
-
-        sly.logger.debug("Images were sorted along with their scores.")
-
-    if filter_settings.active:
-        # If filtering method is enabled, filter the images by their scores according to the threshold.
-        sly.logger.debug(
-            f"Filtering is active, the filtering method is {filter_settings.method} "
-            f"with threshold {filter_settings.threshold}."
-        )
-
-        sly.logger.debug(f"Starting to filter {len(image_infos)} images.")
-
-        if filter_settings.method == "above threshold":
-            image_infos = [
-                image_infos[i]
-                for i, score in enumerate(scores)
-                if score >= filter_settings.threshold
-            ]
-        elif filter_settings.method == "below threshold":
-            image_infos = [
-                image_infos[i]
-                for i, score in enumerate(scores)
-                if score <= filter_settings.threshold
-            ]
-
-        sly.logger.debug(f"Finished filtering. {len(image_infos)} images left.")
+    save_params = engine.SaveParams(
+        sort_method=sort_settings.method if sort_settings.active else None,
+        filter_method=filter_settings.method if filter_settings.active else None,
+        threshold=filter_settings.threshold,
+    )
+    image_infos, scores = engine.select_images(image_infos, scores, i_sort, save_params)
 
     # Retrieving the selected project and dataset IDs from the destination widget.
     project_id = destination.get_selected_project_id()
     dataset_id = destination.get_selected_dataset_id()
 
-    if dataset_id == g.SELECTED_DATASET:
-        # If the same dataset was selected, show the warning message and stop the function.
+    if dataset_id in g.SELECTED_DATASETS:
+        # If one of the input datasets was selected, show the warning message and stop the function.
         sly.logger.warning("Same dataset was selected. Showing warning message and stopping.")
         sly.app.show_dialog(
             title="Same dataset was selected",
@@ -238,87 +296,86 @@ def save():
         sly.logger.info("Project was not selected. Creating new project.")
 
         project_id = create_project(destination.get_project_name())
-    if not dataset_id:
-        sly.logger.info("Dataset was not selected. Creating new dataset.")
-
-        dataset_id = create_dataset(project_id, destination.get_dataset_name())
-
-    sly.logger.info(f"Project ID: {project_id}. Dataset ID: {dataset_id}.")
-
-    # Updating the project meta to upload annotations.
-    project_meta = update_project_meta(project_id)
-    sly.logger.debug(f"Successfully updated project meta for project with ID {project_id}.")
-
-    image_ids = [image.id for image in image_infos]
 
     save_progress.show()
-    save_button.text = "Saving..."
-
-    sly.logger.info(f"Start saving {len(image_infos)} images.")
-
-    with save_progress(message="Saving in process...", total=len(image_infos)) as pbar:
-        uploaded_image_ids = []
-        prefix = 0
+    save_button.disable()
+    cancel_save_button.show()
 
-        for batched_image_infos in sly.batched(image_infos, g.BATCH_SIZE):
-            # Uploading images in batches.
-            sly.logger.debug(f"Starting to upload batch of {len(batched_image_infos)} images.")
-
-            ids = [image_info.id for image_info in batched_image_infos]
-            metas = []
-            names = []
-
-            for i in range(len(batched_image_infos)):
-                old_name = batched_image_infos[i].name
-                new_name = f"{str(prefix).zfill(5)}_{old_name}"
-                names.append(new_name)
-                prefix += 1
-
-                meta = batched_image_infos[i].meta
-                meta["Prompt based confidence"] = f"{g.STATE.text_prompt} - {scores[i]:.4f}"
-                metas.append(meta)
-
-            # Uploading images by their IDs.
-            uploaded_images = g.api.image.upload_ids(dataset_id, names, ids, metas=metas)
-            uploaded_image_ids.extend([image.id for image in uploaded_images])
+    if split_checkbox.is_checked():
+        save_job.start(run_save, save_splits, image_infos, class_prompts, project_id, add_tag)
+        return
 
-            sly.logger.debug(f"Successfully uploaded batch of {len(batched_image_infos)} images.")
-            pbar.update(len(batched_image_infos))
+    if not dataset_id:
+        sly.logger.info("Dataset was not selected. Creating new dataset.")
 
-    sly.logger.info(f"Finished uploading {len(uploaded_image_ids)} images.")
+        dataset_id = create_dataset(project_id, destination.get_dataset_name())
 
-    # Copying annotations from the selected dataset to the new dataset.
-    g.api.annotation.copy_batch_by_ids(image_ids, uploaded_image_ids, save_source_date=False)
-    sly.logger.info(f"Successfully copied annotations for {len(uploaded_image_ids)} images.")
+    sly.logger.info(f"Project ID: {project_id}. Dataset ID: {dataset_id}.")
 
-    if add_tag:
-        with save_progress(message="Adding tags...", total=len(uploaded_image_ids)) as pbar:
-            sly.logger.debug("Add tag is enabled. Starting to add tag to the images.")
+    save_job.start(run_save, save_results, image_infos, scores, project_id, dataset_id, add_tag)
 
-            tag_name = f"CLIP score ({g.STATE.text_prompt})"
-            sly.logger.debug(f"Tag name: {tag_name}")
 
-            score_meta = sly.TagMeta(tag_name, "any_number")
-            tagged_project_meta = project_meta.add_tag_meta(score_meta)
-            sly.logger.debug("Added tag meta to the project meta.")
+def run_save(func: Callable, *args):
+    """Runs the saving function in the background job and returns the UI to the state before
+    saving. Errors are shown in the UI instead of the dialog of the click handler.
 
-            g.api.project.update_meta(project_id, tagged_project_meta)
-            sly.logger.debug("Updated project meta with tag meta.")
+    Args:
+        func (Callable): saving function, save_results or save_splits.
+    """
+    try:
+        func(*args)
+    except Cancelled:
+        sly.logger.info("Saving was cancelled.")
+        show_result(
+            "Saving was cancelled, the images saved before it stay in the destination.", "warning"
+        )
+    except Exception as e:
+        sly.logger.error(f"Saving failed: {e}", exc_info=True)
+        show_result(f"Saving failed: {e}", "error")
+    finally:
+        cancel_save_button.hide()
+        save_button.text = "Save"
+        save_button.enable()
+
+
+def show_result(message: str, status: str):
+    result_message.text = message
+    result_message.status = status
+    result_message.show()
 
-            tag_meta = get_tag_meta(project_id, tag_name)
 
-            sly.logger.info("Starting to add tags to the images.")
-            for i in range(len(uploaded_image_ids)):
-                g.api.image.add_tag(uploaded_image_ids[i], tag_meta.sly_id, f"{scores[i]:.4f}")
-                pbar.update(1)
+def save_results(
+    image_infos: List[sly.ImageInfo],
+    scores: np.ndarray,
+    project_id: int,
+    dataset_id: int,
+    add_tag: bool,
+):
+    """Saves the selected images to the destination dataset.
 
-            sly.logger.info(f"Successfully added tags to {len(uploaded_image_ids)} images.")
+    Args:
+        image_infos (List[sly.ImageInfo]): infos of the selected images.
+        scores (np.ndarray): scores of the images (in the same order).
+        project_id (int): ID of the destination project.
+        dataset_id (int): ID of the destination dataset.
+        add_tag (bool): whether to add the confidence tag.
+    """
+    save_button.text = "Saving..."
 
-    save_button.text = "Save"
+    uploaded_image_ids = engine.save_results(
+        g.api,
+        image_infos,
+        scores,
+        g.STATE.text_prompt,
+        g.SELECTED_PROJECT,
+        project_id,
+        dataset_id,
+        add_tag=add_tag,
+        progress=AsyncProgress(save_progress),
+        is_cancelled=save_job.is_cancelled,
+    )
 
-    result_message.text = f"Successfully saved {len(uploaded_image_ids)} images."
-    result_message.status = "success"
-    result_message.show()
+    show_result(f"Successfully saved {len(uploaded_image_ids)} images.", "success")
 
     project_info = g.api.project.get_info_by_id(project_id)
     dataset_info = g.api.dataset.get_info_by_id(dataset_id)
@@ -327,35 +384,78 @@ def save():
     result_dataset.show()
 
 
-def update_project_meta(project_id: int) -> sly.ProjectMeta:
-    """Retrieves the project meta from the original project and updates the project meta for the new project.
+def save_splits(
+    image_infos: List[sly.ImageInfo], class_prompts: List[str], project_id: int, add_tag: bool
+):
+    """Classifies the selected images by the class prompts with the model of the last inference
+    and saves the images of each class to a new dataset in the destination project.
 
     Args:
-        project_id (int): ID of the new project.
+        image_infos (List[sly.ImageInfo]): infos of the selected images.
+        class_prompts (List[str]): prompts of the classes.
+        project_id (int): ID of the destination project.
+        add_tag (bool): whether to add the tag with the class probability.
 
-    Returns:
-        sly.ProjectMeta: Project meta of the original project.
+    Raises:
+        Cancelled: if the saving was cancelled.
     """
-    # Retrieving the project meta from the original project.
-    meta_json = g.api.project.get_meta(g.SELECTED_PROJECT)
-    project_meta = sly.ProjectMeta.from_json(meta_json)
-
-    sly.logger.debug(
-        f"Successfully downloaded project meta for original project with ID {g.SELECTED_PROJECT}."
+    save_button.text = "Classifying..."
+
+    probabilities = engine.classify_images(
+        g.api,
+        image_infos,
+        class_prompts,
+        g.STATE.params,
+        templates=parse_templates(class_templates_input.get_value()),
+        progress=AsyncProgress(save_progress),
+        is_cancelled=save_job.is_cancelled,
+    )
+    # The classification stops after the current batch, the datasets aren't created then.
+    if save_job.is_cancelled():
+        raise Cancelled()
+
+    dataset_ids = [engine.create_dataset(g.api, project_id, prompt) for prompt in class_prompts]
+    splits = engine.build_splits(
+        image_infos,
+        probabilities,
+        class_prompts,
+        dataset_ids,
+        split_method_radio.get_value(),
+        split_threshold_input.get_value(),
     )
 
-    # Updating the new project meta to upload annotations.
-    g.api.project.update_meta(project_id, project_meta)
+    save_button.text = "Saving..."
+
+    uploaded_image_ids = engine.save_splits(
+        g.api,
+        splits,
+        g.SELECTED_PROJECT,
+        project_id,
+        add_tag=add_tag,
+        progress=AsyncProgress(save_progress),
+        is_cancelled=save_job.is_cancelled,
+    )
 
-    sly.logger.debug(f"Successfully updated project meta for new project with ID {project_id}.")
+    show_result(
+        f"Successfully saved {sum(len(ids) for ids in uploaded_image_ids)} images "
+        f"to {len(splits)} datasets: "
+        + ", ".join(
+            f"{split.text_prompt} ({len(ids)})" for split, ids in zip(splits, uploaded_image_ids)
+        )
+        + ".",
+        "success",
+    )
 
-    return project_meta
+    result_project.set(g.api.project.get_info_by_id(project_id))
+    result_project.show()
 
 
-def get_tag_meta(project_id, tag_name) -> sly.TagMeta:
-    project_meta = g.api.project.get_meta(project_id)
-    project_meta = sly.ProjectMeta.from_json(project_meta)
-    return project_meta.get_tag_meta(tag_name)
+@cancel_save_button.click
+def cancel_save():
+    sly.logger.debug("Cancel save button was clicked.")
+    cancel_save_button.hide()
+    save_button.text = "Stopping..."
+    save_job.cancel()
 
 
 def create_project(project_name: Union[str, None]) -> int:
@@ -370,21 +470,12 @@ def create_project(project_name: Union[str, None]) -> int:
     """
     if not project_name:
         # If the name is not specified, timestamp and text prompt will be used.
-        text_prompt = g.STATE.text_prompt
-
-        timestamp = datetime.now().strftime("%Y-%m-%d %H:%M")
-
         sly.logger.debug(
-            f"Project name is not specified, using text prompt {text_prompt} and timestamp."
+            f"Project name is not specified, using text prompt {g.STATE.text_prompt} and timestamp."
         )
-        project_name = f"{timestamp}_({text_prompt})"
-
-    # Creating a new project.
-    project = g.api.project.create(g.WORKSPACE_ID, project_name, change_name_if_conflict=True)
+        project_name = engine.get_default_name(g.STATE.text_prompt)
 
-    sly.logger.info(f"Project with name {project_name} and id {project.id} was created.")
-
-    return project.id
+    return engine.create_project(g.api, g.WORKSPACE_ID, project_name)
 
 
 def create_dataset(project_id: int, dataset_name: Union[str, None]) -> int:
@@ -400,18 +491,9 @@ def create_dataset(project_id: int, dataset_name: Union[str, None]) -> int:
     """
     if not dataset_name:
         # If the name is not specified, timestamp and text prompt will be used.
-        text_prompt = g.STATE.text_prompt
-
-        timestamp = datetime.now().strftime("%Y-%m-%d %H:%M")
-
         sly.logger.debug(
-            f"Project name is not specified, using text prompt {text_prompt} and timestamp."
+            f"Dataset name is not specified, using text prompt {g.STATE.text_prompt} and timestamp."
         )
-        dataset_name = f"{timestamp}_({text_prompt})"
-
-    # Creating a new dataset.
-    dataset = g.api.dataset.create(project_id, dataset_name, change_name_if_conflict=True)
-
-    sly.logger.info(f"Dataset with name {dataset_name} and id {dataset.id} was created.")
+        dataset_name = engine.get_default_name(g.STATE.text_prompt)
 
-    return dataset.id
+    return engine.create_dataset(g.api, project_id, dataset_name)
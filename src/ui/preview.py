@@ -1,7 +1,8 @@
 import os
 
-from typing import List, Union
+from typing import Dict, List, Union
 
+import numpy as np
 import supervisely as sly
 from supervisely.app.widgets import (
     LinePlot,
@@ -14,6 +15,7 @@ from supervisely.app.widgets import (
 )
 
 import src.globals as g
+import src.ui.inference as inference
 
 confidence_text = Text(
     "Confidence value indicates how certain the model is that the search query is relevant to the image.",
@@ -24,10 +26,14 @@ confidence_text = Text(
 plot = LinePlot("Images scores by prompt", show_legend=True, decimals_in_float=4)
 
 # Preparing table for data and hiding it until the inference is done.
-table = Table(fixed_cols=1, width="100%", per_page=15, sort_column_id=4, sort_direction="desc")
+table = Table(fixed_cols=1, width="100%", per_page=15, sort_column_id=5, sort_direction="desc")
 table.hide()
 rows = []
 
+# Table with scores of the images in each dataset, shown if several datasets were selected.
+datasets_table = Table(width="100%", per_page=15, sort_column_id=2, sort_direction="desc")
+datasets_table.hide()
+
 image_preview = LabeledImage()
 image_preview.hide()
 
@@ -39,7 +45,11 @@ card = Card(
         [
             confidence_text,
             Container(
-                widgets=[plot, Container(widgets=[table, image_preview], direction="horizontal")]
+                widgets=[
+                    plot,
+                    datasets_table,
+                    Container(widgets=[table, image_preview], direction="horizontal"),
+                ]
             ),
         ]
     ),
@@ -83,8 +93,9 @@ def build_table(image_infos: List[sly.api.image_api.ImageInfo], scores: List[flo
     table.loading = True
     sly.logger.debug(f"Starting to build table with {len(image_infos)} images.")
 
+    dataset_names = get_dataset_names(image_infos)
     for image, score in zip(image_infos, scores):
-        rows.append(create_row(image, score))
+        rows.append(create_row(image, score, dataset_names[image.dataset_id]))
 
     table_data = {"columns": g.TABLE_COLUMNS, "data": rows}
 
@@ -99,12 +110,15 @@ def build_table(image_infos: List[sly.api.image_api.ImageInfo], scores: List[flo
     image_preview.show()
 
 
-def create_row(image_info: sly.api.image_api.ImageInfo, score: float) -> List[Union[int, str]]:
+def create_row(
+    image_info: sly.api.image_api.ImageInfo, score: float, dataset_name: str
+) -> List[Union[int, str]]:
     """Creates a row for the table with image data and score, also adds a button to select the image.
 
     Args:
         image_info (sly.api.image_api.ImageInfo): image info from dataset (id, name, width, height).
         score (float): score (confidence) for the image.
+        dataset_name (str): name of the dataset with the image.
 
     Returns:
         List[Union[int, str]]: list of values for the row in the table.
@@ -112,20 +126,73 @@ def create_row(image_info: sly.api.image_api.ImageInfo, score: float) -> List[Un
     return [
         image_info.id,
         image_info.name,
+        dataset_name,
         image_info.width,
         image_info.height,
         f"{score:.4f}",
         sly.app.widgets.Table.create_button(g.SELECT_BUTTON),
+        sly.app.widgets.Table.create_button(g.EXAMPLE_BUTTON),
     ]
 
 
+def build_datasets_breakdown(
+    image_infos: List[sly.api.image_api.ImageInfo], scores: np.ndarray, text_prompt: str
+):
+    """Builds the table with the number of images and their scores in each dataset and adds
+    the series with sorted scores of each dataset to the plot.
+
+    Args:
+        image_infos (List[sly.api.image_api.ImageInfo]): list of image infos from all datasets.
+        scores (np.ndarray): scores (confidence) for each image (in the same order as image_infos).
+        text_prompt (str): text prompt, used for inference.
+    """
+    datasets_table.loading = True
+
+    dataset_ids = np.array([image_info.dataset_id for image_info in image_infos])
+    dataset_names = get_dataset_names(image_infos)
+
+    datasets_rows = []
+    for dataset_id, dataset_name in dataset_names.items():
+        dataset_scores = np.sort(scores[dataset_ids == dataset_id])[::-1]
+        datasets_rows.append(
+            [
+                dataset_name,
+                len(dataset_scores),
+                f"{dataset_scores.mean():.4f}",
+                f"{dataset_scores.max():.4f}",
+            ]
+        )
+        update_plot(
+            np.arange(len(dataset_scores)).tolist(),
+            dataset_scores.tolist(),
+            f"{text_prompt} ({dataset_name})",
+        )
+
+    datasets_table.read_json({"columns": g.DATASETS_TABLE_COLUMNS, "data": datasets_rows})
+    datasets_table.loading = False
+    datasets_table.show()
+
+    sly.logger.debug(f"Built the breakdown of scores for {len(datasets_rows)} datasets.")
+
+
+def get_dataset_names(image_infos: List[sly.api.image_api.ImageInfo]) -> Dict[int, str]:
+    """Returns the names of the datasets with the images."""
+    dataset_ids = sorted({image_info.dataset_id for image_info in image_infos})
+    return {dataset_id: g.api.dataset.get_info_by_id(dataset_id).name for dataset_id in dataset_ids}
+
+
 @table.click
 def handle_table_button(datapoint: sly.app.widgets.Table.ClickedDataPoint):
-    """Handles the click on the button in the table. Downloads the image and updates the image preview.
+    """Handles the click on the button in the table. Downloads the image and updates the image preview
+    or adds the image to the examples for the search of similar images.
 
     Args:
         datapoint (sly.app.widgets.Table.ClickedDataPoint): data point with the button name and row data.
     """
+    if datapoint.button_name == g.EXAMPLE_BUTTON:
+        inference.add_example(datapoint.row[g.TABLE_COLUMNS[0]])
+        return
+
     if datapoint.button_name != g.SELECT_BUTTON:
         return
 
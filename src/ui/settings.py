@@ -1,6 +1,21 @@
-from supervisely.app.widgets import Card, RadioTable, Checkbox, InputNumber, Field, Container
+from typing import Dict
+
+import supervisely as sly
+from supervisely.app.widgets import (
+    Card,
+    RadioTable,
+    InputNumber,
+    Field,
+    Container,
+    RadioGroup,
+    Button,
+    Table,
+    Checkbox,
+)
 
 import src.globals as g
+import src.clip_api as clip_api
+from src.jobs import BackgroundJob
 
 # Building rows for RadioTable.
 rows = []
@@ -17,26 +32,170 @@ model_radio_field = Field(
 )
 
 # Field with batch size input.
-batch_size_input = InputNumber(value=g.MODEL_BATCH_SIZE, min=1, max=1024)
+batch_size_input = InputNumber(value=g.MODEL_BATCH_SIZE, min=1, max=g.MAX_BATCH_SIZE)
+auto_batch_size_checkbox = Checkbox("Adjust automatically", checked=False)
 batch_size_field = Field(
     title="Batch size",
-    description="Choose the batch size in range from 1 to 1024.",
-    content=batch_size_input,
+    description=(
+        f"Choose the batch size in range from 1 to {g.MAX_BATCH_SIZE}. In automatic mode the "
+        "first batches are used to find the batch size with the highest throughput, which fits "
+        "into the free RAM or VRAM, starting from the given one. In both modes the batch size "
+        "is reduced if the model runs out of memory."
+    ),
+    content=Container(widgets=[batch_size_input, auto_batch_size_checkbox]),
 )
 
-# JIT field.
-jit_checkbox = Checkbox(content="Enable JIT", checked=True)
-jit_field = Field(
-    title="Enable Just-In-Time compilation",
-    description="JIT can speed up inference, but may require more memory and increase runtime overhead.",
-    content=jit_checkbox,
+# Field with the number of batches prepared in advance.
+prefetch_input = InputNumber(value=g.PREFETCH_BATCHES, min=1, max=16)
+prefetch_field = Field(
+    title="Prefetch batches",
+    description=(
+        "Number of batches downloaded and decoded in advance while the model is busy. "
+        "Higher values hide network latency better, but require more memory."
+    ),
+    content=prefetch_input,
+)
+
+# Field with the number of workers and the pool mode for decoding images.
+decode_workers_input = InputNumber(value=g.DECODE_WORKERS, min=1, max=64)
+decode_mode_radio = RadioGroup(
+    items=[RadioGroup.Item(value=mode, label=label) for mode, label in g.DECODE_POOL_MODES.items()]
+)
+decode_field = Field(
+    title="Decoding workers",
+    description=(
+        "Number of workers, which decode and preprocess images in parallel. "
+        "Processes avoid the GIL and are faster for large images, but take longer to start."
+    ),
+    content=Container(widgets=[decode_workers_input, decode_mode_radio]),
+)
+
+# Field with the source of images for inference.
+image_source_radio = RadioGroup(
+    items=[RadioGroup.Item(value=source, label=label) for source, label in g.IMAGE_SOURCES.items()],
+    direction="vertical",
+)
+image_source_field = Field(
+    title="Image source",
+    description=(
+        "Models use images resized to 224-336 pixels, so decoding at reduced resolution "
+        "or downloading resized previews is much faster for high-resolution images."
+    ),
+    content=image_source_radio,
+)
+
+# Field with execution mode of the model.
+execution_mode_radio = RadioGroup(
+    items=[RadioGroup.Item(value=mode, label=label) for mode, label in g.EXECUTION_MODES.items()],
+    direction="vertical",
+)
+measure_speed_button = Button("Measure speed", button_type="text", icon="zmdi zmdi-timer")
+speed_table = Table(columns=g.SPEED_TABLE_COLUMNS, per_page=len(g.EXECUTION_MODES))
+speed_table.hide()
+execution_mode_field = Field(
+    title="Execution mode",
+    description=(
+        "JIT, torch.compile and channels-last memory format can speed up inference, "
+        "but may require more memory and time to prepare the model. "
+        "Measure the speed of each mode to choose the fastest one for the selected model."
+    ),
+    content=Container(widgets=[execution_mode_radio, measure_speed_button, speed_table]),
+)
+
+# Field with inference backend.
+backend_radio = RadioGroup(
+    items=[RadioGroup.Item(value=backend, label=label) for backend, label in g.BACKENDS.items()],
+    direction="vertical",
+)
+backend_field = Field(
+    title="Backend",
+    description=(
+        "ONNX Runtime can be several times faster on CPU, int8 quantization speeds it up further "
+        "with a negligible change of the ranking. The model is exported to ONNX on the first run, "
+        "the execution mode is not applied to ONNX models."
+    ),
+    content=backend_radio,
 )
 
 # Main card for all settings in the module.
 card = Card(
     title="2️⃣ Settings",
     description="Choose the model and necessary settings for it.",
-    content=Container(widgets=[model_radio_field, batch_size_field, jit_field]),
+    content=Container(
+        widgets=[
+            model_radio_field,
+            batch_size_field,
+            prefetch_field,
+            image_source_field,
+            decode_field,
+            execution_mode_field,
+            backend_field,
+        ]
+    ),
     lock_message="Select the dataset on step 1️⃣.",
 )
 card.lock()
+
+# Speed is measured in the background, so the app keeps serving the UI while models are built.
+measure_speed_job = BackgroundJob("measure_speed")
+
+
+@measure_speed_button.click
+def measure_speed():
+    """Starts the measurement of the speed of the selected model in the background job."""
+    if measure_speed_job.running:
+        sly.logger.debug("Measure speed button was clicked, but the measurement is running.")
+        return
+
+    selected_model = tuple(model_radio_table.get_selected_row())
+    model_name, pretrained = selected_model[:2]
+    model_data: Dict = g.MODELS[selected_model]
+    batch_size = batch_size_input.get_value()
+
+    measure_speed_button.loading = True
+    speed_table.loading = True
+    speed_table.show()
+
+    measure_speed_job.start(measure_modes, model_name, pretrained, model_data, batch_size)
+
+
+def measure_modes(model_name: str, pretrained: str, model_data: Dict, batch_size: int):
+    """Builds the model in each execution mode and measures the speed of the image encoder with
+    the batch size, then shows the results in the table. The models are built without the cache,
+    so the measurement doesn't evict the models used for inference.
+
+    Args:
+        model_name (str): name of the model.
+        pretrained (str): pretrained tag of the model.
+        model_data (Dict): url and path of the model checkpoint.
+        batch_size (int): batch size of the measurement.
+    """
+    rows = []
+    try:
+        for execution_mode, label in g.EXECUTION_MODES.items():
+            try:
+                model, preprocess, _ = clip_api.build_model(
+                    model_name, pretrained, g.DEVICE, model_data, execution_mode, cache=False
+                )
+                input_size = clip_api.get_input_size(preprocess)
+                images_per_second = clip_api.measure_throughput(
+                    model, input_size, batch_size, g.DEVICE, execution_mode
+                )
+            except Exception as e:
+                sly.logger.warning(f"Failed to measure speed in {execution_mode} mode: {e}")
+                rows.append([label, "failed"])
+                continue
+            finally:
+                # The model of the previous mode is freed before the next one is built.
+                model = None
+
+            sly.logger.info(
+                f"Model {model_name} ({pretrained}) in {execution_mode} mode: "
+                f"{images_per_second:.1f} images/sec with batch size {batch_size}."
+            )
+            rows.append([label, f"{images_per_second:.1f}"])
+
+        speed_table.read_json({"columns": g.SPEED_TABLE_COLUMNS, "data": rows})
+    finally:
+        speed_table.loading = False
+        measure_speed_button.loading = False
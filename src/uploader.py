@@ -0,0 +1,206 @@
+import time
+
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Callable, List, NamedTuple, Optional
+
+import supervisely as sly
+
+from src.jobs import Cancelled
+
+# Default number of attempts for each request and the initial delay between them in seconds.
+RETRIES = 3
+BACKOFF = 1.0
+
+
+def with_retries(func: Callable, *args, retries: int = RETRIES, backoff: float = BACKOFF, **kwargs):
+    """Calls the function and retries it with exponential backoff if it raises an exception.
+
+    Args:
+        func (Callable): function to call.
+        retries (int, optional): max number of attempts. Defaults to RETRIES.
+        backoff (float, optional): delay before the second attempt in seconds, it's doubled
+            after each attempt. Defaults to BACKOFF.
+
+    Returns:
+        the result of the function.
+    """
+    for attempt in range(1, retries + 1):
+        try:
+            return func(*args, **kwargs)
+        except Exception as e:
+            if attempt == retries:
+                raise
+            delay = backoff * 2 ** (attempt - 1)
+            sly.logger.warning(
+                f"Attempt {attempt} of {retries} to call {func.__name__} failed: {e}. "
+                f"Retrying in {delay:.1f} s."
+            )
+            time.sleep(delay)
+
+
+def upload_ids(
+    api: sly.Api,
+    dataset_id: int,
+    names: List[str],
+    ids: List[int],
+    metas: List[dict],
+    retries: int = RETRIES,
+) -> List[int]:
+    """Uploads the images to the dataset by their IDs and retries the failed request.
+    The upload isn't idempotent: the failed request could have been applied on the server
+    partially or completely, so before each retry the dataset is listed and only the images,
+    which aren't in it yet, are uploaded again.
+
+    Args:
+        api (sly.Api): API to upload the images with.
+        dataset_id (int): ID of the destination dataset.
+        names (List[str]): names of the uploaded images, unique in the dataset.
+        ids (List[int]): IDs of the original images.
+        metas (List[dict]): metas of the uploaded images.
+        retries (int, optional): max number of attempts. Defaults to RETRIES.
+
+    Returns:
+        List[int]: IDs of the uploaded images in the same order as names.
+    """
+    uploaded_ids = {}
+    attempted = False
+
+    def upload_missing():
+        nonlocal attempted
+        if attempted:
+            existing = {image.name: image.id for image in api.image.get_list(dataset_id)}
+            uploaded_ids.update((name, existing[name]) for name in names if name in existing)
+        attempted = True
+
+        indices = [index for index, name in enumerate(names) if name not in uploaded_ids]
+        if not indices:
+            return
+        uploaded_images = api.image.upload_ids(
+            dataset_id,
+            [names[index] for index in indices],
+            [ids[index] for index in indices],
+            metas=[metas[index] for index in indices],
+        )
+        uploaded_ids.update((image.name, image.id) for image in uploaded_images)
+
+    with_retries(upload_missing, retries=retries)
+    return [uploaded_ids[name] for name in names]
+
+
+class UploadJob(NamedTuple):
+    """Images to upload to one destination dataset.
+
+    Args:
+        dataset_id (int): ID of the destination dataset.
+        image_infos (List[sly.ImageInfo]): infos of the original images.
+        names (List[str]): names of the uploaded images.
+        metas (List[dict]): metas of the uploaded images.
+        on_batch_uploaded (Optional[Callable[[int, List[sly.ImageInfo], List[int]], None]]):
+            function, which takes the offset of the batch, infos of the original images and
+            IDs of the uploaded images. It isn't retried as a whole, so it should retry its own
+            requests.
+    """
+
+    dataset_id: int
+    image_infos: List[sly.ImageInfo]
+    names: List[str]
+    metas: List[dict]
+    on_batch_uploaded: Optional[Callable[[int, List[sly.ImageInfo], List[int]], None]] = None
+
+
+def upload_images(
+    api: sly.Api,
+    dataset_id: int,
+    image_infos: List[sly.ImageInfo],
+    names: List[str],
+    metas: List[dict],
+    on_batch_uploaded: Optional[Callable[[int, List[sly.ImageInfo], List[int]], None]],
+    batch_size: int,
+    workers: int,
+    progress_cb: Optional[Callable[[int], None]] = None,
+    retries: int = RETRIES,
+    is_cancelled: Callable[[], bool] = lambda: False,
+) -> List[int]:
+    """Uploads the images to the dataset by their IDs in batches with a pool of workers.
+    See upload_jobs for details.
+
+    Returns:
+        List[int]: IDs of the uploaded images in the same order as image_infos.
+    """
+    job = UploadJob(dataset_id, image_infos, names, metas, on_batch_uploaded)
+    return upload_jobs(api, [job], batch_size, workers, progress_cb, retries, is_cancelled)[0]
+
+
+def upload_jobs(
+    api: sly.Api,
+    jobs: List[UploadJob],
+    batch_size: int,
+    workers: int,
+    progress_cb: Optional[Callable[[int], None]] = None,
+    retries: int = RETRIES,
+    is_cancelled: Callable[[], bool] = lambda: False,
+) -> List[List[int]]:
+    """Uploads the images of all the jobs by their IDs in batches with a single pool of workers,
+    so the batches of different destination datasets are uploaded concurrently. Each batch is
+    processed with on_batch_uploaded of its job (e.g. to copy annotations) as soon as it's
+    uploaded, so the uploads and the post-processing of different batches run concurrently.
+    Failed uploads are retried with exponential backoff, see upload_ids.
+
+    Args:
+        api (sly.Api): API to upload the images with.
+        jobs (List[UploadJob]): images to upload to each destination dataset.
+        batch_size (int): number of images in the batch.
+        workers (int): number of batches uploaded at the same time.
+        progress_cb (Optional[Callable[[int], None]], optional): function, which takes the number
+            of processed images. Defaults to None.
+        retries (int, optional): max number of attempts for each upload. Defaults to RETRIES.
+        is_cancelled (Callable[[], bool], optional): function, which returns True if the upload
+            was cancelled. Checked before each batch, the uploaded batches stay in the datasets.
+            Defaults to lambda: False.
+
+    Raises:
+        Cancelled: if the upload was cancelled.
+
+    Returns:
+        List[List[int]]: IDs of the uploaded images of each job in the same order as its infos.
+    """
+
+    def upload_batch(job: UploadJob, offset: int) -> List[int]:
+        if is_cancelled():
+            raise Cancelled()
+        batched_image_infos = job.image_infos[offset : offset + batch_size]
+        ids = [image_info.id for image_info in batched_image_infos]
+        uploaded_ids = upload_ids(
+            api,
+            job.dataset_id,
+            job.names[offset : offset + batch_size],
+            ids,
+            job.metas[offset : offset + batch_size],
+            retries,
+        )
+
+        sly.logger.debug(f"Successfully uploaded batch of {len(uploaded_ids)} images.")
+
+        if job.on_batch_uploaded is not None:
+            job.on_batch_uploaded(offset, batched_image_infos, uploaded_ids)
+
+        return uploaded_ids
+
+    uploaded_batches = [{} for _ in jobs]
+    with ThreadPoolExecutor(max_workers=max(workers, 1)) as executor:
+        futures = {
+            executor.submit(upload_batch, job, offset): (job_index, offset)
+            for job_index, job in enumerate(jobs)
+            for offset in range(0, len(job.image_infos), batch_size)
+        }
+        for future in as_completed(futures):
+            uploaded_ids = future.result()
+            job_index, offset = futures[future]
+            uploaded_batches[job_index][offset] = uploaded_ids
+            if progress_cb is not None:
+                progress_cb(len(uploaded_ids))
+
+    return [
+        [image_id for offset in sorted(batches) for image_id in batches[offset]]
+        for batches in uploaded_batches
+    ]
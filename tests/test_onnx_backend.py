@@ -0,0 +1,50 @@
+"""Checks that the rankings of the ONNX backend match the PyTorch model. Uses a small randomly
+initialized CLIP model, so no weights are downloaded. Run from the repository root:
+    python -m pytest tests
+"""
+
+import pytest
+
+torch = pytest.importorskip("torch")
+open_clip = pytest.importorskip("open_clip")
+pytest.importorskip("onnx")
+pytest.importorskip("onnxruntime")
+pytest.importorskip("supervisely")
+
+import src.onnx_backend as onnx_backend  # noqa: E402
+
+INPUT_SIZE = 64
+
+# Min mean top-k overlap with the PyTorch model. The exported fp32 model computes the same
+# function, int8 weights are allowed to reorder the images close to the top-k boundary.
+MIN_OVERLAP = {False: 0.9, True: 0.6}
+
+
+def build_small_model():
+    torch.manual_seed(0)
+    model = open_clip.CLIP(
+        embed_dim=64,
+        vision_cfg={"image_size": INPUT_SIZE, "patch_size": 16, "width": 64, "layers": 2},
+        text_cfg={"context_length": 77, "vocab_size": 49408, "width": 64, "heads": 2, "layers": 2},
+    )
+    return model.eval(), open_clip.get_tokenizer("ViT-B-32")
+
+
+@pytest.mark.parametrize("quantize", [False, True], ids=["fp32", "int8"])
+def test_topk_overlap_with_pytorch(tmp_path, quantize):
+    model, tokenizer = build_small_model()
+    onnx_model = onnx_backend.build_onnx_model(
+        model, tokenizer, INPUT_SIZE, str(tmp_path), "cpu", quantize=quantize
+    )
+
+    torch.manual_seed(1)
+    overlap = onnx_backend.verify(model, onnx_model, tokenizer, INPUT_SIZE)
+
+    assert overlap >= MIN_OVERLAP[quantize]
+
+
+def test_topk_overlap():
+    scores = torch.arange(10, dtype=torch.float32).numpy()
+
+    assert onnx_backend.topk_overlap(scores, scores, 3) == 1.0
+    assert onnx_backend.topk_overlap(scores, -scores, 3) == 0.0